@@ -25,7 +25,7 @@ current state of the component, and these are updated by processing systems.
 
 import math
 
-from .ecs import Component, EntityRef, EntityRefList
+from .ecs import Component, EntityRef, EntityRefList, Column, VectorColumn
 from .utils import Timer, Vec2d
 
 
@@ -39,8 +39,30 @@ class Joint(Component):
         self.entity_b_local_point = Vec2d(0, 0)
 
 
+class RigidAttachment(Component):
+    """ The entity's body is rigidly attached to another entity's body.  It is
+    simulated as an extra shape on the other body, so its position and velocity
+    follow that body, but its orientation is its own. """
+    def __init__(self, entity, game_services, config):
+        Component.__init__(self, entity, game_services, config)
+        self.parent = EntityRef(None, Body)
+        self.position = Vec2d(config.get_or_default("position", (0, 0)))
+
+
 class Body(Component):
     """ A physical body. """
+
+    # Fields that can be stored in columns.
+    mass = Column("mass")
+    size = Column("size")
+    position = VectorColumn("position")
+    velocity = VectorColumn("velocity")
+    angular_velocity = Column("angular_velocity")
+    orientation = Column("orientation")
+    is_collideable = Column("is_collideable", dtype=bool)
+    force = VectorColumn("force")
+    torque = Column("torque")
+
     def __init__(self, entity, game_services, config):
         Component.__init__(self, entity, game_services, config)
         self.mass = config.get_or_default("mass", 1)
@@ -52,9 +74,18 @@ class Body(Component):
         self.orientation = 0
         self.kinematic = config.get_or_default("kinematic", False)
 
-        # List of (force, position) vectors. These impulses will be applied on
-        # the next update to the physics simulation.
-        self.impulses = []
+        # Collision filtering: "default" bodies collide with everything and
+        # "bullet" bodies collide with everything but other bullets. Bodies
+        # in the same nonzero collision group don't collide. If the group is
+        # 0, the physics system works one out (e.g. from the entity's team.)
+        self.collision_category = config.get_or_default("collision_category",
+                                                        "default")
+        self.collision_group = 0
+
+        # The net force (in local coordinates) and torque applied to the body
+        # since the last update to the physics simulation.
+        self.force = Vec2d(0, 0)
+        self.torque = 0
 
 
 class Tracking(Component):
@@ -106,6 +137,11 @@ class ExplodesOnDeath(Component):
 
 class Hitpoints(Component):
     """ Object with hitpoints, can be damaged. """
+
+    # Fields that can be stored in columns.
+    hp = Column("hp")
+    max_hp = Column("max_hp")
+
     def __init__(self, entity, game_services, config):
         Component.__init__(self, entity, game_services, config)
         self.hp = self.config["hp"]
@@ -114,6 +150,13 @@ class Hitpoints(Component):
 
 class Power(Component):
     """ The entity stores / produces power. """
+
+    # Fields that can be stored in columns.
+    capacity = Column("capacity")
+    power = Column("power")
+    recharge_rate = Column("recharge_rate")
+    overloaded = Column("overloaded", bool)
+
     def __init__(self, entity, game_services, config):
         Component.__init__(self, entity, game_services, config)
         self.capacity = config["capacity"]
@@ -125,6 +168,13 @@ class Power(Component):
 
 class Shields(Component):
     """ The entity has shields that protect it from damage. """
+
+    # Fields that can be stored in columns.
+    hp = Column("hp")
+    max_hp = Column("max_hp")
+    recharge_rate = Column("recharge_rate")
+    overloaded = Column("overloaded", bool)
+
     def __init__(self, entity, game_services, config):
         Component.__init__(self, entity, game_services, config)
         self.hp = self.config["hp"]
@@ -139,12 +189,52 @@ class DamageOnContact(Component):
     pass
 
 
+class TeamParentRef(EntityRef):
+    """ The reference to the parent of a Team, which counts changes to it: see
+    Team.version. """
+
+    def __init__(self, team, *types):
+        """ Constructor. 'team' is the Team that has the parent. """
+        EntityRef.__init__(self, None, *types)
+        self.__team = team
+
+    def __set_entity(self, entity):
+        """ Set the wrapped entity. """
+        EntityRef.entity.fset(self, entity)
+        self.__team.version += 1
+
+    entity = property(EntityRef.entity.fget, __set_entity)
+
+
 class Team(Component):
-    """ The entity is on a team. """
+    """ The entity is on a team. If it has a parent with a team, then it is on
+    its parent's team. """
+
+    # Fields that can be stored in columns. The team id is the resolved team:
+    # see teams.py.
+    team_id = Column("team_id", int)
+
     def __init__(self, entity, game_services, config):
         Component.__init__(self, entity, game_services, config)
+
+        # Incremented whenever the team or parent changes, so that resolved
+        # teams can be cached.
+        self.version = 0
+
         self.team = config.get_or_none("team")
-        self.parent = EntityRef(None, Team)
+        self.parent = TeamParentRef(self, Team)
+        self.team_id = 0
+
+    @property
+    def team(self):
+        """ The name of the team, or None. """
+        return self.__team
+
+    @team.setter
+    def team(self, team):
+        """ Set the name of the team. """
+        self.__team = team
+        self.version += 1
 
 
 class Text(Component):
@@ -199,7 +289,9 @@ class Thrusters(Component):
         self.direction = Vec2d(0, 0)
         self.turn = 0
         self.thrusters = EntityRefList(Thruster)
-        self.thruster_configurations = {}
+
+        # The layout of the thrusters, for looking up their allocations.
+        self.layout = None
 
 
 class Turret(Component):
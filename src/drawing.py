@@ -2,6 +2,7 @@
 
 from pygame import Rect
 import math
+import numpy
 import random
 
 from .physics import Physics
@@ -9,7 +10,7 @@ from .components import Body, Thrusters, Thruster, Hitpoints, Text, Shields, \
                         AnimationComponent, Weapon, Power, Camera, CelestialBody, \
                         Planet, Star, Dockable, Player
 from .renderer import Renderer, View
-from .systems import get_team
+from .systems import get_team, ProjectileSystem
 from .ecs import EntityRef
 from .utils import Vec2d, Polygon
 
@@ -77,6 +78,7 @@ class Drawing(object):
         if camera.zoom_level > zoom_map_threshold:
             self.__draw_planets(camera)
             self.__draw_animations(camera)
+            self.__draw_projectiles(camera)
             self.__draw_thrusters(camera)
             self.__draw_shields(camera)
             self.__draw_lasers(camera)
@@ -335,25 +337,59 @@ class Drawing(object):
                 **kwargs
             )
 
+    def __draw_projectiles(self, camera):
+        """ Draw the projectiles, which point the way they are going. """
+        projectile_system = self.__entity_manager.get_system(ProjectileSystem)
+        if projectile_system is None:
+            return
+        projectiles = projectile_system.projectiles
+        if len(projectiles.ages) == 0:
+            return
+        velocities = projectiles.velocities
+        orientations = -numpy.degrees(
+            numpy.arctan2(velocities[:, 1], velocities[:, 0])) - 90
+        for (position, orientation, type_index) in \
+                zip(projectiles.positions, orientations, projectiles.types):
+            projectile_type = projectile_system.types[type_index]
+            if projectile_type.anim is None:
+                continue
+            self.__renderer.add_job_animation(
+                orientation,
+                Vec2d(position[0], position[1]),
+                projectile_type.anim,
+                brightness=projectile_type.brightness
+            )
+
     def __draw_thrusters(self, camera):
         """ Draw the thrusters affecting the body. """
         physics = self.__entity_manager.get_system(Physics)
         entities = self.__entity_manager.query(Body, Thrusters)
         for entity in entities:
             thrusters = entity.get_component(Thrusters)
+            firing = []
             for thruster_ent in thrusters.thrusters:
                 thruster = thruster_ent.get_component(Thruster)
                 if thruster.thrust > 0:
-                    pos = physics.local_to_world(entity, thruster.position)
-                    dir = physics.local_dir_to_world(entity, thruster.direction)
-                    length = thruster.thrust / 500.0
-                    length *= (1.0 + random.random()*0.1 - 0.2)
-                    poly = Polygon.make_bullet_polygon(pos, pos-(dir*length))
-                    self.__renderer.add_job_polygon(
-                        poly,
-                        colour=(255, 255, 255),
-                        brightness=2
-                    )
+                    firing.append(thruster)
+            if len(firing) == 0:
+                continue
+
+            # Transform all of the firing thrusters at once.
+            positions = physics.local_to_world_array(
+                entity, [thruster.position for thruster in firing])
+            directions = physics.local_dir_to_world_array(
+                entity, [thruster.direction for thruster in firing])
+            for (thruster, pos, dir) in zip(firing, positions, directions):
+                pos = Vec2d(pos[0], pos[1])
+                dir = Vec2d(dir[0], dir[1])
+                length = thruster.thrust / 500.0
+                length *= (1.0 + random.random()*0.1 - 0.2)
+                poly = Polygon.make_bullet_polygon(pos, pos-(dir*length))
+                self.__renderer.add_job_polygon(
+                    poly,
+                    colour=(255, 255, 255),
+                    brightness=2
+                )
 
     def __draw_hitpoints(self, camera):
         """ Draw the entity's hitpoints, or a marker showing where it
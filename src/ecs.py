@@ -32,19 +32,57 @@ to the 'player' team, and the body has a default mass and size.  If we do
 
 then the Team defaults to 'player'.
 
+Each config is compiled into an 'entity prototype' the first time it is used:
+the component types are looked up once, and the prototype is reused for every
+entity created from that config.  Many entities can be created from a prototype
+at once using create_entities().
+
+A prototype can be marked as pooled by adding a 'pool' entry to its config.
+When an entity created from a pooled prototype dies, its components are kept
+and reused, reinitialised from their configs, for the next entity created from
+the prototype.  This is worthwhile for short-lived things like bullets.
+
 Entity processing 'systems' can be registered with the entity manager. A system
 operates on a subset of the entities in the manager, determined by a query.
 Systems can be update()ed, allowing them to make changes to the entities they
 operate on.
 
+Entities are stored grouped by 'archetype' - the set of component types they
+have - so that a query only visits the groups of entities that match it.
+
+Optionally, the numeric fields of some component types can be stored in
+columns: contiguous arrays with a row per component.  Such fields are declared
+as Column attributes of the component class, and read and written as normal,
+but systems can also get at the whole column to process it in bulk.
+
+Systems can declare the component types that they read and write.  If the
+entity manager is given some threads, consecutive systems that don't conflict
+are updated concurrently.  While this is happening, entities can be created and
+killed and components added and removed, but this is recorded in a 'command
+buffer' and only done once all of the systems have finished.  So during a stage
+create_entity() returns None: a system that needs to set up the entities it
+creates passes a 'setup' function, which is called with the new entity.  A
+killed entity's handle is invalidated straight away, so references to it see it
+as dead during the rest of the stage.  Two systems can kill the same entity at
+once, so the dead are deduplicated before they are removed.
+
 Global services are exposed via a 'game services' object.  This is injected
 into each component.
 """
 
+import collections
+import copy
+import csv
+import json
+import multiprocessing.pool
+import numpy
 import pickle
+import threading
+import timeit
+import weakref
 
 from .config import Config
-from .utils import lookup_type, bail
+from .utils import lookup_type, bail, Vec2d
 
 class GameInfo(object):
     """ Information about the running game. """
@@ -57,6 +95,16 @@ class GameInfo(object):
         self.min_framerate = 0
         self.time_ratio = 0
         self.framerates = []
+        self.pool_stats = {}
+        self.cache_stats = {}
+
+    def update_pool_stats(self, name, stats):
+        """ Update the statistics for a named object pool. """
+        self.pool_stats[name] = copy.copy(stats)
+
+    def update_cache_stats(self, name, stats):
+        """ Update the statistics for a named cache. """
+        self.cache_stats[name] = copy.copy(stats)
 
     def update_framerate(self, framerate, raw_framerate, time_ratio):
         """ Update the framerate tracking data. """
@@ -69,6 +117,211 @@ class GameInfo(object):
         if len(self.framerates) > 30:
             self.framerates.pop(0)
 
+class CacheStats(object):
+    """ Statistics about a cache. """
+
+    def __init__(self):
+        """ Constructor. """
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        """ The proportion of requests that were served from the cache. """
+        requests = self.hits + self.misses
+        if requests == 0:
+            return 0
+        return float(self.hits) / requests
+
+
+class PoolStats(CacheStats):
+    """ Statistics about an object pool. """
+
+    def __init__(self):
+        """ Constructor. """
+        CacheStats.__init__(self)
+        self.size = 0
+        self.peak_size = 0
+
+    def resize(self, delta):
+        """ Track a change in the size of the pool. """
+        self.size += delta
+        self.peak_size = max(self.peak_size, self.size)
+
+
+class Instrumentation(object):
+    """ Per-frame measurements of the systems in an entity manager.
+
+    The time taken by each system and the number of entities it manages are
+    recorded every frame, along with the number of entities and the number of
+    components created and destroyed.  Only the most recent frames are kept. """
+
+    def __init__(self, frames=300):
+        """ Constructor. Keep the given number of frames. """
+        self.frames = frames
+        self.system_names = []
+        self.system_times = {}
+        self.system_entities = {}
+        self.entity_counts = collections.deque(maxlen=frames)
+        self.components_created = collections.deque(maxlen=frames)
+        self.components_destroyed = collections.deque(maxlen=frames)
+
+    def record_system(self, name, time, entities):
+        """ Record the time taken to update a system, in seconds, and the
+        number of entities it managed. """
+        if not name in self.system_times:
+            self.system_names.append(name)
+            self.system_times[name] = collections.deque(maxlen=self.frames)
+            self.system_entities[name] = collections.deque(maxlen=self.frames)
+        self.system_times[name].append(time)
+        self.system_entities[name].append(entities)
+
+    def record_frame(self, entities, created, destroyed):
+        """ Record the number of entities at the end of a frame, and the
+        number of components created and destroyed during it. """
+        self.entity_counts.append(entities)
+        self.components_created.append(created)
+        self.components_destroyed.append(destroyed)
+
+    def breakdown(self):
+        """ Get (name, mean time, mean entities) for each system, most
+        expensive first. """
+        ret = []
+        for name in self.system_names:
+            times = self.system_times[name]
+            entities = self.system_entities[name]
+            ret.append((name,
+                        sum(times) / len(times),
+                        float(sum(entities)) / len(entities)))
+        return sorted(ret, key=lambda x: x[1], reverse=True)
+
+    def rows(self):
+        """ Get a dictionary for each recorded frame, oldest first. """
+        ret = []
+        for i in range(len(self.entity_counts)):
+            row = collections.OrderedDict()
+            row["entities"] = self.entity_counts[i]
+            row["components_created"] = self.components_created[i]
+            row["components_destroyed"] = self.components_destroyed[i]
+            for name in self.system_names:
+                # Systems that have only recently been registered have fewer
+                # frames recorded.
+                times = self.system_times[name]
+                j = i - (len(self.entity_counts) - len(times))
+                if j >= 0:
+                    row[name + "_time"] = times[j]
+                    row[name + "_entities"] = self.system_entities[name][j]
+            ret.append(row)
+        return ret
+
+    def export_csv(self, output_file):
+        """ Write the recorded frames to a file as CSV. """
+        fields = ["entities", "components_created", "components_destroyed"]
+        for name in self.system_names:
+            fields += [name + "_time", name + "_entities"]
+        writer = csv.DictWriter(output_file, fields)
+        writer.writeheader()
+        for row in self.rows():
+            writer.writerow(row)
+
+    def export_json(self, output_file):
+        """ Write the recorded frames to a file as JSON. """
+        json.dump(self.rows(), output_file, indent=2)
+
+    def export(self, filename):
+        """ Write the recorded frames to a file, as JSON if the filename
+        ends in .json and as CSV otherwise. """
+        with open(filename, "w") as output_file:
+            if filename.endswith(".json"):
+                self.export_json(output_file)
+            else:
+                self.export_csv(output_file)
+
+
+class CommandBuffer(object):
+    """ Changes to the entity manager made by a system while it is being
+    updated concurrently with others.  They are made when execute() is
+    called. """
+
+    def __init__(self):
+        """ Constructor. """
+        self.__commands = []
+
+    def kill(self, entity):
+        """ Record that an entity has been killed. """
+        self.__commands.append((self.__kill, (entity,)))
+
+    def add_component(self, component):
+        """ Add a component to its entity later. """
+        self.__commands.append((self.__add_component, (component,)))
+
+    def remove_component(self, entity, component_type):
+        """ Remove a component from an entity later. """
+        self.__commands.append((self.__remove_component,
+                                (entity, component_type)))
+
+    def create_entity(self, config_name=None, setup=None):
+        """ Create an entity later.  If given, 'setup' is called with the new
+        entity. """
+        self.__commands.append((self.__create_entity, (config_name, setup)))
+
+    def execute(self, entity_manager):
+        """ Carry out the recorded commands in order. """
+        for (command, args) in self.__commands:
+            command(entity_manager, *args)
+        self.__commands = []
+
+    @staticmethod
+    def __kill(entity_manager, entity):
+        """ Kill an entity. """
+        entity_manager.on_entity_killed(entity)
+
+    @staticmethod
+    def __create_entity(entity_manager, config_name, setup):
+        """ Create an entity. """
+        entity_manager.create_entity(config_name, setup)
+
+    @staticmethod
+    def __add_component(entity_manager, component):
+        """ Add a component. """
+        entity_manager.add_component(component)
+
+    @staticmethod
+    def __remove_component(entity_manager, entity, component_type):
+        """ Remove a component. """
+        entity_manager.remove_component_by_concrete_type(entity, component_type)
+
+
+class SystemScheduler(object):
+    """ Works out which systems can be updated at the same time. """
+
+    @staticmethod
+    def conflicts(system1, system2):
+        """ Might two systems interfere with one another? """
+        if system1.writes is None or system2.writes is None:
+            return True
+        return len(system1.writes & (system2.reads | system2.writes)) > 0 or \
+               len(system2.writes & system1.reads) > 0
+
+    @staticmethod
+    def stages(systems):
+        """ Split a list of systems into stages.  Each stage is a run of
+        consecutive systems that don't conflict, so a stage can be updated
+        concurrently without changing the result. """
+        stages = []
+        stage = []
+        for system in systems:
+            for other in stage:
+                if SystemScheduler.conflicts(system, other):
+                    stages.append(stage)
+                    stage = []
+                    break
+            stage.append(system)
+        if len(stage) > 0:
+            stages.append(stage)
+        return stages
+
+
 class GameServices(object):
     """ Functionality required of the game. """
 
@@ -119,19 +372,68 @@ class GameServices(object):
 class EntityManager(object):
     """ Manages a set of components systems which themselves manage components. """
 
-    def __init__(self, game_services):
-        """ Initialise the entity manager. """
+    def __init__(self, game_services, columnar=False):
+        """ Initialise the entity manager. If 'columnar' is set then Column
+        fields of components are stored in ComponentTables. """
 
         # Currently existing objects and queue of objects to create.
         self.__entities = []
         self.__new_entities = []
+        self.__queued = set()
+
+        # Entities that have been killed since the last garbage collection.
+        self.__dead = []
 
-        # Map from component concrete type to component store.
-        self.__component_store = ComponentStore()
+        # Generation table for entity handles.
+        self.__handles = EntityHandles()
+
+        # Compiled entity prototypes, by config filename and by config.
+        self.__prototypes = {}
+        self.__config_prototypes = weakref.WeakKeyDictionary()
+
+        # Components of dead entities, by pooled prototype.
+        self.__pools = {}
+        self.__pool_stats = PoolStats()
+
+        # Measurements of the systems, if they are being taken, and the
+        # number of components created and destroyed this frame.
+        self.__instrumentation = None
+        self.__components_created = 0
+        self.__components_destroyed = 0
+
+        # Component storage.
+        self.__columnar = columnar
+        self.__component_store = ComponentStore(columnar)
+
+        # Live query views, keyed on the tuple of queried types, and the views
+        # interested in each component type.
+        self.__views = {}
+        self.__views_by_type = {}
 
         # Entity processing systems.
         self.__systems = []
 
+        # Groups of systems that can be updated concurrently, and the threads
+        # to do it with.  If there is no thread pool, the systems are updated
+        # one by one.
+        self.__stages = None
+        self.__thread_pool = None
+
+        # The command buffer of the stage being updated on this thread.
+        self.__local = threading.local()
+
+        # Map from component type to the systems interested in it.  This is
+        # filled in as types are encountered.
+        self.__systems_by_type = {}
+
+        # Map from system class to system, filled in by get_system().
+        self.__systems_by_class = {}
+
+        # Count of component add / remove notifications sent to systems this
+        # frame, and in the last complete frame.
+        self.__notifications = 0
+        self.__last_frame_notifications = 0
+
         # The game services.  These get passed into the objects we create.
         self.__game_services = game_services
 
@@ -158,6 +460,11 @@ class EntityManager(object):
 
         # Move new entities to the working set.
         self.__entities += self.__new_entities
+        self.__queued.clear()
+
+        # They now exist, so they can appear in query views.
+        for entity in self.__new_entities:
+            self.__enter_views(entity)
         del self.__new_entities[:]
 
     def save(self, output_file):
@@ -166,7 +473,8 @@ class EntityManager(object):
         output = {
             "entities" : self.__entities,
             "new_entities" : self.__new_entities,
-            "components" : self.__component_store
+            "components" : self.__component_store,
+            "handles" : self.__handles
         }
         pickle.dump(output, output_file)
 
@@ -179,18 +487,84 @@ class EntityManager(object):
             for e in (entities + new_entities):
                 e.just_unpickled(self.__game_services)
             components = old_state["components"]
+            self.__handles = old_state["handles"]
             self.__entities = entities
             self.__new_entities = new_entities
+            self.__queued = set(new_entities)
+            self.__dead = []
+            self.__pools = {}
+            self.__pool_stats.resize(-self.__pool_stats.size)
             self.__component_store = components
+            self.__component_store.set_columnar(self.__columnar)
+            for types in self.__views:
+                self.__populate_view(self.__views[types])
+            for system in self.__systems:
+                system.on_load()
         except:
             bail()
 
+    def on_entity_killed(self, entity):
+        """ Called when an entity is marked for deletion.  References to it
+        are invalidated at once, even if its removal is deferred. """
+        if entity.handle is not None:
+            self.__handles.advance(entity.handle[0])
+        commands = getattr(self.__local, "commands", None)
+        if commands is not None:
+            commands.kill(entity)
+            return
+        self.__dead.append(entity)
+
+    def is_alive(self, handle):
+        """ Is the entity with the given handle alive, and has it kept all of
+        its components since the handle was obtained? """
+        return self.__handles.is_valid(handle)
+
+    def get_entity(self, handle):
+        """ Get the entity with the given handle, or None if the handle is no
+        longer valid. """
+        return self.__handles.lookup(handle)
+
     def __garbage_collect(self):
-        """ Remove all of the objects that have been marked for deletion."""
-        self.__component_store.garbage_collect(self.__systems)
-        for o in self.__entities:
-            if o.is_garbage:
-                self.__entities.remove(o)
+        """ Remove all of the objects that have been marked for deletion.
+        This only touches the dead entities and their components, unless
+        something has died in which case the entity lists are compacted. """
+        if len(self.__dead) == 0:
+            return
+
+        # An entity can be killed twice if two systems being updated
+        # concurrently kill it at once.
+        dead = list(collections.OrderedDict.fromkeys(self.__dead))
+        self.__dead = []
+
+        # Keep hold of the components of pooled entities.
+        recycled = [
+            (o.prototype, self.__component_store.get_all_components(o))
+            for o in dead if o.prototype is not None and o.prototype.pooled
+        ]
+
+        # Remove the entities and their components.
+        for o in dead:
+            self.__exit_views(o)
+        self.__component_store.garbage_collect(dead, self.__notify_remove)
+
+        # Return the components to their pools.
+        for (prototype, components) in recycled:
+            pool = self.__pools.setdefault(prototype, [])
+            if len(pool) < prototype.pool_size:
+                pool.append(dict((type(c), c) for c in components))
+                self.__pool_stats.resize(1)
+
+        # The entities' handle slots can now be reused.
+        for o in dead:
+            if o.handle is not None:
+                self.__handles.release(o.handle[0])
+
+        # Compact the entity lists.  Entities killed before they were created
+        # are dropped from the creation queue.
+        self.__entities = [o for o in self.__entities if not o.is_garbage]
+        if any(o in self.__queued for o in dead):
+            self.__new_entities[:] = [o for o in self.__new_entities if not o.is_garbage]
+            self.__queued = set(self.__new_entities)
 
     def create_component(self, entity, component_type, data=Config()):
         if not isinstance(data, Config):
@@ -200,41 +574,113 @@ class EntityManager(object):
         return component
 
     def create_entity_with(self, *types):
-        """ Create a new entity with a given list of components. """
-        entity = self.create_entity()
-        for t in types:
-            component = t(entity, self.__game_services, Config())
-            entity.add_component(component)
+        """ Create a new entity with a given list of components.  During a
+        stage, this is deferred and returns None: see create_entity(). """
+        def add_components(entity):
+            for t in types:
+                component = t(entity, self.__game_services, Config())
+                entity.add_component(component)
+        return self.create_entity(setup=add_components)
+
+    def get_prototype(self, config_name):
+        """ Get the compiled prototype for a config, which can be given as a
+        filename or a Config. Prototypes are compiled once and cached. """
+        if isinstance(config_name, EntityPrototype):
+            return config_name
+        if isinstance(config_name, Config):
+            prototype = self.__config_prototypes.get(config_name)
+            if prototype is None:
+                prototype = EntityPrototype(config_name)
+                self.__config_prototypes[config_name] = prototype
+            return prototype
+        prototype = self.__prototypes.get(config_name)
+        if prototype is None:
+            loader = self.__game_services.get_resource_loader()
+            prototype = EntityPrototype(loader.load_config_file(config_name))
+            self.__prototypes[config_name] = prototype
+        return prototype
+
+    def create_entity(self, config_name=None, setup=None):
+        """ Add a new object. It is initialised, but not added to the game
+        right away: that gets done at a certain point in the game loop.  If
+        given, 'setup' is called with the new object.
+
+        If a stage of systems is being updated concurrently, the creation is
+        recorded in the calling system's command buffer and None is returned,
+        so anything that needs doing to the object must be done by 'setup'. """
+        commands = getattr(self.__local, "commands", None)
+        if commands is not None:
+            commands.create_entity(config_name, setup)
+            return None
+
+        # Instantiate the object.
+        if config_name is None:
+            entity = self.__instantiate(None)
+        else:
+            entity = self.__instantiate(self.get_prototype(config_name))
+        if setup is not None:
+            setup(entity)
         return entity
 
-    def create_entity(self, config_name=None):
-        """ Add a new object. It is initialised, but not added to the game
-        right away: that gets done at a certain point in the game loop."""
+    def create_entities(self, config_name, n):
+        """ Create n entities from the same config or prototype.  During a
+        stage, this is deferred and returns None: see create_entity(). """
+        commands = getattr(self.__local, "commands", None)
+        if commands is not None:
+            for i in range(n):
+                commands.create_entity(config_name)
+            return None
+        prototype = self.get_prototype(config_name)
+        return [self.__instantiate(prototype) for i in range(n)]
 
-        loader = self.__game_services.get_resource_loader()
+    @property
+    def pool_stats(self):
+        """ Statistics about the pooling of entities' components. """
+        return self.__pool_stats
 
-        # load the config if specified.
-        config = None
-        if config_name is not None:
-            if isinstance(config_name, Config):
-                config = config_name
-            else:
-                config = loader.load_config_file(config_name)
-        else:
-            config = Config()
+    def __instantiate(self, prototype):
+        """ Create an entity from a prototype, or an empty entity if the
+        prototype is None. """
 
-        # Instantiate the object.
         obj = Entity(self.__game_services)
-        obj.name = config.name.title()
+        obj.prototype = prototype
         obj.id = self.__next_id
         self.__next_id += 1
-
-        # Add components specified in the config.
-        components = config.get_or_default("components", Config())
-        for component in components:
-            component_config = components[component]
-            component_type = lookup_type(component)
-            component = component_type(obj, self.__game_services, component_config)
+        obj.handles = self.__handles
+        obj.handle = self.__handles.allocate(obj)
+
+        # It doesn't exist until it has been created, so keep it out of query
+        # views while its components are added.
+        self.__queued.add(obj)
+
+        # Take some components from the pool if possible.
+        name = "Anonymous"
+        components = ()
+        pooled = None
+        if prototype is not None:
+            name = prototype.name
+            components = prototype.components
+            if prototype.pooled:
+                pool = self.__pools.get(prototype)
+                if pool:
+                    pooled = pool.pop()
+                    self.__pool_stats.hits += 1
+                    self.__pool_stats.resize(-1)
+                else:
+                    self.__pool_stats.misses += 1
+        obj.name = name
+
+        # Add components specified in the config.  Pooled components are
+        # reinitialised rather than constructed.
+        game_services = self.__game_services
+        for (component_type, component_config) in components:
+            component = None
+            if pooled is not None:
+                component = pooled.get(component_type)
+            if component is None:
+                component = component_type(obj, game_services, component_config)
+            else:
+                component_type.__init__(component, obj, game_services, component_config)
             obj.add_component(component)
 
         # Add the object to the creation queue, and return it to the caller.
@@ -250,19 +696,82 @@ class EntityManager(object):
             self.__systems,
             key = lambda x: x.priority
         )
+        self.__systems_by_class = {}
+        self.__stages = None
+        self.system_interests_changed()
+
+    def system_interests_changed(self):
+        """ Called when the component types that a system matches() have
+        changed, so that it is notified about the right components. """
+        self.__systems_by_type = {}
 
     def add_component(self, component):
-        """ Add a component to the appropriate store. """
+        """ Add a component to the appropriate store.  During a stage, this
+        is deferred: see create_entity(). """
+        commands = getattr(self.__local, "commands", None)
+        if commands is not None:
+            commands.add_component(component)
+            return
         self.__component_store.add(component.entity, component)
+        self.__components_created += 1
 
         # Notify the systems.
-        for system in self.__systems:
-            if system.matches(component.__class__):
-                system.on_component_add(component)
+        for system in self.__get_interested_systems(component.__class__):
+            self.__notifications += 1
+            system.on_component_add(component)
+
+        # The entity might have entered some query views.
+        entity = component.entity
+        if not entity in self.__queued:
+            signature = self.__component_store.get_signature(entity)
+            for view in self.__views_by_type.get(component.__class__, ()):
+                if not entity in view and view.matches(signature):
+                    view.add(entity)
 
     def remove_component_by_concrete_type(self, entity, component_type):
-        """ Remove the component of the given ***concrete*** type from the entity. """
-        self.__component_store.remove(entity, component_type, self.__systems)
+        """ Remove the component of the given ***concrete*** type from the
+        entity.  During a stage, this is deferred: see create_entity(). """
+        commands = getattr(self.__local, "commands", None)
+        if commands is not None:
+            commands.remove_component(entity, component_type)
+            return
+        component = self.__component_store.get(entity, component_type)
+        if component is None:
+            return
+        self.__notify_remove(component)
+        self.__component_store.remove(entity, component_type)
+
+        # References to the entity might be checking for the component.
+        if entity.handle is not None:
+            handle = self.__handles.advance(entity.handle[0])
+            if not entity.is_garbage:
+                entity.handle = handle
+
+        # The entity might have left some query views.
+        for view in self.__views_by_type.get(component_type, ()):
+            if entity in view:
+                view.remove(entity)
+
+    def __get_interested_systems(self, component_type):
+        """ Get the systems that want to know about components of a type. """
+        systems = self.__systems_by_type.get(component_type)
+        if systems is None:
+            systems = [s for s in self.__systems if s.matches(component_type)]
+            self.__systems_by_type[component_type] = systems
+        return systems
+
+    def __notify_remove(self, component):
+        """ Tell the interested systems that a component is being removed. """
+        self.__components_destroyed += 1
+        for system in self.__get_interested_systems(component.__class__):
+            self.__notifications += 1
+            system.on_component_remove(component)
+
+    @property
+    def last_frame_notifications(self):
+        """ The number of component add / remove notifications that were
+        sent to systems during the last update. """
+        return self.__last_frame_notifications
 
     def get_component_of_type(self, entity, t):
         """ Get the component of a particular type on a particular entity. """
@@ -272,14 +781,51 @@ class EntityManager(object):
         """ Get all components of an entity. """
         return self.__component_store.get_all_components(entity)
 
-    def query(self, type1, *types):
-        """ Get all entities with a particular set of components. """
+    def get_component_table(self, component_type):
+        """ Get the table holding the columns of a component type, or None if
+        the type isn't stored in columns. """
+        return self.__component_store.get_table(component_type)
 
-        # Get the matching entities.
-        matches = self.__component_store.query_entities(type1, *types)
-
-        # Don't expose entities that don't technically exist yet.
-        return filter(lambda x: x not in self.__new_entities, matches)
+    def query(self, type1, *types):
+        """ Get all entities with a particular set of components.  This is the
+        cached tuple of a query view, so it is only rebuilt when entities
+        enter or exit the view. """
+        return self.query_view(type1, *types).entities()
+
+    def query_view(self, type1, *types):
+        """ Get a live view of the entities with a particular set of
+        components.  This doesn't include entities queued for creation. """
+        types = (type1,) + types
+        view = self.__views.get(types)
+        if view is None:
+            view = QueryView(types)
+            self.__populate_view(view)
+            self.__views[types] = view
+            for t in types:
+                self.__views_by_type.setdefault(t, []).append(view)
+        return view
+
+    def __populate_view(self, view):
+        """ Fill a view with the matching entities from the store. """
+        view.clear()
+        for entity in self.__component_store.iter_entities(*view.types):
+            if not entity in self.__queued:
+                view.add(entity)
+
+    def __enter_views(self, entity):
+        """ Add a newly created entity to the views that it matches. """
+        signature = self.__component_store.get_signature(entity)
+        for component_type in signature:
+            for view in self.__views_by_type.get(component_type, ()):
+                if not entity in view and view.matches(signature):
+                    view.add(entity)
+
+    def __exit_views(self, entity):
+        """ Remove an entity from all of the views containing it. """
+        for component_type in self.__component_store.get_signature(entity):
+            for view in self.__views_by_type.get(component_type, ()):
+                if entity in view:
+                    view.remove(entity)
 
     def query_include_queued(self, type1, *types):
         """ Get all entities with a particular set of components. 
@@ -290,104 +836,569 @@ class EntityManager(object):
 
     def get_system(self, system_type):
         """ Get a system by type. """
+        if system_type in self.__systems_by_class:
+            return self.__systems_by_class[system_type]
         for system in self.__systems:
             if isinstance(system, system_type):
-                return system
+                break
+        else:
+            system = None
+        self.__systems_by_class[system_type] = system
+        return system
+
+    def __update_system(self, system, dt):
+        """ Update a system, measuring it if required. """
+        if self.__paused and not system.updates_when_paused:
+            return
+        instrumentation = self.__instrumentation
+        if instrumentation is None:
+            system.update(dt)
+        else:
+            start = timeit.default_timer()
+            system.update(dt)
+            instrumentation.record_system(type(system).__name__,
+                                          timeit.default_timer() - start,
+                                          system.entity_count())
+
+    def __update_stage(self, stage, dt):
+        """ Update a group of non-conflicting systems concurrently.  Each
+        system gets a command buffer, and these are executed in order once all
+        of the systems are done. """
+        buffers = [CommandBuffer() for system in stage]
+        def update(i):
+            self.__local.commands = buffers[i]
+            try:
+                self.__update_system(stage[i], dt)
+            finally:
+                self.__local.commands = None
+        self.__thread_pool.map(update, range(len(stage)))
+        for commands in buffers:
+            commands.execute(self)
+
+    @property
+    def instrumentation(self):
+        """ Measurements of the systems, or None if they aren't being
+        taken. """
+        return self.__instrumentation
+
+    def set_instrumented(self, instrumented, frames=300):
+        """ Start or stop measuring the systems.  The given number of
+        frames of measurements are kept. """
+        if instrumented:
+            self.__instrumentation = Instrumentation(frames)
+        else:
+            self.__instrumentation = None
+
+    def set_system_threads(self, threads):
+        """ Set the number of threads used to update systems.  With fewer
+        than two, the systems are updated one by one in priority order. """
+        if self.__thread_pool is not None:
+            self.__thread_pool.close()
+            self.__thread_pool = None
+        if threads > 1:
+            self.__thread_pool = multiprocessing.pool.ThreadPool(threads)
+
+    def get_command_buffer(self):
+        """ Get the command buffer for the calling system, if it is being
+        updated concurrently with other systems. """
+        return getattr(self.__local, "commands", None)
 
     def update(self, dt):
         """ Update all of the systems in priority order. """
-        for system in self.__systems:
-            if not self.__paused or system.updates_when_paused:
-                system.update(dt)
+        if self.__thread_pool is None:
+            for system in self.__systems:
+                self.__update_system(system, dt)
+        else:
+            if self.__stages is None:
+                self.__stages = SystemScheduler.stages(self.__systems)
+            for stage in self.__stages:
+                if len(stage) == 1:
+                    self.__update_system(stage[0], dt)
+                else:
+                    self.__update_stage(stage, dt)
         self.__garbage_collect()
+        instrumentation = self.__instrumentation
+        if instrumentation is not None:
+            instrumentation.record_frame(len(self.__entities),
+                                         self.__components_created,
+                                         self.__components_destroyed)
+        self.__components_created = 0
+        self.__components_destroyed = 0
+        self.__last_frame_notifications = self.__notifications
+        self.__notifications = 0
+
+
+class Archetype(object):
+    """ The set of entities that have exactly the same component types.
+
+    Grouping entities by their 'signature' means that a query only has to
+    visit the archetypes whose signature contains every queried type, rather
+    than intersecting the entity sets of each individual type. """
+
+    def __init__(self, signature):
+        """ Constructor. """
+
+        # The (frozen) set of component types of our entities.
+        self.signature = signature
+
+        # The entities, and the index of each one in the list.
+        self.entities = []
+        self.__indices = {}
+
+        # Archetypes we have moved entities to by adding or removing a type.
+        self.with_type = {}
+        self.without_type = {}
+
+    def matches(self, types):
+        """ Do our entities have all of the given types? """
+        for t in types:
+            if not t in self.signature:
+                return False
+        return True
+
+    def add(self, entity):
+        """ Add an entity. """
+        self.__indices[entity] = len(self.entities)
+        self.entities.append(entity)
+
+    def remove(self, entity):
+        """ Remove an entity.  The last entity is moved into its slot, so
+        this doesn't have to shuffle the list along. """
+        index = self.__indices.pop(entity)
+        last = self.entities.pop()
+        if last is not entity:
+            self.entities[index] = last
+            self.__indices[last] = index
 
 
 class ComponentStore(object):
-    """ Data storage for components. """
+    """ Data storage for components.
 
-    def __init__(self):
+    Components are stored per entity, and entities are grouped into
+    'archetypes' according to the types of component they have. """
+
+    def __init__(self, columnar=False):
         """ Constructor. """
-        self.__component_stores = {}
+
+        # Map from entity to a map from component type to component.
+        self.__components = {}
+
+        # If columnar storage is enabled, map from component type to the table
+        # for that type (or None if the type has no columns.)
+        self.__tables = {} if columnar else None
+
+        # Map from entity to the archetype containing it.
+        self.__entity_archetypes = {}
+
+        # Map from signature to archetype.
+        self.__archetypes = {}
+
+        # Map from a tuple of queried types to the matching archetypes.
+        self.__queries = {}
 
     def add(self, entity, component):
         """ Add a component to an entity """
-        self.__ensure_store_exists(component.__class__)
-        assert self.get(entity, component.__class__) is None
-        self.__component_stores[component.__class__][entity] = component
+        component_type = component.__class__
+        components = self.__components.setdefault(entity, {})
+        assert not component_type in components
+        components[component_type] = component
+        table = self.get_table(component_type)
+        if table is not None:
+            table.add(component)
+
+        # Move the entity to its new archetype.
+        old = self.__entity_archetypes.get(entity)
+        if old is None:
+            new = self.__get_archetype(frozenset(components))
+        else:
+            new = old.with_type.get(component_type)
+            if new is None:
+                new = self.__get_archetype(old.signature | set([component_type]))
+                old.with_type[component_type] = new
+            old.remove(entity)
+        new.add(entity)
+        self.__entity_archetypes[entity] = new
 
     def get(self, entity, component_type):
         """ Get a component from an entity. """
-        self.__ensure_store_exists(component_type)
-        try:
-            return self.__component_stores[component_type][entity]
-        except KeyError:
+        components = self.__components.get(entity)
+        if components is None:
             return None
+        return components.get(component_type)
 
-    def remove(self, entity, component_type, systems):
+    def remove(self, entity, component_type):
         """ Remove a component from an entity. """
-        self.__ensure_store_exists(component_type)
-        store = self.__component_stores[component_type]
-        if entity in store:
-
-            # Notify observers.
-            for system in systems:
-                if system.matches(component_type):
-                    system.on_component_remove(store[entity])
-
-            # Remove the component.
-            del store[entity]
+        components = self.__components.get(entity)
+        if components is None or not component_type in components:
+            return
+
+        # Remove the component.
+        self.__detach(components.pop(component_type))
+
+        # Move the entity to its new archetype.
+        old = self.__entity_archetypes.pop(entity)
+        old.remove(entity)
+        if len(components) == 0:
+            del self.__components[entity]
+            return
+        new = old.without_type.get(component_type)
+        if new is None:
+            new = self.__get_archetype(old.signature - set([component_type]))
+            old.without_type[component_type] = new
+        new.add(entity)
+        self.__entity_archetypes[entity] = new
+
+    def iter_entities(self, type1, *types):
+        """ Iterate over the entities that have a particular set of
+        components.  This walks the matching archetypes without copying them,
+        so components mustn't be added or removed while iterating. """
+        for archetype in self.__get_matching_archetypes((type1,) + types):
+            for entity in archetype.entities:
+                yield entity
 
     def query_entities(self, type1, *types):
-        """ Get the entities that have a particular set of components. """
-        self.__ensure_store_exists(type1)
-        ret = set(self.__component_stores[type1].keys())
-        for t in types:
-            self.__ensure_store_exists(t)
-            ret = ret.intersection(set(self.__component_stores[t].keys()))
+        """ Get a list of the entities that have a particular set of
+        components.  Unlike iter_entities(), the list can be used while
+        components are added and removed. """
+        archetypes = self.__get_matching_archetypes((type1,) + types)
+        if len(archetypes) == 1:
+            return list(archetypes[0].entities)
+        ret = []
+        for archetype in archetypes:
+            ret.extend(archetype.entities)
         return ret
 
     def get_all_components(self, entity):
         """ Get all of the components of a given entity. """
-        return [c for c in map(
-            lambda t: self.get(entity, t),
-            self.__component_stores.keys()
-        ) if c is not None]
+        return list(self.__components.get(entity, {}).values())
+
+    def get_signature(self, entity):
+        """ Get the set of component types that an entity has. """
+        archetype = self.__entity_archetypes.get(entity)
+        if archetype is None:
+            return frozenset()
+        return archetype.signature
 
-    def garbage_collect(self, systems):
-        """ Delete each component of each entity that is marked for deletion. """
+    def garbage_collect(self, dead, on_remove):
+        """ Delete each component of each of the given dead entities.
+        'on_remove' is called with each component before it is deleted. """
+
+        # Ignore entities that don't have any components.
+        dead = [entity for entity in dead if entity in self.__components]
 
         # First notify any observers that might be interested.
-        for component_type in self.__component_stores:
-            store = self.__component_stores[component_type]
-            for entity in store:
-                if entity.is_garbage:
-                    for system in systems:
-                        if system.matches(component_type):
-                            system.on_component_remove(store[entity])
+        for entity in dead:
+            for component in self.__components[entity].values():
+                on_remove(component)
 
         # Now perform the deletion.
-        for component_type in self.__component_stores:
-            store = self.__component_stores[component_type]
-            entities = store.keys()
-            for entity in entities:
-                if entity.is_garbage:
-                    del store[entity]
+        for entity in dead:
+            for component in self.__components.pop(entity).values():
+                self.__detach(component)
+            self.__entity_archetypes.pop(entity).remove(entity)
+
+    def get_table(self, component_type):
+        """ Get the table storing the columns of a component type, if there
+        is one. """
+        if self.__tables is None:
+            return None
+        if not component_type in self.__tables:
+            table = None
+            if len(ComponentTable.get_columns(component_type)) > 0:
+                table = ComponentTable(component_type)
+            self.__tables[component_type] = table
+        return self.__tables[component_type]
+
+    def set_columnar(self, columnar):
+        """ Switch columnar storage on or off, moving component data into or
+        out of tables as required. """
+        if self.__tables is not None:
+            for table in self.__tables.values():
+                if table is not None:
+                    table.clear()
+        self.__tables = {} if columnar else None
+        if columnar:
+            for components in self.__components.values():
+                for component in components.values():
+                    table = self.get_table(component.__class__)
+                    if table is not None:
+                        table.add(component)
+
+    def __detach(self, component):
+        """ Remove a component from its table, if it is in one. """
+        if component._table is not None:
+            component._table.remove(component)
 
-    def __ensure_store_exists(self, component_type):
-        """ Ensure an object store exists for the component type. """
-        if not component_type in self.__component_stores:
-            self.__component_stores[component_type] = {}
+    def __getstate__(self):
+        """ Tables aren't serialised: the components save their own values,
+        and the tables are rebuilt by set_columnar() after loading. """
+        ret = self.__dict__.copy()
+        if ret["_ComponentStore__tables"] is not None:
+            ret["_ComponentStore__tables"] = {}
+        return ret
+
+    def __get_archetype(self, signature):
+        """ Get the archetype with the given signature, creating it if it
+        doesn't exist yet. """
+        archetype = self.__archetypes.get(signature)
+        if archetype is None:
+            archetype = Archetype(signature)
+            self.__archetypes[signature] = archetype
+            for types in self.__queries:
+                if archetype.matches(types):
+                    self.__queries[types].append(archetype)
+        return archetype
+
+    def __get_matching_archetypes(self, types):
+        """ Get the archetypes matching a query.  These are cached, and the
+        cache is kept up to date as new archetypes are created. """
+        archetypes = self.__queries.get(types)
+        if archetypes is None:
+            archetypes = [a for a in self.__archetypes.values() if a.matches(types)]
+            self.__queries[types] = archetypes
+        return archetypes
+
+
+class Column(object):
+    """ A numeric component field that can be stored in a ComponentTable.
+
+    A component class declares its columns as class attributes.  While the
+    component is not in a table - because columnar storage is switched off,
+    or because the component hasn't been added to an entity yet - the value
+    lives in the component's __dict__ like any other field. """
+
+    def __init__(self, name, dtype=float):
+        """ Constructor. The name must match the attribute name. """
+        self.name = name
+        self.dtype = dtype
+
+    def shape(self):
+        """ The shape of a single value in the column. """
+        return ()
+
+    def read(self, array, row):
+        """ Read the value in a row. """
+        return array.item(row)
+
+    def write(self, array, row, value):
+        """ Write the value in a row. """
+        array[row] = value
+
+    def __get__(self, obj, objtype=None):
+        """ Get the value of the field. """
+        if obj is None:
+            return self
+        table = obj._table
+        if table is None:
+            return obj.__dict__[self.name]
+        return self.read(table.arrays[self.name], obj._row)
+
+    def __set__(self, obj, value):
+        """ Set the value of the field. """
+        table = obj.__dict__.get("_table")
+        if table is None:
+            obj.__dict__[self.name] = value
+        else:
+            self.write(table.arrays[self.name], obj._row, value)
+
+
+class VectorColumn(Column):
+    """ A Vec2d component field that can be stored in a ComponentTable. The
+    column is an array of (x, y) pairs. """
+
+    def __init__(self, name):
+        """ Constructor. """
+        Column.__init__(self, name, float)
+
+    def shape(self):
+        """ The shape of a single value in the column. """
+        return (2,)
+
+    def read(self, array, row):
+        """ Read the value in a row. """
+        return Vec2d(array.item(row, 0), array.item(row, 1))
+
+    def write(self, array, row, value):
+        """ Write the value in a row. """
+        array[row, 0] = value[0]
+        array[row, 1] = value[1]
+
+
+class ComponentTable(object):
+    """ Struct-of-arrays storage for the Column fields of a component type.
+
+    Each component in the table has a row.  The values of its columns are
+    stored in contiguous numpy arrays, one per column, which systems can
+    process in bulk.  A component keeps its row until a component is removed
+    from the table, at which point the last row is moved into the hole; the
+    'version' is incremented whenever this happens so that anything caching
+    row indices knows to refresh them. """
+
+    def __init__(self, component_type, capacity=64):
+        """ Constructor. """
+        self.component_type = component_type
+        self.fields = ComponentTable.get_columns(component_type)
+        self.count = 0
+        self.version = 0
+        self.components = []
+        self.arrays = {}
+        for column in self.fields:
+            self.arrays[column.name] = numpy.zeros(
+                (capacity,) + column.shape(),
+                dtype=column.dtype
+            )
+
+    @staticmethod
+    def get_columns(component_type):
+        """ Get the Column fields declared by a component type. """
+        columns = {}
+        for klass in reversed(component_type.__mro__):
+            for value in klass.__dict__.values():
+                if isinstance(value, Column):
+                    columns[value.name] = value
+        return sorted(columns.values(), key=lambda c: c.name)
+
+    def column(self, name):
+        """ Get the values of a column for all of the rows in use.  This is a
+        view onto the table, so writes to it update the components. """
+        return self.arrays[name][:self.count]
+
+    def add(self, component):
+        """ Move a component's column values into the table. """
+        if self.count == len(self.arrays[self.fields[0].name]):
+            self.__grow()
+        row = self.count
+        for column in self.fields:
+            column.write(self.arrays[column.name], row,
+                         component.__dict__.pop(column.name))
+        component._table = self
+        component._row = row
+        self.components.append(component)
+        self.count += 1
+
+    def remove(self, component):
+        """ Move a component's column values back into the component and
+        remove its row. """
+        row = component._row
+        for column in self.fields:
+            component.__dict__[column.name] = column.read(self.arrays[column.name], row)
+        component._table = None
+        component._row = None
+
+        # Fill the hole with the last row.
+        last = self.count - 1
+        if row != last:
+            moved = self.components[last]
+            for column in self.fields:
+                array = self.arrays[column.name]
+                array[row] = array[last]
+            self.components[row] = moved
+            moved._row = row
+        self.components.pop()
+        self.count -= 1
+        self.version += 1
+
+    def clear(self):
+        """ Remove all of the components from the table. """
+        while self.count > 0:
+            self.remove(self.components[-1])
+
+    def __grow(self):
+        """ Double the capacity of the table. """
+        for column in self.fields:
+            array = self.arrays[column.name]
+            grown = numpy.zeros((len(array)*2,) + column.shape(), dtype=column.dtype)
+            grown[:len(array)] = array
+            self.arrays[column.name] = grown
+
+
+class QueryView(object):
+    """ A live view of the existing entities having a set of component types.
+
+    The entity manager keeps views up to date as components are added and
+    removed and entities are created and destroyed, so reading a view doesn't
+    involve any query work.  Observers can subscribe to be told when entities
+    enter or exit the view. """
+
+    def __init__(self, types):
+        """ Constructor. """
+        self.types = types
+        self.__entities = []
+        self.__indices = {}
+        self.__snapshot = None
+        self.__subscribers = []
+
+    def entities(self):
+        """ Get the entities in the view.  The returned sequence isn't
+        affected by subsequent changes to the view. """
+        if self.__snapshot is None:
+            self.__snapshot = tuple(self.__entities)
+        return self.__snapshot
+
+    def subscribe(self, on_enter=None, on_exit=None):
+        """ Register functions to be called with entities entering and
+        exiting the view. """
+        self.__subscribers.append((on_enter, on_exit))
+
+    def matches(self, signature):
+        """ Would an entity with the given component types be in the view? """
+        for t in self.types:
+            if not t in signature:
+                return False
+        return True
+
+    def add(self, entity):
+        """ Add an entity to the view. """
+        self.__indices[entity] = len(self.__entities)
+        self.__entities.append(entity)
+        self.__snapshot = None
+        for (on_enter, on_exit) in self.__subscribers:
+            if on_enter is not None:
+                on_enter(entity)
+
+    def remove(self, entity):
+        """ Remove an entity from the view. """
+        index = self.__indices.pop(entity)
+        last = self.__entities.pop()
+        if last is not entity:
+            self.__entities[index] = last
+            self.__indices[last] = index
+        self.__snapshot = None
+        for (on_enter, on_exit) in self.__subscribers:
+            if on_exit is not None:
+                on_exit(entity)
+
+    def clear(self):
+        """ Empty the view, without notifying subscribers. """
+        self.__entities = []
+        self.__indices = {}
+        self.__snapshot = None
+
+    def __contains__(self, entity):
+        """ Is the entity in the view? """
+        return entity in self.__indices
+
+    def __len__(self):
+        """ Get the number of entities in the view. """
+        return len(self.__entities)
 
 
 class ComponentSystem(object):
     """ Entity processing system.  Can do updates on a set of entities with
     a given set of components. """
 
-    def __init__(self, types, priority=0):
-        """ Initialise. """
+    def __init__(self, types, priority=0, reads=None, writes=None):
+        """ Initialise. 'reads' and 'writes' are the component types that
+        the system reads and writes when it is updated.  If they are not given,
+        the system is assumed to conflict with every other system. """
         self.__types = types
         self.__priority = priority
+        self.__reads = frozenset(reads or ())
+        self.__writes = None
+        if writes is not None:
+            self.__writes = frozenset(writes)
         self.__game_services = None
+        self.__view = None
 
     def setup(self, game_services):
         """ Do any initial setup. """
@@ -397,9 +1408,33 @@ class ComponentSystem(object):
     def game_services(self):
         return self.__game_services
 
+    @property
+    def reads(self):
+        """ The component types the system reads when it is updated. """
+        return self.__reads
+
+    @property
+    def writes(self):
+        """ The component types the system writes when it is updated, or
+        None if they haven't been declared. """
+        return self.__writes
+
+    @property
+    def view(self):
+        """ Get the live view of the entities managed by this system. """
+        if self.__view is None:
+            self.__view = self.__game_services.get_entity_manager().query_view(*self.__types)
+        return self.__view
+
     def entities(self):
         """ Get the entities managed by this system. """
-        return self.__game_services.get_entity_manager().query(*self.__types)
+        return self.view.entities()
+
+    def entity_count(self):
+        """ Get the number of entities managed by this system. """
+        if len(self.__types) == 0:
+            return 0
+        return len(self.view)
 
     def update(self, dt):
         """ Update the system. """
@@ -417,6 +1452,11 @@ class ComponentSystem(object):
         """ Called when a component is removed that matches our expression. """
         pass
 
+    def on_load(self):
+        """ Called when the entity manager's state has been loaded. Systems
+        that keep their own indices of components should rebuild them. """
+        pass
+
     @property
     def priority(self):
         """ Priority - determines order of system update() calls. """
@@ -445,6 +1485,11 @@ class Component(object):
         self.__config = config
         self.cache = {}
 
+        # If our Column fields are stored in a ComponentTable, the table and
+        # our row in it.
+        self._table = None
+        self._row = None
+
     @property
     def entity(self):
         """ Get the entity containing this component. """
@@ -464,35 +1509,124 @@ class Component(object):
         ret = self.__dict__.copy()
         assert "cache" in ret
         ret["cache"] = {}
+
+        # Save the values of our columns rather than the table.
+        if self._table is not None:
+            for column in self._table.fields:
+                ret[column.name] = getattr(self, column.name)
+            ret["_table"] = None
+            ret["_row"] = None
         return ret
 
 
+class EntityPrototype(object):
+    """ A config compiled for fast entity creation.
+
+    The component types named in the config are looked up when the prototype
+    is built, rather than every time an entity is created.  The component
+    configs themselves are shared by all the entities created from the
+    prototype, just as they would be if the config was used directly. """
+
+    def __init__(self, config):
+        """ Compile a config. """
+        self.config = config
+        self.name = config.name.title()
+        self.pooled = config.get_or_default("pool", False)
+        self.pool_size = config.get_or_default("pool_size", 256)
+        components = config.get_or_default("components", Config())
+        self.components = tuple(
+            (lookup_type(name), components[name]) for name in components
+        )
+
+
+class EntityHandles(object):
+    """ Generation table for entity handles.
+
+    A handle is an (index, generation) pair.  Each entity is allocated a slot
+    in the table.  The generation of the slot is advanced when the entity dies
+    or loses a component, and the slot is reused once the entity has been
+    garbage collected.  A handle is valid for as long as the generation of its
+    slot is unchanged, which can be checked in constant time. """
+
+    def __init__(self):
+        """ Constructor. """
+        self.generations = []
+        self.entities = []
+        self.__free = []
+
+    def allocate(self, entity):
+        """ Allocate a slot for an entity and return its handle. """
+        if len(self.__free) > 0:
+            index = self.__free.pop()
+            self.entities[index] = entity
+        else:
+            index = len(self.generations)
+            self.generations.append(0)
+            self.entities.append(entity)
+        return (index, self.generations[index])
+
+    def advance(self, index):
+        """ Invalidate the handles to a slot, and return the new handle. """
+        self.generations[index] += 1
+        return (index, self.generations[index])
+
+    def release(self, index):
+        """ Invalidate the handles to a slot and free it for reuse. """
+        self.generations[index] += 1
+        self.entities[index] = None
+        self.__free.append(index)
+
+    def is_valid(self, handle):
+        """ Is the handle still valid? """
+        return self.generations[handle[0]] == handle[1]
+
+    def lookup(self, handle):
+        """ Get the entity for a handle, or None if it is no longer valid. """
+        if self.generations[handle[0]] == handle[1]:
+            return self.entities[handle[0]]
+        return None
+
+
 class EntityRef(object):
-    """ A reference to an entity that resets itself when the entity is killed. """
+    """ A reference to an entity that resets itself when the entity is killed.
+
+    The reference remembers the handle of the entity from the last time it
+    checked that the entity was alive and had the right components.  While
+    that handle is valid, there is no need to check again. """
 
     def __init__(self, entity, *types):
         """ Construct a reference. """
         self.__entity = entity
         self.__types = types
+        self.__handle = None
 
     @property
     def entity(self):
         """ The wrapped entity.  It will only not be None if it has the right
         components and isnt dead. """
-        if self.__entity:
-            if self.__entity.is_garbage:
+        entity = self.__entity
+        if entity is not None:
+            handle = self.__handle
+            if handle is not None and \
+               entity.handles.generations[handle[0]] == handle[1]:
+                return entity
+            self.__handle = None
+            if entity.is_garbage:
                 self.__entity = None
             else:
                 for t in self.__types:
-                    if not self.__entity.has_component(t):
+                    if not entity.has_component(t):
                         self.__entity = None
                         break
+                else:
+                    self.__handle = entity.handle
         return self.__entity
 
     @entity.setter
     def entity(self, entity):
         """ Set the wrapped entity. """
         self.__entity = entity
+        self.__handle = None
 
 
 class EntityRefList(object):
@@ -524,8 +1658,12 @@ class EntityRefList(object):
             yield item.entity
 
     def __garbage_collect(self):
-        """ Remove all dead references. """
-        self.__list = [ref for ref in self.__list if ref.entity is not None]
+        """ Remove all dead references.  The list is only rebuilt if there
+        are any. """
+        for ref in self.__list:
+            if ref.entity is None:
+                self.__list = [ref for ref in self.__list if ref.entity is not None]
+                return
 
     def kill_all(self):
         """ Kill all entities in the list. """
@@ -556,6 +1694,14 @@ class Entity(object):
         self.id = 0
         self.name = ""
 
+        # Our handle, and the table it is valid in.  These are set by the
+        # entity manager.
+        self.handle = None
+        self.handles = None
+
+        # The prototype we were created from, if any.
+        self.prototype = None
+
     @property
     def is_garbage(self):
         """ Is this entity scheduled for deletion? """
@@ -572,7 +1718,9 @@ class Entity(object):
 
     def kill(self):
         """ Mark the object for deletion. """
-        self.__is_garbage = True
+        if not self.__is_garbage:
+            self.__is_garbage = True
+            self.ecs().on_entity_killed(self)
 
     def add_component(self, component):
         """ Shortcut to add a component. """
@@ -597,4 +1745,7 @@ class Entity(object):
         field_name = "_Entity__game_services"
         assert field_name in ret
         ret[field_name] = None
+
+        # Prototypes aren't saved, so loaded entities won't be pooled.
+        ret["prototype"] = None
         return ret
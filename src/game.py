@@ -119,7 +119,16 @@ class Game(object):
         self.wave_spawner = None
 
         # Create the entity manager.
-        self.entity_manager = ecs.EntityManager(self.game_services)
+        self.entity_manager = ecs.EntityManager(
+            self.game_services,
+            columnar=self.config.get_or_default("columnar_components", False)
+        )
+        self.entity_manager.set_instrumented(
+            self.config.get_or_default("instrumentation", False)
+        )
+        self.entity_manager.set_system_threads(
+            self.config.get_or_default("system_threads", 0)
+        )
 
         # Configure the resource loader.
         self.resource_loader.set_minimise_image_loading(
@@ -163,7 +172,9 @@ class Game(object):
         self.renderer.initialise()
 
         # Create the game systems.
-        self.entity_manager.register_component_system(physics.Physics())
+        self.entity_manager.register_component_system(physics.Physics(self.config))
+        self.entity_manager.register_component_system(systems.AssemblySystem())
+        self.entity_manager.register_component_system(systems.TeamSystem())
         self.entity_manager.register_component_system(systems.FollowsTrackedSystem())
         self.entity_manager.register_component_system(systems.TrackingSystem())
         self.entity_manager.register_component_system(systems.LaunchesFightersSystem())
@@ -173,11 +184,18 @@ class Game(object):
         self.entity_manager.register_component_system(systems.TextSystem())
         self.entity_manager.register_component_system(systems.AnimSystem())
         self.entity_manager.register_component_system(systems.ThrusterSystem())
-        self.entity_manager.register_component_system(systems.ThrustersSystem())
+        self.entity_manager.register_component_system(systems.ThrustersSystem(
+            self.config.get_or_default("thruster_cache", None)
+        ))
         self.entity_manager.register_component_system(systems.CameraSystem())
-        self.entity_manager.register_component_system(systems.TurretSystem())
+        self.entity_manager.register_component_system(systems.TurretSystem(
+            self.config.get_or_default("turret_line_of_sight_frames", 10),
+            self.config.get_or_default("turret_line_of_sight_tolerance", 5),
+            self.config.get_or_default("turret_line_of_sight_angle", 5)
+        ))
         self.entity_manager.register_component_system(systems.TurretsSystem())
         self.entity_manager.register_component_system(systems.WeaponSystem())
+        self.entity_manager.register_component_system(systems.ProjectileSystem())
         self.entity_manager.register_component_system(systems.SolarSystem())
         self.entity_manager.register_component_system(systems.PlayerSystem())
         
@@ -226,6 +244,11 @@ class Game(object):
             DamageCollisionHandler()
         )
 
+        # Make it so that things on the same team don't collide.
+        self.entity_manager.get_system(physics.Physics).set_collision_group_function(
+            systems.get_collision_group
+        )
+
         # Set the scrolling background.
         self.drawing.set_background("res/images/857-tileable-classic-nebula-space-patterns/6.jpg")
 
@@ -301,6 +324,19 @@ class Game(object):
             self.game_services.info.update_framerate(limited_fps,
                                                      raw_fps,
                                                      time_ratio)
+            self.game_services.info.update_pool_stats(
+                "Entities", self.entity_manager.pool_stats)
+            self.game_services.info.update_pool_stats(
+                "Bodies", self.entity_manager.get_system(physics.Physics).pool_stats)
+            self.game_services.info.update_cache_stats(
+                "Line of sight",
+                self.entity_manager.get_system(systems.TurretSystem).line_of_sight_stats)
+
+        # Write out the system measurements if requested.
+        instrumentation = self.entity_manager.instrumentation
+        instrumentation_file = self.config.get_or_default("instrumentation_file", "")
+        if instrumentation is not None and instrumentation_file:
+            instrumentation.export(instrumentation_file)
 
         # Finalise
         self.nkpygame.teardown()
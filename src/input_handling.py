@@ -423,10 +423,16 @@ class GUIElementDebugInfo(GUIElement):
             return ret
 
         game_info = self.game_services.get_info()
+        entity_manager = self.game_services.get_entity_manager()
 
         average_fps = sum(game_info.framerates) / (len(game_info.framerates)+1)
 
-        rect = pynk.lib.nk_rect(10, 60, 200, 260)
+        # Show the most expensive systems, if they are being measured.
+        breakdown = []
+        if entity_manager.instrumentation is not None:
+            breakdown = entity_manager.instrumentation.breakdown()
+
+        rect = pynk.lib.nk_rect(10, 60, 200, 350 + 30*(len(breakdown) + len(game_info.cache_stats)))
         wflags = pynk.lib.NK_WINDOW_MOVABLE | pynk.lib.NK_WINDOW_TITLE
         if pynk.lib.nk_begin(nkpygame.ctx, "Debug Info", rect, wflags):
             pynk.lib.nk_layout_row_dynamic(nkpygame.ctx, 0, 2)
@@ -436,6 +442,19 @@ class GUIElementDebugInfo(GUIElement):
             pynk.lib.nk_label(nkpygame.ctx, "%.2f" % game_info.framerate, pynk.lib.NK_TEXT_RIGHT)
             pynk.lib.nk_label(nkpygame.ctx, "FPS (raw)", pynk.lib.NK_TEXT_LEFT)
             pynk.lib.nk_label(nkpygame.ctx, "%.2f" % game_info.raw_framerate, pynk.lib.NK_TEXT_RIGHT)
+            pynk.lib.nk_label(nkpygame.ctx, "Notifications", pynk.lib.NK_TEXT_LEFT)
+            pynk.lib.nk_label(nkpygame.ctx, "%d" % entity_manager.last_frame_notifications, pynk.lib.NK_TEXT_RIGHT)
+            for name in sorted(game_info.pool_stats):
+                stats = game_info.pool_stats[name]
+                pynk.lib.nk_label(nkpygame.ctx, "Pool (%s)" % name, pynk.lib.NK_TEXT_LEFT)
+                pynk.lib.nk_label(nkpygame.ctx, "%d%% / %d" % (stats.hit_rate*100, stats.peak_size), pynk.lib.NK_TEXT_RIGHT)
+            for name in sorted(game_info.cache_stats):
+                stats = game_info.cache_stats[name]
+                pynk.lib.nk_label(nkpygame.ctx, "Cache (%s)" % name, pynk.lib.NK_TEXT_LEFT)
+                pynk.lib.nk_label(nkpygame.ctx, "%d / %d" % (stats.hits, stats.misses), pynk.lib.NK_TEXT_RIGHT)
+            for (name, time, entities) in breakdown:
+                pynk.lib.nk_label(nkpygame.ctx, name, pynk.lib.NK_TEXT_LEFT)
+                pynk.lib.nk_label(nkpygame.ctx, "%.2fms / %d" % (time*1000, entities), pynk.lib.NK_TEXT_RIGHT)
             pynk.lib.nk_layout_row_dynamic(nkpygame.ctx, 100, 1)
             pynk.lib.nk_chart_begin(nkpygame.ctx, pynk.lib.NK_CHART_LINES, len(game_info.framerates), 0, 60)
             for value in game_info.framerates:
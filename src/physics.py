@@ -6,15 +6,74 @@ mapping between objects in a pymunk physics simulation and the logical
 components attached to entities (which are what get serialised.) The relevant
 data is copied back and forth between the simulation and the game state
 periodically to keep them in sync.
+
+If Body components are stored in a table, the sync is done in bulk.  Columns of
+the table are compared with a snapshot taken at the end of the last update, so
+that only the bodies that have been changed by the game are copied into the
+simulation.  Simulation state is copied back a column at a time.
+
+The Physics system also maintains a spatial index of the bodies, which is
+updated as the simulation state is copied back.  It can be used to find the
+bodies near a point, or in a region.
+
+A body with a RigidAttachment to another body doesn't get a simulation body of
+its own.  Instead its shape is added to the other body's simulation body, so
+the solver treats the pair as one rigid object, and the attached body's
+position and velocity are worked out from the other body's when the simulation
+state is copied back.  Contacts with the shape are still reported for the
+attached entity.
+
+Collisions are filtered inside pymunk as far as possible.  Each shape is given
+a pymunk collision type for the set of component types that the logical
+collision handlers are interested in, and pymunk handlers are only registered
+for the pairs of collision types that some logical handler matches, so the
+game only hears about contacts it will do something with.  If several logical
+handlers match a pair, they are tried in turn until one handles the contact.
+Shapes are also given a ShapeFilter: bodies on the same team share a group and
+so never collide, bullets do not collide with each other, and non-collideable
+bodies collide with nothing (but can still be found by queries.)  A shape is
+configured again when its entity gains or loses a handled component type, or
+when it is passed to reconfigure() (e.g. because its team has changed.)
+
+The pymunk space is configured from the game config: see base_config.txt.
+Its spatial index is a bounding box tree unless a spatial hash cell size is
+given, or 'auto', in which case one is chosen from a histogram of the sizes of
+the bodies when there first are some (unless they vary too much in size for a
+spatial hash to suit them.)  Bodies that have been idle for a while can sleep.
+A sleeping body is only written to when its Body component has been changed,
+or has had forces applied, so that it is woken by the game interacting with it
+and not by the sync.
+
+Hit scans (ray casts) can be done in batches, with hit_scan_batch(): the rays
+are transformed to world coordinates together, filtered by collision group
+inside pymunk, and the results are returned as numpy arrays.
 """
 
 
-from .ecs import ComponentSystem, Component
+from .ecs import ComponentSystem, Component, PoolStats
+from .config import Config
 from .utils import Vec2d
-from .components import Body, Joint
+from .components import Body, Joint, RigidAttachment
 
 import pymunk
+import heapq
 import math
+import numpy
+
+
+# Collision categories.  Queries use the default ShapeFilter, which matches all
+# categories, so every shape includes the QUERY category in its mask.
+CATEGORY_DEFAULT = 0x1
+CATEGORY_BULLET = 0x2
+CATEGORY_NON_COLLIDEABLE = 0x4
+CATEGORY_QUERY = 0x8
+
+# The (categories, mask) for each value of Body.collision_category.
+COLLISION_CATEGORIES = {
+    "default": (CATEGORY_DEFAULT, pymunk.ShapeFilter.ALL_MASKS),
+    "bullet": (CATEGORY_BULLET,
+               pymunk.ShapeFilter.ALL_MASKS & ~CATEGORY_BULLET),
+}
 
 
 class Physics(ComponentSystem):
@@ -31,31 +90,52 @@ class Physics(ComponentSystem):
         an update, while the updated simulation will be copied back to the
         components at the end of each update(). """
 
-        def __init__(self, body_component):
-            """ Constructor. """
+        def __init__(self, body_component, parent=None):
+            """ Constructor. If a parent is given, then the body is rigidly
+            attached to it: the parent's simulation body is shared, and only
+            a shape is added for this body. """
 
             self.entity = body_component.entity
 
-            # Moment of inertia.
-            moment = pymunk.moment_for_circle(
-                float(body_component.mass),
-                0,
-                float(body_component.size)
-            )
+            # The body we are attached to, and the bodies attached to us.
+            self.parent = parent
+            self.children = []
 
-            # Initialise body and shape.
-            body_type = pymunk.Body.DYNAMIC
-            if body_component.kinematic:
-                body_type = pymunk.Body.KINEMATIC
-            self.body = pymunk.Body(float(body_component.mass), moment, body_type)
-            self.shape = pymunk.Circle(self.body, float(body_component.size))
-            self.shape.friction = 0.8
+            if parent is None:
+
+                # Moment of inertia.
+                moment = pymunk.moment_for_circle(
+                    float(body_component.mass),
+                    0,
+                    float(body_component.size)
+                )
+
+                # Initialise body and shape.
+                body_type = pymunk.Body.DYNAMIC
+                if body_component.kinematic:
+                    body_type = pymunk.Body.KINEMATIC
+                self.body = pymunk.Body(float(body_component.mass), moment, body_type)
+                self.offset = Vec2d(0, 0)
 
-            # Collision type for non-collidable bodies.
-            if body_component.is_collideable:
-                self.shape.collision_type = 1
             else:
-                self.shape.collision_type = 0
+
+                # Share the parent's body, and put our shape where we are
+                # attached.  Note that our mass isn't added to the parent's.
+                attachment = self.entity.get_component(RigidAttachment)
+                self.body = parent.body
+                self.offset = Vec2d(attachment.position)
+                parent.children.append(self)
+
+            self.shape = pymunk.Circle(self.body, float(body_component.size),
+                                       self.offset)
+            self.shape.friction = 0.8
+
+            # Collision filtering: see set_collision(). Until then, the shape
+            # collides with everything and has no collision handlers.
+            self.is_collideable = True
+            self.group = 0
+            self.categories = None
+            self.mask = None
 
             # Squirell ourself away inside the shape, so we can map back
             # later. Note that we're modifying the shape with a new field on
@@ -64,54 +144,213 @@ class Physics(ComponentSystem):
             # pymunk.Shape and extend it, just without all the code...
             self.shape.game_body = self
 
-        def copy_from_component(self):
-            """ Copy body data from components to simulation. """
-            body_component = self.entity.get_component(Body)
+            # Bodies can only be reused for bodies with the same key.
+            self.key = Physics.PymunkBody.key_for(body_component)
+
+            # Our row in the Body table when it was last synced, or -1.
+            self.row = -1
+
+            # The state last copied to the body component, if it was copied
+            # individually.  See copy_from_component().
+            self.synced_state = None
+
+        @staticmethod
+        def key_for(body_component):
+            """ Get the properties that a body must match for this simulation
+            body to be reused for it. """
+            return (float(body_component.mass),
+                    float(body_component.size),
+                    body_component.kinematic)
+
+        def reuse(self, body_component):
+            """ Reuse the simulation body for another body component. The
+            rest of the state is copied from the component on the next
+            update. """
+            self.entity = body_component.entity
+            self.body.force = (0, 0)
+            self.body.torque = 0
+            self.row = -1
+            self.synced_state = None
+
+        def set_collision(self, collision_type, group, categories, mask,
+                          is_collideable):
+            """ Set the pymunk collision type and the collision filter. Setting
+            them wakes the body, so they are left alone if they haven't
+            changed. """
+            if self.shape.collision_type == collision_type and \
+               self.group == group and self.categories == categories and \
+               self.mask == mask:
+                self.set_collideable(is_collideable)
+                return
+            self.shape.collision_type = collision_type
+            self.group = group
+            self.categories = categories
+            self.mask = mask
+            self.is_collideable = None
+            self.set_collideable(is_collideable)
+
+        def set_collideable(self, is_collideable):
+            """ Make the shape collide with nothing, or restore its filter. """
+            if is_collideable == self.is_collideable:
+                return
+            self.is_collideable = is_collideable
+            if is_collideable:
+                self.shape.filter = pymunk.ShapeFilter(
+                    self.group, self.categories, self.mask)
+            else:
+                self.shape.filter = pymunk.ShapeFilter(
+                    self.group, CATEGORY_NON_COLLIDEABLE, CATEGORY_QUERY)
+
+        @property
+        def position(self):
+            """ The position of the body in the simulation. """
+            if self.parent is None:
+                return self.body.position
+            return self.body.local_to_world(self.offset)
+
+        def attached_state(self, body_component):
+            """ Get the row of the Body table for an attached body: see
+            PymunkBodyMapping.copy_to_table(). The position and velocity
+            follow the parent, the rest is the component's own. """
+            position = self.position
+            velocity = self.body.velocity_at_local_point(self.offset)
+            return (position.x, position.y, velocity.x, velocity.y,
+                    math.radians(body_component.orientation),
+                    math.radians(body_component.angular_velocity),
+                    body_component.mass, self.shape.radius,
+                    self.is_collideable)
+
+        @staticmethod
+        def synced_state_of(body_component):
+            """ Get the state of a body component that is copied into the
+            simulation.  The vectors are copied, since they can be changed in
+            place (e.g. with +=). """
+            return (tuple(body_component.position),
+                    tuple(body_component.velocity),
+                    body_component.orientation, body_component.angular_velocity,
+                    body_component.mass, body_component.is_collideable)
+
+        def copy_from_component(self, body_component=None):
+            """ Copy body data from components to simulation. Writing to a
+            body wakes it (and keeps it from falling asleep), so a body is
+            left alone unless the component has changed since it was last
+            copied back. """
+            if body_component is None:
+                body_component = self.entity.get_component(Body)
             pymunk_body = self
+
+            if pymunk_body.parent is None and \
+               body_component.torque == 0 and \
+               body_component.force == Vec2d(0, 0) and \
+               Physics.PymunkBody.synced_state_of(body_component) == \
+                   pymunk_body.synced_state:
+                return
+
+            # An attached body is moved by its parent, but it can still push
+            # the parent around.
+            if pymunk_body.parent is not None:
+                pymunk_body.set_collideable(bool(body_component.is_collideable))
+                pymunk_body.apply_force(body_component, pymunk_body.offset)
+                return
+
             pymunk_body.body.position = body_component.position
             pymunk_body.body.velocity = body_component.velocity
             #pymunk_body.shape.radius = body_component.size
             if not body_component.kinematic:
                 pymunk_body.body.mass = body_component.mass
-            if body_component.is_collideable:
-                pymunk_body.shape.collision_type = 1
-            else:
-                pymunk_body.shape.collision_type = 0
+            pymunk_body.set_collideable(bool(body_component.is_collideable))
             pymunk_body.body.angle = math.radians(
                 body_component.orientation)
             pymunk_body.body.angular_velocity = math.radians(
                 body_component.angular_velocity)
-            for (force, local_point) in body_component.impulses:
-                pymunk_body.body.apply_force_at_local_point(force, local_point)
+            pymunk_body.apply_force(body_component, (0, 0))
+
+        def apply_force(self, body_component, local_point):
+            """ Apply the net force and torque accumulated by a body
+            component, with the force acting at a local point. """
+            force = body_component.force
+            torque = body_component.torque
+            if force.x != 0 or force.y != 0:
+                self.body.apply_force_at_local_point(force, local_point)
+            if torque != 0:
+                self.body.torque += torque
 
         def copy_to_component(self):
             """ Copy simulation state back to components """
             body_component = self.entity.get_component(Body)
             pymunk_body = self
+
+            # An attached body keeps its own orientation and mass.
+            if pymunk_body.parent is not None:
+                body_component.position = pymunk_body.position
+                body_component.velocity = \
+                    pymunk_body.body.velocity_at_local_point(pymunk_body.offset)
+                body_component.size = pymunk_body.shape.radius
+                body_component.is_collideable = pymunk_body.is_collideable
+                body_component.force = Vec2d(0, 0)
+                body_component.torque = 0
+                return
+
             body_component.position = pymunk_body.body.position
             body_component.velocity = pymunk_body.body.velocity
             body_component.size = pymunk_body.shape.radius
             body_component.mass = pymunk_body.body.mass
-            body_component.is_collideable = pymunk_body.shape.collision_type == 1
+            body_component.is_collideable = pymunk_body.is_collideable
             body_component.orientation = math.degrees(
                 pymunk_body.body.angle)
             body_component.angular_velocity = math.degrees(
                 pymunk_body.body.angular_velocity)
-            body_component.impulses = []
+            body_component.force = Vec2d(0, 0)
+            body_component.torque = 0
+            pymunk_body.synced_state = \
+                Physics.PymunkBody.synced_state_of(body_component)
 
     class PymunkBodyMapping(object):
         """ Manages the mapping between Body components and simulation 
         objects. """
 
-        def __init__(self, space):
-            """ Constructor. """
+        # Columns of the Body table that are copied into the simulation.
+        SYNCED_COLUMNS = ("position", "velocity", "orientation",
+                          "angular_velocity", "mass", "is_collideable")
+
+        def __init__(self, space, index, configure):
+            """ Constructor. 'configure' is called with each simulation body
+            and its body component before the body is added to the space. """
             self.__mapping = {}
             self.__space = space
+            self.__index = index
+            self.__configure = configure
+
+            # Simulation bodies of dead pooled entities, by key.
+            self.__pool = {}
+            self.pool_stats = PoolStats()
+
+            # Incremented whenever simulation bodies are added or removed.
+            self.__version = 0
+
+            # State for syncing with a Body table: the layout of the table
+            # when we last looked at it, the simulation body for each row,
+            # the rows that have simulation bodies, rows that are new since
+            # the last sync, and a snapshot of the synced columns.
+            self.__layout = None
+            self.__row_bodies = []
+            self.__rows = numpy.zeros(0, int)
+            self.__new_rows = numpy.zeros(0, int)
+            self.__snapshot = {}
 
         def __getitem__(self, item):
             """ Look up a pymunk body from an entity. """
             return self.__mapping[item]
 
+        def __contains__(self, item):
+            """ Does an entity have a pymunk body? """
+            return item in self.__mapping
+
+        def sizes(self):
+            """ Get the sizes (radii) of the simulation bodies. """
+            return [pymunk_body.shape.radius
+                    for pymunk_body in self.__mapping.values()]
+
         def update(self, entities):
             """ Update the mapping, creating new simulation bodies where needed
             and deleting ones that we are done with. """
@@ -120,22 +359,93 @@ class Physics(ComponentSystem):
             # object. We remove entities where we see them, and create
             # simulation objects where necessary.
             to_remove = set(self.__mapping.keys())
+            to_add = []
             for e in entities:
                 if e in to_remove:
                     to_remove.remove(e)
                 else:
-                    body = e.get_component(Body)
-                    assert body
-                    pymunk_body = Physics.PymunkBody(body)
-                    self.__mapping[e] = pymunk_body
-                    self.__space.add(pymunk_body.body, pymunk_body.shape)
+                    to_add.append(e)
+
+            # Bodies attached to a body that is going away are detached, and
+            # get simulation bodies of their own.
+            for e in list(to_remove):
+                for child in self.__mapping[e].children:
+                    if not child.entity in to_remove:
+                        to_remove.add(child.entity)
+                        to_add.append(child.entity)
 
             # Now, the set contains all of the entities that had simulation
-            # bodies but shouldn't any more.
-            for e in to_remove:
+            # bodies but shouldn't any more. Attached shapes are removed
+            # before the bodies they are attached to.
+            for e in sorted(to_remove, key=lambda e: self.__mapping[e].parent is None):
                 pymunk_body = self.__mapping[e]
-                self.__space.remove(pymunk_body.body, pymunk_body.shape)
                 del self.__mapping[e]
+                self.__index.remove(e)
+                self.__version += 1
+                if pymunk_body.parent is not None:
+                    self.__space.remove(pymunk_body.shape)
+                    pymunk_body.parent.children.remove(pymunk_body)
+                    continue
+                self.__space.remove(pymunk_body.body, pymunk_body.shape)
+                if e.prototype is not None and e.prototype.pooled:
+                    pool = self.__pool.setdefault(pymunk_body.key, [])
+                    if len(pool) < e.prototype.pool_size:
+                        pool.append(pymunk_body)
+                        self.pool_stats.resize(1)
+
+            # Create the new simulation bodies, and then the shapes that are
+            # attached to them. Bodies can't be attached to attached bodies.
+            attached = []
+            for e in to_add:
+                body = e.get_component(Body)
+                assert body
+                attachment = e.get_component(RigidAttachment)
+                if attachment is not None and attachment.parent.entity is not None:
+                    attached.append((e, body, attachment.parent.entity))
+                else:
+                    self.__add(e, body, None)
+            for (e, body, parent_entity) in attached:
+                parent = self.__mapping.get(parent_entity)
+                if parent is not None and parent.parent is not None:
+                    parent = None
+                self.__add(e, body, parent)
+
+        def __add(self, entity, body, parent):
+            """ Make a simulation body for a body component and add it to the
+            simulation. """
+            if parent is None:
+                pymunk_body = self.__allocate(body)
+            else:
+                pymunk_body = Physics.PymunkBody(body, parent)
+            self.__configure(pymunk_body, body)
+            self.__mapping[entity] = pymunk_body
+            if parent is None:
+                self.__space.add(pymunk_body.body, pymunk_body.shape)
+            else:
+                self.__space.add(pymunk_body.shape)
+            self.__version += 1
+
+        def __allocate(self, body):
+            """ Make a simulation body for a body component, reusing one from
+            the pool if the entity is pooled. """
+            prototype = body.entity.prototype
+            if prototype is None or not prototype.pooled:
+                return Physics.PymunkBody(body)
+            pool = self.__pool.get(Physics.PymunkBody.key_for(body))
+            if not pool:
+                self.pool_stats.misses += 1
+                return Physics.PymunkBody(body)
+            self.pool_stats.hits += 1
+            self.pool_stats.resize(-1)
+            pymunk_body = pool.pop()
+            pymunk_body.reuse(body)
+            return pymunk_body
+
+        def reconfigure(self):
+            """ Configure all of the existing simulation bodies again. """
+            for entity in self.__mapping:
+                self.__configure(self.__mapping[entity],
+                                 entity.get_component(Body))
 
         def copy_from_components(self):
             """ Copy body data from components to simulation. """
@@ -144,8 +454,113 @@ class Physics(ComponentSystem):
 
         def copy_to_components(self):
             """ Copy simulation state back to components """
-            for entity in self.__mapping:
-                self.__mapping[entity].copy_to_component()
+            entities = list(self.__mapping.keys())
+            positions = []
+            for entity in entities:
+                pymunk_body = self.__mapping[entity]
+                pymunk_body.copy_to_component()
+                position = pymunk_body.position
+                positions.append((position.x, position.y))
+            self.__index.update_many(entities, positions)
+
+        def copy_from_table(self, table):
+            """ Copy body data from a Body table to the simulation.  Only rows
+            that differ from the snapshot, are new, or have had forces applied
+            are copied. """
+            self.__update_layout(table)
+            dirty = numpy.zeros(table.count, bool)
+            dirty[self.__new_rows] = True
+            for name in self.SYNCED_COLUMNS:
+                changed = table.column(name) != self.__snapshot[name]
+                if changed.ndim > 1:
+                    changed = changed.any(axis=1)
+                dirty |= changed
+            dirty |= table.column("force").any(axis=1)
+            dirty |= table.column("torque") != 0
+            row_bodies = self.__row_bodies
+            components = table.components
+            for row in numpy.flatnonzero(dirty):
+                pymunk_body = row_bodies[row]
+                if pymunk_body is not None:
+                    pymunk_body.copy_from_component(components[row])
+
+        def copy_to_table(self, table):
+            """ Copy simulation state back to a Body table, and snapshot the
+            result. """
+            self.__update_layout(table)
+            rows = self.__rows
+            row_bodies = self.__row_bodies
+            components = table.components
+            state = []
+            for row in rows:
+                pymunk_body = row_bodies[row]
+                if pymunk_body.parent is not None:
+                    state.append(pymunk_body.attached_state(components[row]))
+                    continue
+                body = pymunk_body.body
+                position = body.position
+                velocity = body.velocity
+                state.append((position.x, position.y, velocity.x, velocity.y,
+                              body.angle, body.angular_velocity, body.mass,
+                              pymunk_body.shape.radius,
+                              pymunk_body.is_collideable))
+            state = numpy.array(state, float).reshape(len(rows), 9)
+            arrays = table.arrays
+            arrays["position"][rows] = state[:, 0:2]
+            arrays["velocity"][rows] = state[:, 2:4]
+            arrays["orientation"][rows] = numpy.degrees(state[:, 4])
+            arrays["angular_velocity"][rows] = numpy.degrees(state[:, 5])
+            arrays["mass"][rows] = state[:, 6]
+            arrays["size"][rows] = state[:, 7]
+            arrays["is_collideable"][rows] = state[:, 8] != 0
+            table.column("force")[:] = 0
+            table.column("torque")[:] = 0
+            for name in self.SYNCED_COLUMNS:
+                self.__snapshot[name] = table.column(name).copy()
+            self.__new_rows = numpy.zeros(0, int)
+            self.__index.update_many(
+                [row_bodies[row].entity for row in rows], state[:, 0:2])
+
+        def __update_layout(self, table):
+            """ Work out which simulation body goes with each row of the
+            table, if the table or the bodies have changed since we last
+            looked. The snapshot is rearranged to match. """
+            layout = (table, table.version, table.count, self.__version)
+            if layout == self.__layout:
+                return
+            same_table = self.__layout is not None and self.__layout[0] is table
+            self.__layout = layout
+
+            # Find the body for each row, and the row it was in before.
+            count = table.count
+            row_bodies = [None] * count
+            rows = []
+            old_rows = []
+            mapping = self.__mapping
+            components = table.components
+            for row in range(count):
+                pymunk_body = mapping.get(components[row].entity)
+                if pymunk_body is not None:
+                    row_bodies[row] = pymunk_body
+                    rows.append(row)
+                    old_rows.append(pymunk_body.row if same_table else -1)
+                    pymunk_body.row = row
+            rows = numpy.array(rows, int)
+            old_rows = numpy.array(old_rows, int)
+
+            # Move the snapshot values to the new rows.  Rows without an old
+            # value are new, and must be copied in full.
+            kept = old_rows >= 0
+            for name in self.SYNCED_COLUMNS:
+                column = table.column(name)
+                snapshot = numpy.zeros_like(column)
+                old_snapshot = self.__snapshot.get(name)
+                if old_snapshot is not None:
+                    snapshot[rows[kept]] = old_snapshot[old_rows[kept]]
+                self.__snapshot[name] = snapshot
+            self.__row_bodies = row_bodies
+            self.__rows = rows
+            self.__new_rows = numpy.concatenate((self.__new_rows, rows[~kept]))
 
     class PymunkJointMapping(object):
         """ Manages the mapping between Joint components and physical joints
@@ -162,13 +577,15 @@ class Physics(ComponentSystem):
 
             # If a joint no longer has correspond entities, then delete the
             # joint.
+            live_entities = []
             for e in entities:
                 joint = e.get_component(Joint)
                 if joint.entity_a.entity is None or \
                                 joint.entity_b.entity is None:
                     e.kill()
-                    entities.remove(e)
                     continue
+                live_entities.append(e)
+            entities = live_entities
 
             # Create simulation joints.
             to_remove = set(self.__mapping.keys())
@@ -195,52 +612,189 @@ class Physics(ComponentSystem):
                 self.__space.remove(joint)
                 del self.__mapping[e]
 
-    def __init__(self):
-        """ Initialise physics. """
+    def __init__(self, config=None):
+        """ Initialise physics. The space is configured from the 'physics_'
+        settings in the config, if one is given. """
         ComponentSystem.__init__(self, [Body])
+        if config is None:
+            config = Config()
 
         # List of collision handlers. These operate in terms of types of
-        # entity. We implement them using a pymunk collision handler.
+        # component, and the set of component types they are interested in.
         self.__collision_handlers = []
+        self.__collision_handler_types = set()
+
+        # Map from a set of handled component types to the pymunk collision
+        # type of shapes whose entities have exactly those types.  Collision
+        # types are never reused, since pymunk handlers can't be removed.
+        self.__collision_types = {}
+        self.__next_collision_type = 1
+
+        # Function mapping an entity to its collision group, or None.
+        self.__collision_group_function = None
+
+        # Entities whose shapes need to be configured again.
+        self.__to_reconfigure = set()
 
         # The pymunk space.
         self.__space = pymunk.Space()
+        self.__space.iterations = \
+            config.get_or_default("physics_iterations", 10)
+        self.__space.collision_slop = \
+            config.get_or_default("physics_collision_slop", 0.1)
+        self.__space.sleep_time_threshold = float(
+            config.get_or_default("physics_sleep_time_threshold", float("inf")))
+        self.__space.idle_speed_threshold = \
+            config.get_or_default("physics_idle_speed_threshold", 0)
 
-        # Note: the this function assumes we have snuck a reference to our
-        # own body into the pymunk shape. Which we have: see Body(). Here
-        # we try each handler in turn till we find one that is compatible.
-        def collide_begin(arbiter, space, data):
-            go1 = arbiter.shapes[0].game_body.entity
-            go2 = arbiter.shapes[1].game_body.entity
-            for handler in self.__collision_handlers:
-                result = handler.handle_collision(go1, go2)
-                if result.handled:
-                    return result.wants_physical_simulation
-            return True
-
-        # Setup our simple pymunk collision handler.
-        self.__pymunk_handler = self.__space.add_collision_handler(1, 1)
-        self.__pymunk_handler.begin = lambda a, s, d: collide_begin(a, s, d)
+        # The cell size of the space's spatial hash, if it uses one, and the
+        # configured size (a number or 'auto') if it hasn't been chosen yet.
+        self.spatial_hash_cell_size = None
+        self.__pending_cell_size = \
+            config.get_or_none("physics_spatial_hash_cell_size")
 
-        # Setup a default handler for non-collideable objects.
-        self.__default_handler = self.__space.add_default_collision_handler()
-        self.__default_handler.begin = lambda a, s, d: False
+        # Spatial index of the bodies.
+        self.__index = SpatialIndex()
 
         # Map Body and Joint components to simulation objects.
-        self.__pymunk_bodies = Physics.PymunkBodyMapping(self.__space)
+        self.__pymunk_bodies = Physics.PymunkBodyMapping(
+            self.__space,
+            self.__index,
+            lambda pymunk_body, body: self.__configure(pymunk_body, body)
+        )
         self.__pymunk_joints = Physics.PymunkJointMapping(self.__space,
                                                           self.__pymunk_bodies)
 
+    @property
+    def pool_stats(self):
+        """ Statistics about the pooling of simulation bodies. """
+        return self.__pymunk_bodies.pool_stats
+
     def add_collision_handler(self, handler):
         """ Add a logical collision handler for the game. """
         self.__collision_handlers.append(handler)
+        self.__collision_handler_types.update((handler.t1, handler.t2))
+        self.__collision_types = {}
+        self.__pymunk_bodies.reconfigure()
+        if self.game_services is not None:
+            self.game_services.get_entity_manager().system_interests_changed()
+
+    def set_collision_group_function(self, f):
+        """ Set a function mapping an entity to its collision group: bodies in
+        the same nonzero group do not collide.  A Body's own collision_group
+        takes precedence if it is set. """
+        self.__collision_group_function = f
+        self.__pymunk_bodies.reconfigure()
+
+    def matches(self, component_type):
+        """ We manage bodies, and want to know when an entity gains or loses a
+        component type that a collision handler is interested in. """
+        return component_type is Body or \
+            component_type in self.__collision_handler_types
+
+    def on_component_add(self, component):
+        """ Configure a shape again if its entity gains a handled type. """
+        if component.__class__ is not Body:
+            self.__to_reconfigure.add(component.entity)
+
+    def on_component_remove(self, component):
+        """ Configure a shape again if its entity loses a handled type. """
+        if component.__class__ is not Body:
+            self.__to_reconfigure.add(component.entity)
+
+    def reconfigure(self, entity):
+        """ Configure an entity's shape again on the next update, e.g. because
+        its collision group has changed. """
+        self.__to_reconfigure.add(entity)
+
+    def __reconfigure_entities(self):
+        """ Configure the shapes that need it. """
+        for entity in self.__to_reconfigure:
+            if entity in self.__pymunk_bodies:
+                body = entity.get_component(Body)
+                if body is not None:
+                    self.__configure(self.__pymunk_bodies[entity], body)
+        self.__to_reconfigure = set()
+
+    def __configure(self, pymunk_body, body):
+        """ Set up collision filtering for a simulation body. """
+        entity = body.entity
+        types = frozenset(t for t in self.__collision_handler_types
+                          if entity.get_component(t) is not None)
+        group = body.collision_group
+        if group == 0 and self.__collision_group_function is not None:
+            group = self.__collision_group_function(entity)
+        (categories, mask) = COLLISION_CATEGORIES[body.collision_category]
+        pymunk_body.set_collision(self.__get_collision_type(types), group,
+                                  categories, mask, bool(body.is_collideable))
+
+    def __get_collision_type(self, types):
+        """ Get the pymunk collision type for shapes of entities with a set
+        of handled component types, registering pymunk handlers for it with
+        each other collision type if it is new. """
+        collision_type = self.__collision_types.get(types)
+        if collision_type is not None:
+            return collision_type
+        collision_type = self.__next_collision_type
+        self.__next_collision_type += 1
+        self.__collision_types[types] = collision_type
+        for (other_types, other_type) in self.__collision_types.items():
+            self.__add_pymunk_handler(types, collision_type,
+                                      other_types, other_type)
+        return collision_type
+
+    def __add_pymunk_handler(self, types1, collision_type1,
+                             types2, collision_type2):
+        """ Register a pymunk handler for a pair of collision types if there
+        are logical handlers for them.  The matching handlers are tried in
+        turn, and whether their component types are swapped is worked out up
+        front. """
+        handlers = []
+        for handler in self.__collision_handlers:
+            if handler.t1 in types1 and handler.t2 in types2:
+                handlers.append((handler, False))
+            elif handler.t1 in types2 and handler.t2 in types1:
+                handlers.append((handler, True))
+        if len(handlers) > 0:
+            pymunk_handler = self.__space.add_collision_handler(
+                collision_type1, collision_type2)
+            pymunk_handler.begin = Physics.__make_begin(handlers)
+
+    @staticmethod
+    def __make_begin(handlers):
+        """ Make a pymunk 'begin' callback dispatching to logical handlers,
+        trying each in turn until one handles the contact.  Note: this
+        assumes we have snuck a reference to our own body into the pymunk
+        shape, which we have: see PymunkBody. """
+        def begin(arbiter, space, data):
+            (shape1, shape2) = arbiter.shapes
+            e1 = shape1.game_body.entity
+            e2 = shape2.game_body.entity
+            for (handler, swapped) in handlers:
+                if swapped:
+                    c1 = e2.get_component(handler.t1)
+                    c2 = e1.get_component(handler.t2)
+                else:
+                    c1 = e1.get_component(handler.t1)
+                    c2 = e2.get_component(handler.t2)
+                if c1 is None or c2 is None:
+                    continue
+                result = handler.handle_matching_collision(c1, c2)
+                if result.handled:
+                    return result.wants_physical_simulation
+            return True
+        return begin
 
     def update(self, dt):
         """ Advance the simulation. """
 
         # Update the body mapping & copy simulation state from the components.
         self.__pymunk_bodies.update(self.entities())
-        self.__pymunk_bodies.copy_from_components()
+        if len(self.__to_reconfigure) > 0:
+            self.__reconfigure_entities()
+        if self.__pending_cell_size:
+            self.__choose_spatial_index()
+        self.copy_from_components()
         self.__pymunk_joints.update(
             self.game_services.get_entity_manager().query(Joint)
         )
@@ -249,19 +803,62 @@ class Physics(ComponentSystem):
         self.__space.step(dt)
 
         # Copy simulation state back to components.
-        self.__pymunk_bodies.copy_to_components()
+        self.copy_to_components()
+
+    def __choose_spatial_index(self):
+        """ Switch the space to a spatial hash, if one was configured.  An
+        'auto' cell size is chosen once there are some bodies.  Note that
+        pymunk can't switch back to a tree. """
+        cell_size = self.__pending_cell_size
+        sizes = self.__pymunk_bodies.sizes()
+        if cell_size == "auto":
+            if len(sizes) == 0:
+                return
+            cell_size = choose_spatial_hash_cell_size(sizes)
+        self.__pending_cell_size = None
+        if cell_size:
+            self.__space.use_spatial_hash(float(cell_size),
+                                          max(1000, 10*len(sizes)))
+            self.spatial_hash_cell_size = float(cell_size)
+
+    def is_sleeping(self, entity):
+        """ Is an entity's body asleep in the simulation? """
+        if entity not in self.__pymunk_bodies:
+            return False
+        return self.__pymunk_bodies[entity].body.is_sleeping
+
+    def copy_from_components(self):
+        """ Copy the state of the Body components into the simulation. """
+        table = self.game_services.get_entity_manager().get_component_table(Body)
+        if table is None:
+            self.__pymunk_bodies.copy_from_components()
+        else:
+            self.__pymunk_bodies.copy_from_table(table)
+
+    def copy_to_components(self):
+        """ Copy the state of the simulation back to the Body components. """
+        table = self.game_services.get_entity_manager().get_component_table(Body)
+        if table is None:
+            self.__pymunk_bodies.copy_to_components()
+        else:
+            self.__pymunk_bodies.copy_to_table(table)
+
+    @property
+    def spatial_index(self):
+        """ The spatial index of the bodies.  Positions in the index are as of
+        the end of the last update. """
+        return self.__index
 
     def closest_body_with(self, point, f):
         """ Find the closest body of a given predicate. """
-        bodies = filter(f, map(lambda e: e.get_component(Body), self.entities()))
-        best_yet = None
-        best_length_yet = None
-        for b in bodies:
-            length = (b.position - point).length
-            if not best_yet or length < best_length_yet:
-                best_yet = b
-                best_length_yet = length
-        return best_yet
+        closest = self.__index.nearest(
+            point,
+            (Body,),
+            lambda e: f(e.get_component(Body))
+        )
+        if closest is None:
+            return None
+        return closest.get_component(Body)
 
     def get_entity_at(self, point):
         """ Get the entity at a point. """
@@ -296,47 +893,433 @@ class Physics(ComponentSystem):
                 return (hit_entity, result.point, result.normal)
         return (None, end, None)
 
+    def hit_scan_batch(self, from_entities, local_origins, local_directions,
+                       distances, radii, groups=None, ignore=None):
+        """ Do a number of hit scans, one from each entity, as hit_scan()
+        would.  The origins and directions are (n, 2) arrays in the local
+        coordinates of the entities, and the distances and radii are arrays
+        of length n (or single values.)
+
+        Bodies in a ray's collision group (if it isn't zero) are not hit, and
+        neither are the entities in the ray's 'ignore' collection (if any.)
+        Groups and non-collideable bodies are filtered inside pymunk.
+
+        Returns (hit_entities, points, normals, fractions): an object array of
+        the closest entities hit (None for a miss), an (n, 2) array of the
+        hit points (the end of the ray for a miss), an (n, 2) array of the
+        surface normals (zero for a miss), and how far along each ray the hit
+        was, from 0 to 1 (1 for a miss.) """
+        n = len(from_entities)
+        local_origins = numpy.asarray(local_origins, float).reshape(-1, 2)
+        local_directions = numpy.asarray(local_directions, float).reshape(-1, 2)
+        distances = numpy.broadcast_to(numpy.asarray(distances, float), (n,))
+        radii = numpy.broadcast_to(numpy.asarray(radii, float), (n,))
+        if groups is None:
+            groups = numpy.zeros(n, int)
+
+        # Transform the rays to world coordinates in bulk.
+        positions = numpy.zeros((n, 2))
+        angles = numpy.zeros(n)
+        for (i, entity) in enumerate(from_entities):
+            component = entity.get_component(Body)
+            if component is not None:
+                positions[i] = (component.position.x, component.position.y)
+                angles[i] = component.orientation
+        angles = numpy.radians(angles)
+        (c, s) = (numpy.cos(angles), numpy.sin(angles))
+        (ox, oy) = (local_origins[:, 0], local_origins[:, 1])
+        (dx, dy) = (local_directions[:, 0], local_directions[:, 1])
+        starts = positions + numpy.column_stack((ox*c - oy*s, ox*s + oy*c))
+        ends = starts + numpy.column_stack((dx*c - dy*s, dx*s + dy*c)) * \
+            distances[:, None]
+        return self.segment_query_batch(starts, ends, radii, groups, ignore,
+                                        exclude=from_entities)
+
+    def segment_query_batch(self, starts, ends, radii, groups=None,
+                            ignore=None, category="query", exclude=None):
+        """ Find the first body hit along each of a number of segments, given
+        as (n, 2) arrays of world coordinates.  The segments are filtered as
+        bodies of the given collision category would be (e.g. "bullet"
+        segments don't hit bullets), and they never hit non-collideable
+        bodies.  'exclude' is an entity per segment that it doesn't hit.  See hit_scan_batch() for the other arguments and the
+        results. """
+        n = len(starts)
+        radii = numpy.broadcast_to(numpy.asarray(radii, float), (n,))
+        if groups is None:
+            groups = numpy.zeros(n, int)
+        if category == "query":
+            (categories, mask) = (CATEGORY_QUERY, pymunk.ShapeFilter.ALL_MASKS)
+        else:
+            (categories, mask) = COLLISION_CATEGORIES[category]
+        mask &= ~CATEGORY_NON_COLLIDEABLE
+
+        hit_entities = numpy.empty(n, object)
+        points = numpy.array(ends, float).reshape(-1, 2)
+        normals = numpy.zeros((n, 2))
+        fractions = numpy.ones(n)
+        for i in range(n):
+            shape_filter = pymunk.ShapeFilter(int(groups[i]), categories, mask)
+            results = self.__space.segment_query(
+                tuple(starts[i]), tuple(points[i]), radii.item(i), shape_filter
+            )
+            if len(results) == 0:
+                continue
+            ignored = ignore[i] if ignore is not None else ()
+            excluded = exclude[i] if exclude is not None else None
+            for result in sorted(results, key=lambda r: r.alpha):
+                hit_entity = result.shape.game_body.entity
+                if hit_entity != excluded and hit_entity not in ignored:
+                    hit_entities[i] = hit_entity
+                    points[i] = result.point
+                    normals[i] = result.normal
+                    fractions[i] = result.alpha
+                    break
+        return (hit_entities, points, normals, fractions)
+
     def world_to_local(self, entity, point):
         """ Convert a world point to local coordinates. """
-        # Note: uses data from component for correctness since might not have
-        # been copied to pymunk body yet. But copy to temporary pymunk body to
-        # avoid duplicating the code. This is inefficient, we should probably
-        # duplicate the logic & enforce its correctness via tests.
+        # Note: uses data from the component rather than the pymunk body,
+        # since it might not have been copied to the pymunk body yet.
         component = entity.get_component(Body)
-        if component is not None:
-            pb = Physics.PymunkBody(component)
-            pb.copy_from_component()
-            return pb.body.world_to_local(point)
-        else:
+        if component is None:
             return point
+        (c, s) = rotation(component.orientation)
+        position = component.position
+        x = point[0] - position.x
+        y = point[1] - position.y
+        return Vec2d(x*c + y*s, y*c - x*s)
 
     def local_to_world(self, entity, point):
         """ Convert a local point to world coordinates. """
-        # Note: see above.
         component = entity.get_component(Body)
-        if component is not None:
-            pb = Physics.PymunkBody(component)
-            pb.copy_from_component()
-            return pb.body.local_to_world(point)
-        else:
+        if component is None:
             return point
+        (c, s) = rotation(component.orientation)
+        position = component.position
+        x = point[0]
+        y = point[1]
+        return Vec2d(position.x + x*c - y*s, position.y + x*s + y*c)
 
     def local_dir_to_world(self, entity, direction):
         """ Convert a local direction to world coordinates. """
-        # Note: see above.
         component = entity.get_component(Body)
-        if component is not None:
-            pb = Physics.PymunkBody(component)
-            pb.copy_from_component()
-            return pb.body.local_to_world(direction) - pb.body.position
-        else:
+        if component is None:
             return direction
+        (c, s) = rotation(component.orientation)
+        x = direction[0]
+        y = direction[1]
+        return Vec2d(x*c - y*s, x*s + y*c)
+
+    def world_to_local_array(self, entity, points):
+        """ Convert an (n, 2) array of world points to local coordinates. """
+        component = entity.get_component(Body)
+        if component is None:
+            return numpy.array(points, float)
+        (c, s) = rotation(component.orientation)
+        position = component.position
+        return numpy.dot(numpy.asarray(points, float) - (position.x, position.y),
+                         numpy.array([[c, -s], [s, c]]))
+
+    def local_to_world_array(self, entity, points):
+        """ Convert an (n, 2) array of local points to world coordinates. """
+        component = entity.get_component(Body)
+        if component is None:
+            return numpy.array(points, float)
+        (c, s) = rotation(component.orientation)
+        position = component.position
+        return numpy.dot(numpy.asarray(points, float),
+                         numpy.array([[c, s], [-s, c]])) + (position.x, position.y)
+
+    def local_dir_to_world_array(self, entity, directions):
+        """ Convert an (n, 2) array of local directions to world
+        coordinates. """
+        component = entity.get_component(Body)
+        if component is None:
+            return numpy.array(directions, float)
+        (c, s) = rotation(component.orientation)
+        return numpy.dot(numpy.asarray(directions, float),
+                         numpy.array([[c, s], [-s, c]]))
 
     def apply_force_at_local_point(self, entity, force, point):
-        """ Apply a force to the body."""
+        """ Apply a force to the body.  The force and point are in the body's
+        local coordinates.  Forces are accumulated by the Body component as a
+        net force and torque, which are applied on the next update. """
         component = entity.get_component(Body)
         if component is not None:
-            component.impulses.append((force, point))
+            component.force += force
+            component.torque += point[0]*force[1] - point[1]*force[0]
+
+    def apply_forces_at_local_points(self, entities, forces, points):
+        """ Apply a number of forces to bodies, as apply_force_at_local_point()
+        would.  'forces' and 'points' are (n, 2) arrays.  The forces are summed
+        for each body, so each body's component is only updated once. """
+        forces = numpy.asarray(forces, float).reshape(-1, 2)
+        points = numpy.asarray(points, float).reshape(-1, 2)
+        torques = points[:, 0]*forces[:, 1] - points[:, 1]*forces[:, 0]
+        indices = {}
+        rows = [indices.setdefault(entity, len(indices)) for entity in entities]
+        net_forces = numpy.zeros((len(indices), 2))
+        net_torques = numpy.zeros(len(indices))
+        numpy.add.at(net_forces, rows, forces)
+        numpy.add.at(net_torques, rows, torques)
+        for (entity, row) in indices.items():
+            component = entity.get_component(Body)
+            if component is not None:
+                component.force += Vec2d(net_forces.item(row, 0),
+                                         net_forces.item(row, 1))
+                component.torque += net_torques.item(row)
+
+
+class SpatialIndex(object):
+    """ A uniform grid of cells, each of which holds the entities whose
+    positions are in it.  Entities are moved between cells as they are
+    updated.  Queries can be restricted to entities that have some component
+    types, and that pass a filter function. """
+
+    def __init__(self, cell_size=250):
+        """ Constructor. """
+        self.cell_size = float(cell_size)
+
+        # Map from (x, y) cell to the set of entities in it.
+        self.__cells = {}
+
+        # Map from entity to its cell and its position.
+        self.__entity_cells = {}
+        self.__positions = {}
+
+        # The range of cells that have been occupied.
+        self.__min_cell = None
+        self.__max_cell = None
+
+    def __len__(self):
+        """ The number of entities in the index. """
+        return len(self.__positions)
+
+    def __contains__(self, entity):
+        """ Is the entity in the index? """
+        return entity in self.__positions
+
+    def cell_of(self, x, y):
+        """ Get the cell containing a point. """
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def update(self, entity, x, y):
+        """ Add an entity to the index or update its position. """
+        self.__positions[entity] = (x, y)
+        cell = self.cell_of(x, y)
+        old_cell = self.__entity_cells.get(entity)
+        if cell == old_cell:
+            return
+        if old_cell is not None:
+            self.__remove_from_cell(entity, old_cell)
+        self.__entity_cells[entity] = cell
+        self.__cells.setdefault(cell, set()).add(entity)
+        if self.__min_cell is None:
+            self.__min_cell = cell
+            self.__max_cell = cell
+        else:
+            self.__min_cell = (min(self.__min_cell[0], cell[0]),
+                               min(self.__min_cell[1], cell[1]))
+            self.__max_cell = (max(self.__max_cell[0], cell[0]),
+                               max(self.__max_cell[1], cell[1]))
+
+    def remove(self, entity):
+        """ Remove an entity from the index. """
+        cell = self.__entity_cells.pop(entity, None)
+        if cell is not None:
+            del self.__positions[entity]
+            self.__remove_from_cell(entity, cell)
+
+    def update_many(self, entities, positions):
+        """ Add entities to the index or update their positions, which are
+        given as an (n, 2) array. """
+        if len(entities) == 0:
+            return
+        positions = numpy.asarray(positions, float)
+        cells = numpy.floor(positions / self.cell_size).astype(int).tolist()
+        positions = positions.tolist()
+        entity_cells = self.__entity_cells
+        for i in range(len(entities)):
+            entity = entities[i]
+            (x, y) = positions[i]
+            if entity_cells.get(entity) == tuple(cells[i]):
+                self.__positions[entity] = (x, y)
+            else:
+                self.update(entity, x, y)
+
+    def position_of(self, entity):
+        """ Get the indexed position of an entity. """
+        return self.__positions[entity]
+
+    def __remove_from_cell(self, entity, cell):
+        """ Remove an entity from a cell, deleting the cell if it's empty. """
+        entities = self.__cells[cell]
+        entities.discard(entity)
+        if len(entities) == 0:
+            del self.__cells[cell]
+
+    def __accepts(self, entity, types, filter_func):
+        """ Does an entity pass the query's filters? """
+        if entity.is_garbage:
+            return False
+        for t in types:
+            if not entity.has_component(t):
+                return False
+        return filter_func is None or filter_func(entity)
+
+    def __cells_in(self, min_cell, max_cell):
+        """ Get the occupied cells in a range. """
+        cells = self.__cells
+        width = max_cell[0] - min_cell[0] + 1
+        height = max_cell[1] - min_cell[1] + 1
+        if width <= 0 or height <= 0:
+            return []
+        if width * height > len(cells):
+            return [cells[cell] for cell in cells
+                    if min_cell[0] <= cell[0] <= max_cell[0] and
+                       min_cell[1] <= cell[1] <= max_cell[1]]
+        ret = []
+        for x in range(min_cell[0], max_cell[0] + 1):
+            for y in range(min_cell[1], max_cell[1] + 1):
+                entities = cells.get((x, y))
+                if entities is not None:
+                    ret.append(entities)
+        return ret
+
+    def query_rect(self, lower, upper, types=(), filter_func=None):
+        """ Get the entities whose positions are in a rectangle. """
+        ret = []
+        positions = self.__positions
+        for entities in self.__cells_in(self.cell_of(lower[0], lower[1]),
+                                         self.cell_of(upper[0], upper[1])):
+            for entity in entities:
+                (x, y) = positions[entity]
+                if lower[0] <= x <= upper[0] and lower[1] <= y <= upper[1] and \
+                   self.__accepts(entity, types, filter_func):
+                    ret.append(entity)
+        return ret
+
+    def query_radius(self, point, radius, types=(), filter_func=None):
+        """ Get the entities within a distance of a point, closest first. """
+        found = []
+        positions = self.__positions
+        radius_squared = radius * radius
+        for entities in self.__cells_in(
+                self.cell_of(point[0] - radius, point[1] - radius),
+                self.cell_of(point[0] + radius, point[1] + radius)):
+            for entity in entities:
+                (x, y) = positions[entity]
+                dx = x - point[0]
+                dy = y - point[1]
+                distance_squared = dx*dx + dy*dy
+                if distance_squared <= radius_squared and \
+                   self.__accepts(entity, types, filter_func):
+                    found.append((distance_squared, entity))
+        found.sort(key=lambda x: x[0])
+        return [entity for (distance_squared, entity) in found]
+
+    def k_nearest(self, point, k, types=(), filter_func=None, max_distance=None):
+        """ Get the k entities closest to a point, closest first. """
+        if k <= 0 or len(self.__positions) == 0:
+            return []
+
+        # Search rings of cells around the point's cell.  Once a ring has
+        # been searched, everything within ring * cell_size of the point has
+        # been seen.
+        positions = self.__positions
+        cells = self.__cells
+        (cx, cy) = self.cell_of(point[0], point[1])
+        max_ring = max(cx - self.__min_cell[0], self.__max_cell[0] - cx,
+                       cy - self.__min_cell[1], self.__max_cell[1] - cy, 0)
+        heap = []
+        ring = 0
+        while True:
+
+            # If the ring has more cells than there are occupied cells, it's
+            # quicker to look at the remaining occupied cells directly.
+            if 8 * ring > len(cells):
+                ring_cells = [cells[cell] for cell in cells
+                              if max(abs(cell[0] - cx), abs(cell[1] - cy)) >= ring]
+                max_ring = ring
+            elif ring == 0:
+                ring_cells = self.__cells_in((cx, cy), (cx, cy))
+            else:
+                ring_cells = []
+                for x in range(cx - ring, cx + ring + 1):
+                    for y in (cy - ring, cy + ring):
+                        if (x, y) in cells:
+                            ring_cells.append(cells[(x, y)])
+                for y in range(cy - ring + 1, cy + ring):
+                    for x in (cx - ring, cx + ring):
+                        if (x, y) in cells:
+                            ring_cells.append(cells[(x, y)])
+
+            # Keep the k closest in a max-heap (of negated distances.)
+            for entities in ring_cells:
+                for entity in entities:
+                    (x, y) = positions[entity]
+                    dx = x - point[0]
+                    dy = y - point[1]
+                    distance_squared = dx*dx + dy*dy
+                    if len(heap) == k and -heap[0][0] <= distance_squared:
+                        continue
+                    if max_distance is not None and \
+                       distance_squared > max_distance * max_distance:
+                        continue
+                    if not self.__accepts(entity, types, filter_func):
+                        continue
+                    if len(heap) == k:
+                        heapq.heapreplace(heap, (-distance_squared, id(entity), entity))
+                    else:
+                        heapq.heappush(heap, (-distance_squared, id(entity), entity))
+
+            # Stop if nothing unseen can be closer.
+            searched = ring * self.cell_size
+            if ring >= max_ring:
+                break
+            if len(heap) == k and -heap[0][0] <= searched * searched:
+                break
+            if max_distance is not None and searched > max_distance:
+                break
+            ring += 1
+
+        heap.sort(key=lambda x: -x[0])
+        return [entity for (distance_squared, key, entity) in heap]
+
+    def nearest(self, point, types=(), filter_func=None, max_distance=None):
+        """ Get the entity closest to a point, or None. """
+        found = self.k_nearest(point, 1, types, filter_func, max_distance)
+        if len(found) == 0:
+            return None
+        return found[0]
+
+
+def choose_spatial_hash_cell_size(sizes, max_cells=10):
+    """ Choose the cell size of a spatial hash for shapes with the given
+    sizes (radii.)  The diameters are put into a histogram with power of two
+    bins, and the cell size is the top of the fullest bin, so that most shapes
+    overlap few cells.  Returns None if the shapes vary so much in size that,
+    on average, a shape would overlap more than about 'max_cells' cells: a
+    tree is better for them. """
+    diameters = 2 * numpy.asarray(sizes, float)
+    diameters = diameters[diameters > 0]
+    if len(diameters) == 0:
+        return None
+    bins = numpy.floor(numpy.log2(diameters)).astype(int)
+    lowest = bins.min()
+    counts = numpy.bincount(bins - lowest)
+    cell_size = 2.0 ** (numpy.argmax(counts) + lowest + 1)
+    cells = (diameters / cell_size + 1) ** 2
+    if cells.mean() > max_cells:
+        return None
+    return cell_size
+
+
+def rotation(orientation):
+    """ Get the cosine and sine of an orientation in degrees. """
+    angle = math.radians(orientation)
+    return (math.cos(angle), math.sin(angle))
 
 
 class CollisionResult(object):
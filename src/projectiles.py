@@ -0,0 +1,128 @@
+"""
+Projectiles.
+
+Simple bullets, which fly in a straight line until they hit something or time
+out, don't need to be entities.  A bullet config can be marked with
+'projectile: 1', in which case bullets made from it are kept in numpy arrays,
+one row per bullet, and are moved, hit tested and removed in bulk by the
+ProjectileSystem (see systems.py.)
+
+The properties of a type of projectile are taken from the components in its
+config, so the same config works whether or not it is simulated as a
+projectile: the damage from DamageOnContact, the lifetime from KillOnTimer, the
+size from Body, the appearance from AnimationComponent and the explosion from
+ExplodesOnDeath.
+
+Projectiles are not saved with the game.
+"""
+
+
+from .components import Body, DamageOnContact, KillOnTimer, \
+                        AnimationComponent, ExplodesOnDeath
+
+import numpy
+
+
+class ProjectileType(object):
+    """ The shared properties of the projectiles made from a config. """
+
+    def __init__(self, name, prototype):
+        """ Constructor. 'prototype' is the EntityPrototype of the config. """
+        components = dict(prototype.components)
+        self.name = name
+        self.damage = components[DamageOnContact]["damage"]
+        self.lifetime = components[KillOnTimer]["lifetime"]
+        self.size = components[Body].get_or_default("size", 5)
+        self.anim_name = None
+        self.brightness = 0.0
+        animation = components.get(AnimationComponent)
+        if animation is not None:
+            self.anim_name = animation["anim_name"]
+            self.brightness = animation.get_or_default("brightness", 0.0)
+        self.explodes = components.get(ExplodesOnDeath)
+
+        # The animation that all of the projectiles share.
+        self.anim = None
+
+    @staticmethod
+    def can_simulate(prototype):
+        """ Can the entities described by a prototype be simulated as
+        projectiles? """
+        if not prototype.config.get_or_default("projectile", False):
+            return False
+        components = dict(prototype.components)
+        if DamageOnContact not in components or KillOnTimer not in components \
+           or Body not in components:
+            return False
+        return components[DamageOnContact].get_or_default("destroy_on_hit", True)
+
+
+class Projectiles(object):
+    """ Projectiles stored in arrays.
+
+    Projectiles are added to a list, and are moved into the arrays at the
+    start of the next update, so that adding a projectile is cheap. """
+
+    def __init__(self):
+        """ Constructor. """
+        self.positions = numpy.zeros((0, 2))
+        self.velocities = numpy.zeros((0, 2))
+        self.ages = numpy.zeros(0)
+        self.types = numpy.zeros(0, int)
+        self.groups = numpy.zeros(0, int)
+
+        # The entities that fired the projectiles, and their handles, since the
+        # entities might die and be reused.  Projectiles don't hit their
+        # shooters' assemblies.
+        self.shooters = []
+
+        # Projectiles added since the last flush: (position, velocity, type,
+        # group, shooter.)
+        self.__added = []
+
+    def __len__(self):
+        """ Get the number of projectiles, including ones just added. """
+        return len(self.ages) + len(self.__added)
+
+    def add(self, position, velocity, type_index, group, shooter):
+        """ Add a projectile. """
+        self.__added.append((position, velocity, type_index, group, shooter))
+
+    def flush(self):
+        """ Move the projectiles that have been added into the arrays. """
+        if len(self.__added) == 0:
+            return
+        (positions, velocities, types, groups, shooters) = zip(*self.__added)
+        self.__added = []
+        self.positions = numpy.concatenate(
+            (self.positions, numpy.array(positions, float).reshape(-1, 2)))
+        self.velocities = numpy.concatenate(
+            (self.velocities, numpy.array(velocities, float).reshape(-1, 2)))
+        self.ages = numpy.concatenate((self.ages, numpy.zeros(len(types))))
+        self.types = numpy.concatenate((self.types, numpy.array(types, int)))
+        self.groups = numpy.concatenate((self.groups, numpy.array(groups, int)))
+        self.shooters.extend(shooters)
+
+    def integrate(self, dt):
+        """ Move the projectiles along their velocities.  Returns the
+        positions they moved from. """
+        starts = self.positions.copy()
+        self.positions += self.velocities * dt
+        self.ages += dt
+        return starts
+
+    def remove(self, mask):
+        """ Remove the projectiles selected by a boolean array. """
+        if not mask.any():
+            return
+        keep = ~mask
+        self.positions = self.positions[keep]
+        self.velocities = self.velocities[keep]
+        self.ages = self.ages[keep]
+        self.types = self.types[keep]
+        self.groups = self.groups[keep]
+        self.shooters = [s for (s, k) in zip(self.shooters, keep) if k]
+
+    def clear(self):
+        """ Remove all of the projectiles. """
+        self.__init__()
@@ -26,20 +26,33 @@ entity 'follow' another, contains an entity reference - the tracked entity.
 system. For instance an entity with the 'Thruster' component will kill itself
 when the entity it is attached to is killed.
 
+Entities that are pinned together by joints, or rigidly attached to one
+another, form an 'assembly' (e.g. a ship and its turrets.)  The AssemblySystem
+keeps track of the assemblies as joints come and go, so that they can be
+queried without searching the joints.
+
 Some rules are implemented as free functions, since they are needed in multiple
 places.
+
+Systems that only change the fields of existing components (and perhaps kill
+entities) declare the component types they read and write, so that they can be
+updated concurrently with other systems.
 """
 
 from config import Config
-from ecs import ComponentSystem
+from ecs import ComponentSystem, CacheStats
 from components import *
 from physics import Physics
 from direction_providers import *
 from renderer import Renderer
+from thrusters import ThrusterSolver, get_layout
+from teams import TeamSystem, hostile, resolve_team
+from projectiles import Projectiles, ProjectileType
 
+import collections
 import random
 import numpy
-import scipy.optimize
+import scipy.spatial
 
 
 def towards(e1, e2):
@@ -55,14 +68,10 @@ def get_team(e):
     """ Get the team of an entity.  If the entity does not have a team then
     this returns None. """
     assert e is not None
-    ret = None
-    ct = e.get_component(Team)
-    if ct is not None:
-        if ct.parent.entity is not None:
-            ret = get_team(ct.parent.entity)
-        if ret is None:
-            ret = ct.team
-    return ret
+    teams = e.ecs().get_system(TeamSystem)
+    if teams is None:
+        return resolve_team(e)[0]
+    return teams.get_team(e)
 
 
 def setup_team(e1, e2):
@@ -73,13 +82,23 @@ def setup_team(e1, e2):
         t2.parent.entity = e1
 
 
+def get_collision_group(e):
+    """ Get the physics collision group of an entity.  Entities on the same
+    team are in the same group (their team id), so they don't collide.
+    Entities without a team are in group 0, which collides with everything. """
+    teams = e.ecs().get_system(TeamSystem)
+    assert teams is not None, "Collision groups need a TeamSystem."
+    return teams.get_team_id(e)
+
+
 def on_same_team(e1, e2):
     """ Are two entities friendly towards one another? """
-    t1 = get_team(e1)
-    t2 = get_team(e2)
-    if t1 is None or t2 is None:
-        return True
-    return t1 == t2
+    teams = e1.ecs().get_system(TeamSystem)
+    if teams is None:
+        t1 = resolve_team(e1)[0]
+        t2 = resolve_team(e2)[0]
+        return t1 is None or t2 is None or t1 == t2
+    return not hostile(teams.get_team_id(e1), teams.get_team_id(e2))
 
 
 def consume_power(e, amount):
@@ -163,27 +182,8 @@ def apply_damage_to_entity(damage, entity):
 
 def get_attached_entities(start_entity):
     """ Get the entities attached to the one given. """
-    joints_entities = start_entity.ecs().query_include_queued(Joint)
-    got = set()
-    got.add(start_entity)
-    while True:
-        new = set()
-        for joint_entity in joints_entities:
-            joint = joint_entity.get_component(Joint)
-            if joint.entity_a.entity is None or \
-                            joint.entity_b.entity is None:
-                continue
-            e1 = joint.entity_a.entity
-            e2 = joint.entity_b.entity
-            if e1 in got and not e2 in got:
-                new.add(e2)
-            if e2 in got and not e1 in got:
-                new.add(e1)
-        if len(new) == 0:
-            break
-        else:
-            got = got | new
-    return got
+    assemblies = start_entity.ecs().get_system(AssemblySystem)
+    return assemblies.get_assembly(start_entity)
 
 
 def teleport(entity, to, to_velocity=None, to_orientation=None):
@@ -236,12 +236,183 @@ def hit_scan(
         filter_func=lambda x: True
 ):
     """ Do a hit scan from an entity. """
-    aug_filter = lambda x: x != from_entity and not x in get_attached_entities(from_entity)
+    assemblies = from_entity.ecs().get_system(AssemblySystem)
+    aug_filter = lambda x: not assemblies.same_assembly(from_entity, x) and \
+                           filter_func(x)
     physics = from_entity.ecs().get_system(Physics)
     return physics.hit_scan(from_entity, local_origin, local_direction,
                             distance, radius, aug_filter)
 
 
+def hit_scan_batch(
+        from_entities,
+        local_origins=(0, 0),
+        local_directions=(0, -1),
+        distances=1000,
+        radii=1,
+        ignore_friendly=False
+):
+    """ Do a hit scan from each of a number of entities at once.  Rays don't
+    hit the assemblies they are fired from, and rays for which
+    'ignore_friendly' is set (it can be a single value or an array) don't hit
+    anything on their entity's team.  Returns numpy arrays: see
+    Physics.hit_scan_batch(). """
+    n = len(from_entities)
+    if n == 0:
+        return (numpy.empty(0, object), numpy.zeros((0, 2)),
+                numpy.zeros((0, 2)), numpy.ones(0))
+    ecs = from_entities[0].ecs()
+    local_origins = numpy.broadcast_to(numpy.asarray(local_origins, float), (n, 2))
+    local_directions = numpy.broadcast_to(numpy.asarray(local_directions, float), (n, 2))
+    ignore_friendly = numpy.broadcast_to(numpy.asarray(ignore_friendly, bool), (n,))
+    groups = numpy.zeros(n, int)
+    if ignore_friendly.any():
+        teams = ecs.get_system(TeamSystem).team_ids(from_entities)
+        groups = numpy.where(ignore_friendly, teams, 0)
+    assemblies = ecs.get_system(AssemblySystem)
+    ignore = [assemblies.get_assembly(e) for e in from_entities]
+    physics = ecs.get_system(Physics)
+    return physics.hit_scan_batch(from_entities, local_origins,
+                                  local_directions, distances, radii,
+                                  groups, ignore)
+
+
+class AssemblySystem(ComponentSystem):
+    """ Keeps track of the assemblies of entities that are connected by
+    joints or rigid attachments (which are both 'links' here.)
+
+    Each entity with links maps to the set of entities in its assembly,
+    which is shared by all of them.  Adding a link merges two assemblies,
+    moving the members of the smaller into the larger.  Removing a link, or
+    an entity with links, re-discovers the connected parts of just the
+    assembly that was affected.  Entities without links are not stored;
+    they are in an assembly of their own. """
+
+    def __init__(self):
+        """ Constructor. """
+        ComponentSystem.__init__(self, [Joint, RigidAttachment, Body],
+                                 reads=[], writes=[])
+
+        # The assembly of each entity with links.
+        self.__assemblies = {}
+
+        # The links attached to each entity, and the entities that each link
+        # was attached to when it was added.
+        self.__links = {}
+        self.__link_ends = {}
+
+    def setup(self, game_services):
+        """ Index any links that already exist. """
+        ComponentSystem.setup(self, game_services)
+        self.on_load()
+
+    def on_load(self):
+        """ Index the links from scratch. """
+        self.__assemblies = {}
+        self.__links = {}
+        self.__link_ends = {}
+        entity_manager = self.game_services.get_entity_manager()
+        for link_type in (Joint, RigidAttachment):
+            for entity in entity_manager.query_include_queued(link_type):
+                self.__add_link(entity.get_component(link_type))
+
+    def on_component_add(self, component):
+        """ Merge the assemblies joined by a new link. """
+        if isinstance(component, (Joint, RigidAttachment)):
+            self.__add_link(component)
+
+    def on_component_remove(self, component):
+        """ Split the assembly that a link or body is removed from. """
+        if isinstance(component, (Joint, RigidAttachment)):
+            self.__remove_link(component)
+        elif component.entity in self.__links:
+            self.__remove_entity(component.entity)
+
+    def same_assembly(self, e1, e2):
+        """ Are two entities in the same assembly? """
+        if e1 is e2:
+            return True
+        assembly = self.__assemblies.get(e1)
+        return assembly is not None and e2 in assembly
+
+    def get_assembly(self, entity):
+        """ Get the set of entities in an entity's assembly. """
+        assembly = self.__assemblies.get(entity)
+        if assembly is None:
+            return set([entity])
+        return set(assembly)
+
+    def __add_link(self, link):
+        """ Add a link to the index. """
+        if isinstance(link, Joint):
+            e1 = link.entity_a.entity
+            e2 = link.entity_b.entity
+        else:
+            e1 = link.parent.entity
+            e2 = link.entity
+        if e1 is None or e2 is None:
+            return
+        self.__link_ends[link] = (e1, e2)
+        self.__links.setdefault(e1, set()).add(link)
+        self.__links.setdefault(e2, set()).add(link)
+        a1 = self.__assemblies.setdefault(e1, set([e1]))
+        a2 = self.__assemblies.setdefault(e2, set([e2]))
+        if a1 is a2:
+            return
+        if len(a1) < len(a2):
+            (a1, a2) = (a2, a1)
+        a1 |= a2
+        for entity in a2:
+            self.__assemblies[entity] = a1
+
+    def __remove_link(self, link):
+        """ Remove a link from the index. """
+        ends = self.__link_ends.pop(link, None)
+        if ends is None:
+            return
+        for entity in ends:
+            self.__detach(entity, link)
+        self.__split(self.__assemblies[ends[0]])
+
+    def __remove_entity(self, entity):
+        """ Remove an entity and its links from the index. """
+        for link in self.__links.pop(entity):
+            for other in self.__link_ends.pop(link):
+                if other is not entity:
+                    self.__detach(other, link)
+        assembly = self.__assemblies.pop(entity)
+        assembly.discard(entity)
+        self.__split(assembly)
+
+    def __detach(self, entity, link):
+        """ Forget that a link is attached to an entity. """
+        links = self.__links.get(entity)
+        if links is not None:
+            links.discard(link)
+            if len(links) == 0:
+                del self.__links[entity]
+
+    def __split(self, assembly):
+        """ Work out the assemblies that the members of an assembly are now
+        in. """
+        for entity in assembly:
+            del self.__assemblies[entity]
+        for entity in assembly:
+            if entity in self.__assemblies or not entity in self.__links:
+                continue
+            connected = set([entity])
+            stack = [entity]
+            while len(stack) > 0:
+                current = stack.pop()
+                for link in self.__links[current]:
+                    for other in self.__link_ends[link]:
+                        if not other in connected:
+                            connected.add(other)
+                            stack.append(other)
+            for member in connected:
+                self.__assemblies[member] = connected
+
+
 class FollowsTrackedSystem(ComponentSystem):
     """ Updates entities that follow other entities around. """
 
@@ -305,6 +476,7 @@ class WeaponSystem(ComponentSystem):
 
     def update(self, dt):
         """ Update the guns. """
+        beams = []
         for entity in self.entities():
             weapon = entity.get_component(Weapon)
             if weapon.owner.entity is None:
@@ -316,25 +488,39 @@ class WeaponSystem(ComponentSystem):
                 if weapon.weapon_type == "projectile_thrower":
                     self.shoot_bullet(weapon, dt)
                 elif weapon.weapon_type == "beam":
-                    self.shoot_beam(weapon, dt)
+                    if self.power_beam(weapon, dt):
+                        beams.append(weapon)
                 else:
                     # Unknown weapon style.
                     pass
+        self.shoot_beams(beams, dt)
 
-    def shoot_beam(self, weapon, dt):
-        """ Shoot a beam. """
+    def power_beam(self, weapon, dt):
+        """ Consume the power needed to shoot a beam.  Returns whether there
+        was any power; if not, the beam stops shooting. """
         power_consumed = consume_power(weapon.owner.entity, weapon.config["power_usage"] * dt)
         if power_consumed == 0:
             weapon.shooting_at = None
-        else:
-            (hit_entity, weapon.impact_point, weapon.impact_normal) = hit_scan(
-                weapon.owner.entity,
-                Vec2d(0, 0),
-                Vec2d(0, -1),
-                weapon.config["range"],
-                weapon.config["radius"]
-            )
+            return False
+        return True
+
+    def shoot_beams(self, weapons, dt):
+        """ Shoot a number of beams, doing their hit scans in one batch. """
+        if len(weapons) == 0:
+            return
+        (hit_entities, points, normals, fractions) = hit_scan_batch(
+            [weapon.owner.entity for weapon in weapons],
+            (0, 0),
+            (0, -1),
+            [weapon.config["range"] for weapon in weapons],
+            [weapon.config["radius"] for weapon in weapons]
+        )
+        for (i, weapon) in enumerate(weapons):
+            weapon.impact_point = Vec2d(points[i])
+            weapon.impact_normal = None
+            hit_entity = hit_entities[i]
             if hit_entity is not None:
+                weapon.impact_normal = Vec2d(normals[i])
                 apply_damage_to_entity(weapon.config["damage"]*dt, hit_entity)
 
     def shoot_bullet(self, weapon, dt):
@@ -372,6 +558,15 @@ class WeaponSystem(ComponentSystem):
                 cs = self.game_services.get_entity_manager().get_system(CameraSystem)
                 cs.play_sound(shot_sound, body.position)
 
+            # Simple bullets are simulated in bulk, if possible.
+            projectiles = weapon.entity.ecs().get_system(ProjectileSystem)
+            if projectiles is not None:
+                type_index = projectiles.get_type(weapon.config["bullet_config"])
+                if type_index is not None:
+                    projectiles.shoot(type_index, bullet_position,
+                                      bullet_velocity, weapon.owner.entity)
+                    continue
+
             # Create the bullet.
             bullet_entity = weapon.entity.ecs().create_entity(weapon.config["bullet_config"])
 
@@ -379,39 +574,287 @@ class WeaponSystem(ComponentSystem):
             bullet_orientation = shooting_at_dir.normalized().get_angle_degrees()+90
             teleport(bullet_entity, bullet_position, bullet_velocity, bullet_orientation)
 
-            # Set the team.
+            # Set the team. The bullet won't collide with its own side.
             setup_team(weapon.owner.entity, bullet_entity)
+            bullet_body = bullet_entity.get_component(Body)
+            if bullet_body is not None:
+                bullet_body.collision_group = \
+                    get_collision_group(weapon.owner.entity)
+
+
+class ProjectileSystem(ComponentSystem):
+    """ Simulates simple bullets in bulk: see projectiles.py.
+
+    Each update, all of the projectiles are moved along their velocities, and
+    the segments they swept out are hit scanned in one batch, with the same
+    collision filtering that a bullet body would get, so that fast projectiles
+    can't pass through things between frames.  The projectiles that hit
+    something are removed, the damage they did is summed for each entity hit
+    and applied, and their explosions are created. """
+
+    def __init__(self):
+        """ Constructor. """
+        ComponentSystem.__init__(self, [])
+        self.projectiles = Projectiles()
+
+        # The types of projectile, and the index of the type of each bullet
+        # config (or None, if it can't be simulated as a projectile.)
+        self.types = []
+        self.__type_indices = {}
+
+    def matches(self, component_type):
+        """ Projectiles aren't entities, so we don't need to hear about any
+        components. """
+        return False
+
+    def on_load(self):
+        """ Projectiles aren't saved, so remove them. """
+        self.projectiles.clear()
+
+    def get_type(self, bullet_config):
+        """ Get the index of the projectile type for a bullet config, or None
+        if it has to be simulated as an entity. """
+        if bullet_config in self.__type_indices:
+            return self.__type_indices[bullet_config]
+        entity_manager = self.game_services.get_entity_manager()
+        prototype = entity_manager.get_prototype(bullet_config)
+        type_index = None
+        if ProjectileType.can_simulate(prototype):
+            type_index = len(self.types)
+            self.types.append(ProjectileType(bullet_config, prototype))
+        self.__type_indices[bullet_config] = type_index
+        return type_index
+
+    def shoot(self, type_index, position, velocity, shooter):
+        """ Fire a projectile.  It won't hit the shooter's assembly, or
+        anything on the shooter's team. """
+        self.projectiles.add((position[0], position[1]),
+                             (velocity[0], velocity[1]),
+                             type_index,
+                             get_collision_group(shooter),
+                             (shooter, shooter.handle))
+
+    def update(self, dt):
+        """ Move the projectiles and apply their hits. """
+        projectiles = self.projectiles
+        projectiles.flush()
+        self.__tick_animations(dt)
+        if len(projectiles) == 0:
+            return
+
+        # Move the projectiles, and find what they hit on the way.  The
+        # assembly of each shooter is looked up once.
+        starts = projectiles.integrate(dt)
+        entity_manager = self.game_services.get_entity_manager()
+        assemblies = entity_manager.get_system(AssemblySystem)
+        ignore_by_handle = {}
+        ignore = []
+        for (shooter, handle) in projectiles.shooters:
+            shooter_ignore = ignore_by_handle.get(handle)
+            if shooter_ignore is None:
+                if shooter.handles.is_valid(handle):
+                    shooter_ignore = assemblies.get_assembly(shooter)
+                else:
+                    shooter_ignore = ()
+                ignore_by_handle[handle] = shooter_ignore
+            ignore.append(shooter_ignore)
+        sizes = numpy.array([t.size for t in self.types], float)
+        (hit_entities, points, normals, fractions) = \
+            entity_manager.get_system(Physics).segment_query_batch(
+                starts,
+                projectiles.positions,
+                sizes[projectiles.types],
+                projectiles.groups,
+                ignore,
+                category="bullet"
+            )
+
+        # Apply the hits.
+        hit = numpy.not_equal(hit_entities, None)
+        if hit.any():
+            self.__apply_hits(hit_entities[hit], points[hit],
+                              projectiles.types[hit])
+
+        # Remove the projectiles that hit something or are too old.
+        lifetimes = numpy.array([t.lifetime for t in self.types], float)
+        projectiles.remove(hit | (projectiles.ages >= lifetimes[projectiles.types]))
+
+    def __apply_hits(self, hit_entities, points, types):
+        """ Explode the projectiles that hit something, and damage what they
+        hit.  The damage is summed for each entity, so that it is only
+        damaged once. """
+        damages = numpy.array([t.damage for t in self.types], float)[types]
+        damage_by_entity = collections.OrderedDict()
+        for (entity, damage) in zip(hit_entities, damages):
+            damage_by_entity[entity] = damage_by_entity.get(entity, 0) + damage
+
+        # Explosions move with the thing that was hit.  Each type of explosion
+        # makes its sound once.
+        camera_system = self.game_services.get_entity_manager().get_system(CameraSystem)
+        sounds_played = set()
+        for (entity, point, type_index) in zip(hit_entities, points, types):
+            explodes = self.types[type_index].explodes
+            if explodes is None:
+                continue
+            position = Vec2d(point[0], point[1])
+            velocity = Vec2d(0, 0)
+            body = entity.get_component(Body)
+            if body is not None:
+                velocity = body.velocity
+            explosion = entity.ecs().create_entity(explodes["explosion_config"])
+            teleport(explosion, position, velocity)
+            if camera_system is not None:
+                camera_system.apply_shake(
+                    explodes.get_or_default("shake_factor", 1), position)
+                sound = explodes.get_or_none("sound")
+                if sound is not None and sound not in sounds_played:
+                    sounds_played.add(sound)
+                    camera_system.play_sound(sound, position)
+
+        for (entity, damage) in damage_by_entity.items():
+            if not entity.is_garbage:
+                apply_damage_to_entity(damage, entity)
+
+    def __tick_animations(self, dt):
+        """ Advance the animations, which are shared by all of the
+        projectiles of a type. """
+        for projectile_type in self.types:
+            if projectile_type.anim_name is None:
+                continue
+            if projectile_type.anim is None:
+                projectile_type.anim = self.game_services.get_resource_loader() \
+                    .load_animation(projectile_type.anim_name)
+            if projectile_type.anim.tick(dt):
+                projectile_type.anim.reset()
 
 
 class TrackingSystem(ComponentSystem):
-    """ Update entities that track other entities. """
+    """ Update entities that track other entities.
+
+    Trackers that need a target are grouped by team, and the nearest hostile
+    body is found for all of the trackers in a team at once using a KD-tree of
+    the bodies on the other teams.  The trees are rebuilt when they are older
+    than 'rebuild_period', so the targets chosen might be a little out of date:
+    bodies that have died since are skipped, and bodies created since aren't
+    found until the next rebuild.
+
+    Each time the trees are rebuilt, trackers that already have a target are
+    considered too, but only switch to a new one if it is nearer than
+    'switch_ratio' times the distance to their current target. """
 
     def __init__(self):
         """ Constructor. """
         ComponentSystem.__init__(self, [Tracking, Body])
 
+        # For each team, a KD-tree of the hostile bodies, their entities and
+        # their handles.
+        self.__targets = None
+        self.__targets_age = 0
+        self.rebuild_period = 0.25
+
+        # The number of candidates to consider for each tracker, in case the
+        # nearest has died since the tree was built.
+        self.candidates = 4
+
+        # How much nearer a new target must be for a tracker to switch to it.
+        self.switch_ratio = 0.5
+
     def update(self, dt):
         """ Update the trackers. """
+        self.__targets_age += dt
+        retarget = self.__targets is None or \
+                   self.__targets_age >= self.rebuild_period
+
+        # Group the trackers that need a target by team.  When the trees are
+        # about to be rebuilt, trackers that have a target are included.
+        trackers = {}
         for entity in self.entities():
-            self_body = entity.get_component(Body)
             tracking = entity.get_component(Tracking)
-            if tracking.tracked.entity is None and tracking.track_type == "team":
-                def f(body):
-                    return not on_same_team(entity, body.entity)
-                closest = entity.ecs().get_system(Physics).closest_body_with(
-                    self_body.position,
-                    f
-                )
-                if closest is not None:
-                    tracking.tracked.entity = closest.entity
+            if tracking.track_type != "team":
+                continue
+            if retarget or tracking.tracked.entity is None:
+                team = get_team(entity)
+                if team is not None:
+                    trackers.setdefault(team, []).append(entity)
+        if len(trackers) == 0:
+            return
+
+        # Find the nearest hostile body for each tracker.
+        targets = self.get_targets()
+        for team in trackers:
+            if not team in targets:
+                continue
+            (tree, entities, handles) = targets[team]
+            team_trackers = trackers[team]
+            points = [tuple(e.get_component(Body).position) for e in team_trackers]
+            k = min(self.candidates, len(entities))
+            (distances, indices) = tree.query(points, k)
+            distances = numpy.reshape(distances, (len(team_trackers), k))
+            indices = numpy.reshape(indices, (len(team_trackers), k))
+            for (entity, point, candidate_distances, candidates) in \
+                    zip(team_trackers, points, distances, indices):
+                for (distance, i) in zip(candidate_distances, candidates):
+                    if entities[i].handles.is_valid(handles[i]):
+                        self.__choose_target(entity, point, entities[i],
+                                             distance)
+                        break
+
+    def __choose_target(self, entity, point, candidate, distance):
+        """ Make a tracker track a candidate, unless the tracker's current
+        target isn't much further away. """
+        tracking = entity.get_component(Tracking)
+        current = tracking.tracked.entity
+        if current is candidate:
+            return
+        if current is not None:
+            current_distance = (current.get_component(Body).position -
+                                Vec2d(point)).length
+            if distance >= self.switch_ratio * current_distance:
+                return
+        tracking.tracked.entity = candidate
+
+    def get_targets(self):
+        """ Get a map from each team to a KD-tree of the positions of the
+        bodies hostile to it, a list of their entities and a list of their
+        handles. """
+        if self.__targets is not None and \
+           self.__targets_age < self.rebuild_period:
+            return self.__targets
+        bodies = self.game_services.get_entity_manager().query(Body)
+
+        # Group the bodies by team.  Bodies without a team are on the same
+        # side as everyone.
+        teams = {}
+        for entity in bodies:
+            team = get_team(entity)
+            if team is not None:
+                teams.setdefault(team, []).append(entity)
+
+        # Build a tree for each team from the bodies on the other teams.
+        self.__targets = {}
+        for team in teams:
+            entities = []
+            for other in teams:
+                if other != team:
+                    entities += teams[other]
+            if len(entities) > 0:
+                positions = [tuple(e.get_component(Body).position) for e in entities]
+                self.__targets[team] = (scipy.spatial.cKDTree(positions),
+                                        entities,
+                                        [e.handle for e in entities])
+        self.__targets_age = 0
+        return self.__targets
 
 
 class LaunchesFightersSystem(ComponentSystem):
-    """ Updates entities that launch fighters. """
+    """ Updates entities that launch fighters.  The fighters are set up by
+    a function passed to create_entity(), so that they can be created while
+    other systems are being updated. """
 
     def __init__(self):
         """ Constructor. """
-        ComponentSystem.__init__(self, [LaunchesFighters])
+        ComponentSystem.__init__(self, [LaunchesFighters], reads=[Body],
+                                 writes=[LaunchesFighters])
 
     def update(self, dt):
         """ Updates the carriers. """
@@ -428,12 +871,23 @@ class LaunchesFightersSystem(ComponentSystem):
                     direction.rotate_degrees(spread*random.random()-spread/2.0)
 
                     # Launch!
-                    child = entity.ecs().create_entity(launcher.config["fighter_config"])
-                    launcher.launched.add_ref_to(child)
-                    setup_team(entity, child)
-                    teleport(child,
-                             body.position + (body.size + 10) * direction,
-                             body.velocity + direction * launcher.config["takeoff_spread"])
+                    entity.ecs().create_entity(
+                        launcher.config["fighter_config"],
+                        self.__launch(
+                            entity, launcher,
+                            body.position + (body.size + 10) * direction,
+                            body.velocity + direction * launcher.config["takeoff_spread"]
+                        )
+                    )
+
+    @staticmethod
+    def __launch(entity, launcher, position, velocity):
+        """ Get a function that sets up a fighter launched by an entity. """
+        def launch(child):
+            launcher.launched.add_ref_to(child)
+            setup_team(entity, child)
+            teleport(child, position, velocity)
+        return launch
 
 
 class KillOnTimerSystem(ComponentSystem):
@@ -441,7 +895,7 @@ class KillOnTimerSystem(ComponentSystem):
 
     def __init__(self):
         """ Constructor. """
-        ComponentSystem.__init__(self, [KillOnTimer])
+        ComponentSystem.__init__(self, [KillOnTimer], writes=[KillOnTimer])
 
     def update(self, dt):
         """ Update the entities. """
@@ -456,10 +910,14 @@ class PowerSystem(ComponentSystem):
 
     def __init__(self):
         """ Constructor. """
-        ComponentSystem.__init__(self, [Power])
+        ComponentSystem.__init__(self, [Power], writes=[Power])
 
     def update(self, dt):
         """ Update the entities."""
+        table = self.game_services.get_entity_manager().get_component_table(Power)
+        if table is not None:
+            self.update_columns(table, dt)
+            return
         for e in self.entities():
             power = e.get_component(Power)
             if power.overloaded:
@@ -469,13 +927,28 @@ class PowerSystem(ComponentSystem):
             else:
                 power.power = min(power.capacity, power.power + power.recharge_rate * dt)
 
+    def update_columns(self, table, dt):
+        """ Update all of the entities at once, when the Power components are
+        stored in a table.  Note that this includes components of entities
+        that are queued for creation. """
+        power = table.column("power")
+        overloaded = table.column("overloaded")
+        recharged = numpy.minimum(table.column("capacity"),
+                                  power + table.column("recharge_rate") * dt)
+        numpy.copyto(power, recharged, where=~overloaded)
+        for row in numpy.flatnonzero(overloaded):
+            component = table.components[row]
+            if component.overload_timer.tick(dt):
+                component.overloaded = False
+                component.overload_timer.reset()
+
 
 class ShieldSystem(ComponentSystem):
     """ Updates entities with shields. """
 
     def __init__(self):
         """ Constructor. """
-        ComponentSystem.__init__(self, [Shields])
+        ComponentSystem.__init__(self, [Shields], writes=[Shields, Power])
 
     def update(self, dt):
         """ Update the shields. """
@@ -499,7 +972,7 @@ class TextSystem(ComponentSystem):
 
     def __init__(self):
         """ Constructor. """
-        ComponentSystem.__init__(self, [Text])
+        ComponentSystem.__init__(self, [Text], writes=[Text])
 
     def update(self, dt):
         """ Update the entities. """
@@ -519,7 +992,8 @@ class AnimSystem(ComponentSystem):
 
     def __init__(self):
         """ Constructor. """
-        ComponentSystem.__init__(self, [AnimationComponent])
+        ComponentSystem.__init__(self, [AnimationComponent],
+                                 writes=[AnimationComponent])
 
     def update(self, dt):
         """ Update the animations. """
@@ -537,36 +1011,54 @@ class ThrusterSystem(ComponentSystem):
 
     def __init__(self):
         """ Constructor. """
-        ComponentSystem.__init__(self, [Thruster])
+        ComponentSystem.__init__(self, [Thruster], reads=[Thruster], writes=[Body])
 
     def update(self, dt):
-        """ Update the thrusters. """
+        """ Update the thrusters. The forces of the firing thrusters are
+        applied together, so that each body is only pushed once. """
+        attached_entities = []
+        thrusts = []
+        directions = []
+        positions = []
         for entity in self.entities():
             thruster = entity.get_component(Thruster)
             attached = thruster.attached_to.entity
             if attached is None:
                 entity.kill()
-            else:
-                physics = self.game_services.get_entity_manager().get_system(Physics)
-                physics.apply_force_at_local_point(
-                    attached,
-                    thruster.thrust * thruster.direction,
-                    thruster.position
-                )
+            elif thruster.thrust != 0:
+                attached_entities.append(attached)
+                thrusts.append(thruster.thrust)
+                directions.append(thruster.direction)
+                positions.append(thruster.position)
+        if len(attached_entities) == 0:
+            return
+        forces = numpy.array(directions, float) * \
+                 numpy.array(thrusts, float).reshape(-1, 1)
+        physics = self.game_services.get_entity_manager().get_system(Physics)
+        physics.apply_forces_at_local_points(attached_entities, forces, positions)
 
 
 class ThrustersSystem(ComponentSystem):
     """ Update entities with thruster based movement. """
 
-    def __init__(self):
-        """ Constructor. """
-        ComponentSystem.__init__(self, [Body, Thrusters])
+    def __init__(self, cache_file=None):
+        """ Constructor. If a cache file is given, thruster allocations are
+        loaded from it. """
+        ComponentSystem.__init__(self, [Body, Thrusters], reads=[Body],
+                                 writes=[Thrusters, Thruster])
+
+        # Thruster allocations, shared between entities with the same
+        # layout of thrusters.
+        self.solver = ThrusterSolver()
+        if cache_file:
+            self.solver.load(cache_file)
 
     def on_component_add(self, component):
         """ When thrusters are added to an entity we need to create the actual
         thrusters themselves, which are specified in the config. """
         if component.__class__ == Thrusters:
             thruster_cfgs = component.config.get_or_default("thrusters", [])
+            created = []
             for cfg in thruster_cfgs:
                 thruster_ent = component.entity.ecs().create_entity()
                 thruster = Thruster(thruster_ent, self.game_services, cfg)
@@ -574,6 +1066,19 @@ class ThrustersSystem(ComponentSystem):
                 thruster_ent.add_component(thruster)
                 thruster_ent.name = "Thruster"
                 component.thrusters.add_ref_to(thruster_ent)
+                created.append(thruster)
+
+            # Solve the allocations for the layout now, if it's new.
+            component.layout = get_layout(created)
+            self.solver.get_table(component.layout)
+
+    def on_load(self):
+        """ Solve the allocations for the layouts of the loaded entities. """
+        entity_manager = self.game_services.get_entity_manager()
+        for entity in entity_manager.query_include_queued(Thrusters):
+            layout = entity.get_component(Thrusters).layout
+            if layout is not None:
+                self.solver.get_table(layout)
 
     def update(self, dt):
         """ Update the entities. """
@@ -594,123 +1099,24 @@ class ThrustersSystem(ComponentSystem):
             # Fire thrusters to achieve desired spin and direction.
             self.fire_correct_thrusters(thrusters, thrusters.direction, turn)
 
-    def compute_correct_thrusters(self, thrusters, direction, turn):
+    def fire_correct_thrusters(self, thrusters, direction, turn):
         """ Perform logic to determine what engines are firing based on the
-        desired direction. Automatically counteract spin. We cope with an
-        arbitrary configuration of thrusters through use of a mathematical
-        optimisation algorithm (scipy.optimize.minimize.)
-
-        Variables: t0, t1, t2, ...
-        Function: g . f where
-                  f(t0, t1, t2, ...) -> (acceleration, moment)
-                  g(acceleration, moment) -> distance from desired (accel, moment)
-        Constraint: t0min <= t0 <= t0max, ...
-
-        Note: there may be a better way of solving this problem, I
-        don't know. I will try to state the problem clearly here so
-        that a better solution might present itself:
-
-        Note: notation a little odd in the following:
-
-        We have a set of N thrusters, (Tn, Dn, Pn, TMAXn), where "Tn" is
-        the thruster's current (scalar) thrust, Pn is its position,
-        and FMAXn is the maximum thrust it can exert. Dn is the direction
-        of thrust, so the force currently being exerted, Fn, is Tn*Dn.
-
-        The acceleration due to a given thruster:
-
-            An = m * Fn
-
-        where m is the mass of the body.
-
-        The centre of mass is the origin O.
-
-        The torque due to a given thruster is therefore
-
-            Qn = |Pn| * norm(orth(Pn)) * Fn.
-
-        The resultant force on the body, F', is F0+F1+...+Fn
-
-        The resultant torque on the body, Q', is Q0+Q1+...+Qn
-
-        The following constraints are in effect:
-
-            T0 >= 0, T1 >= 0, ..., Tn >= 0
-
-            T0 <= TMAX0, T1 <= TMAX1, Tn <= TMAXn
-
-        In my implementation here, the vector T0..n is the input array for a
-        function to be minimised.
-
-        Note that this function is very slow. Some sort of caching scheme will be
-        a must - and it would be good to share identical configurations between
-        entities.
-
-        I don't know whether there is an analytical solution to this problem.
-
-        """
-
-        def f(thrusts):
-            """ Objective function. Determine the resultant force and torque on
-            the body, and then apply heuristics (absolute guesswork!!) to determine
-            the fitness. We can then use a minimisation algorithm to optimise the
-            thruster configuration. """
-
-            # Calculate the resultant force and moment from applying all thrusters.
-            resultant_force = Vec2d(0, 0);
-            resultant_moment = 0
-            for i in range(0, len(thrusts)):
-                thruster = thrusters.thrusters[i].get_component(Thruster)
-                thrust = float(thrusts[i])
-                force = thruster.direction * thrust
-                resultant_force += force
-                resultant_moment += thruster.position.length * thruster.position.perpendicular_normal().dot(force)
-
-            # We want to maximise the force in the direction in which we want to
-            # be thrusting.
-            force_objective = direction.normalized().dot(resultant_force)
-
-            # We want to maximise the torque in the direction we want.
-            moment_objective = numpy.sign(turn) * resultant_moment
-
-            # We negate the values because we want to *minimise*
-            return -force_objective - moment_objective
-
-        # Initial array of values.
-        thrusts = numpy.zeros(len(thrusters.thrusters))
-
-        # Thrust bounds.
-        thrust_bounds = [(0, thruster.get_component(Thruster).max_thrust) for thruster in thrusters.thrusters]
-
-        # Optimise the thruster values.
-        return scipy.optimize.minimize(f, thrusts, method="TNC", bounds=thrust_bounds)
-
-    def fire_correct_thrusters(self, thrusters, direction, torque):
-        """ Perform logic to determine what engines are firing based on the
-        desired direction. Automatically counteract spin. """
+        desired direction and turn: see thrusters.py. """
 
         # If no thrusters to fire then don't bother!
         if len(thrusters.thrusters) == 0:
             return
 
-        # By default the engines should be off.
-        for entity in thrusters.thrusters:
-            thruster = entity.get_component(Thruster)
-            thruster.thrust = 0
-
-        # Come up with a dictionary key.
-        key = (direction.x, direction.y, torque, len(thrusters.thrusters))
-
-        # Ensure a configuration exists for this input.
-        if not key in thrusters.thruster_configurations:
-            thrusters.thruster_configurations[key] = \
-                self.compute_correct_thrusters(thrusters, direction, torque)
+        # The layout changes if thrusters are lost.
+        if thrusters.layout is None or \
+           len(thrusters.layout) != len(thrusters.thrusters):
+            thrusters.layout = get_layout(
+                [e.get_component(Thruster) for e in thrusters.thrusters])
 
-        # Get the cached configuration and set the thrust.
-        result = thrusters.thruster_configurations[key]
-        for i in range(0, len(result.x)):
-            thruster = thrusters.thrusters[i].get_component(Thruster)
-            thruster.thrust = float(result.x[i])
+        # Get the shared allocation and set the thrust.
+        thrusts = self.solver.get_thrusts(thrusters.layout, direction, turn)
+        for (entity, thrust) in zip(thrusters.thrusters, thrusts):
+            entity.get_component(Thruster).thrust = thrust
 
 
 class WaveSpawnerSystem(ComponentSystem):
@@ -801,7 +1207,8 @@ class CameraSystem(ComponentSystem):
 
     def __init__(self):
         """ Initialise the system. """
-        ComponentSystem.__init__(self, [Camera, Body])
+        ComponentSystem.__init__(self, [Camera, Body], reads=[Body],
+                                 writes=[Camera])
 
     def apply_shake(self, shake_factor, position):
         """ Apply a screen shake effect. """
@@ -835,14 +1242,47 @@ class CameraSystem(ComponentSystem):
 
 
 class TurretSystem(ComponentSystem):
-    """ Manage entities that are turrets. """
-
-    def __init__(self):
+    """ Manage entities that are turrets.
+
+    A turret only starts shooting if its line of sight isn't blocked by
+    something friendly.  The result of each turret's last line of sight check
+    is cached along with its target (if any), and is reused for up to
+    'line_of_sight_frames' frames, as long as the target is the same, neither
+    the turret nor its target has moved further than 'line_of_sight_tolerance',
+    the turret hasn't turned by more than 'line_of_sight_angle' degrees, and
+    whatever was hit is still alive. """
+
+    def __init__(self, line_of_sight_frames=10, line_of_sight_tolerance=5,
+                 line_of_sight_angle=5):
         """ Constructor. """
         ComponentSystem.__init__(self, [Turret])
+        self.line_of_sight_frames = line_of_sight_frames
+        self.line_of_sight_tolerance = line_of_sight_tolerance
+        self.line_of_sight_angle = line_of_sight_angle
+        self.line_of_sight_stats = CacheStats()
+
+        # The last line of sight check of each turret: (frame, handle of the
+        # target, aim, handle of the entity hit, whether clear.)  Handles are
+        # kept rather than entities since entities are reused.
+        self.__line_of_sight = {}
+        self.__frame = 0
+
+    def on_component_remove(self, component):
+        """ Forget the line of sight of a removed turret. """
+        self.__line_of_sight.pop(component.entity, None)
+
+    def on_load(self):
+        """ Forget all of the lines of sight. """
+        self.__line_of_sight = {}
 
     def update(self, dt):
         """ Update the system. """
+
+        self.__frame += 1
+
+        # The turrets that are ready to shoot, if they have a clear shot.
+        ready = []
+
         for entity in self.entities():
 
             # Kill detached turrets
@@ -869,6 +1309,7 @@ class TurretSystem(ComponentSystem):
             # Get the tracked body.  Note the special case for the player. This
             # could be made more elegant!
             shooting_at = turret.shooting_at
+            tracked = None
             if shooting_at is None and turret.attached_to.entity.get_component(Player) is None:
                 # Get tracked entity.
                 tracking = entity.get_component(Tracking)
@@ -890,15 +1331,80 @@ class TurretSystem(ComponentSystem):
                     turret.fire_timer.reset()
                     turret.can_shoot = True
                 if turret.can_shoot:
-                    (hit_entity, hit_point, hit_normal) = hit_scan(entity)
-                    if hit_entity is None or not on_same_team(entity, hit_entity):
-                        turret.can_shoot = False
-                        gun.shooting_at = shooting_at
+                    ready.append((entity, turret, gun, shooting_at, tracked))
             else:
                 if turret.burst_timer.tick(dt):
                     turret.burst_timer.reset()
                     gun.shooting_at = None
 
+        # Shoot if nothing friendly is in the way.
+        clear = self.check_line_of_sight([(r[0], r[4]) for r in ready])
+        for (i, (entity, turret, gun, shooting_at, tracked)) in enumerate(ready):
+            if clear[i]:
+                turret.can_shoot = False
+                gun.shooting_at = shooting_at
+
+    def check_line_of_sight(self, turrets):
+        """ Check whether each of a list of (turret, target) pairs has a clear
+        shot: that there is nothing friendly in front of the turret.  The
+        target can be None.  Cached results are used where possible, and the
+        rest are hit scanned in one batch. """
+        clear = [False] * len(turrets)
+        aims = []
+        scans = []
+        for (i, (entity, target)) in enumerate(turrets):
+            aim = self.__aim_of(entity, target)
+            aims.append(aim)
+            target_handle = target.handle if target is not None else None
+            cached = self.__line_of_sight.get(entity)
+            if cached is not None and cached[1] == target_handle and \
+               self.__frame - cached[0] <= self.line_of_sight_frames and \
+               (cached[3] is None or entity.handles.is_valid(cached[3])) and \
+               self.__aim_close(cached[2], aim):
+                clear[i] = cached[4]
+                self.line_of_sight_stats.hits += 1
+            else:
+                scans.append(i)
+                self.line_of_sight_stats.misses += 1
+        if len(scans) == 0:
+            return clear
+        entities = [turrets[i][0] for i in scans]
+        hit_entities = hit_scan_batch(entities)[0]
+        teams = self.game_services.get_entity_manager().get_system(TeamSystem)
+        scan_clear = numpy.equal(hit_entities, None) | \
+            hostile(teams.team_ids(entities), teams.team_ids(hit_entities))
+        for (j, i) in enumerate(scans):
+            (entity, target) = turrets[i]
+            clear[i] = bool(scan_clear[j])
+            hit = hit_entities[j]
+            self.__line_of_sight[entity] = (
+                self.__frame,
+                target.handle if target is not None else None,
+                aims[i],
+                hit.handle if hit is not None else None,
+                clear[i]
+            )
+        return clear
+
+    def __aim_of(self, entity, target):
+        """ Get the position and orientation of a turret, and the position of
+        its target (or the turret's position if it has none.) """
+        body = entity.get_component(Body)
+        target_body = target.get_component(Body) if target is not None else None
+        if target_body is None:
+            target_body = body
+        return (body.position.x, body.position.y,
+                target_body.position.x, target_body.position.y,
+                body.orientation)
+
+    def __aim_close(self, aim1, aim2):
+        """ Is one aim within tolerance of another? """
+        for k in range(4):
+            if abs(aim1[k] - aim2[k]) > self.line_of_sight_tolerance:
+                return False
+        turn = (aim1[4] - aim2[4] + 180) % 360 - 180
+        return abs(turn) <= self.line_of_sight_angle
+
 
 class TurretsSystem(ComponentSystem):
     """ Manages entities that have a set of turrets attached to them. """
@@ -956,14 +1462,22 @@ class TurretsSystem(ComponentSystem):
             turret_body.position = local_to_world(body.entity, turret.position)
             turret_body.velocity = body.velocity
 
-            # Pin the bodies together.
-            joint_entity = component.entity.ecs().create_entity()
-            joint = Joint(joint_entity, self.game_services, Config())
-            joint.entity_a.entity = component.entity
-            joint.entity_a_local_point = turret.position
-            joint.entity_b.entity = turret_entity
-            joint.entity_b_local_point = Vec2d(0, 0)
-            joint_entity.add_component(joint)
+            # Attach the turret to the body. If the ship is 'compound' then
+            # the turret becomes part of the ship's body, otherwise the
+            # bodies are pinned together.
+            if component.config.get_or_default("compound", False):
+                attachment = RigidAttachment(turret_entity, self.game_services, Config())
+                attachment.parent.entity = component.entity
+                attachment.position = turret.position
+                turret_entity.add_component(attachment)
+            else:
+                joint_entity = component.entity.ecs().create_entity()
+                joint = Joint(joint_entity, self.game_services, Config())
+                joint.entity_a.entity = component.entity
+                joint.entity_a_local_point = turret.position
+                joint.entity_b.entity = turret_entity
+                joint.entity_b_local_point = Vec2d(0, 0)
+                joint_entity.add_component(joint)
 
             
 class SolarSystem(ComponentSystem):
@@ -971,7 +1485,8 @@ class SolarSystem(ComponentSystem):
 
     def __init__(self):
         """ Constructor. """
-        ComponentSystem.__init__(self, [CelestialBody, Body])
+        ComponentSystem.__init__(self, [CelestialBody, Body],
+                                 reads=[CelestialBody], writes=[Body])
 
     def update(self, dt):
         """ Update the system. """
@@ -990,7 +1505,8 @@ class PlayerSystem(ComponentSystem):
 
     def __init__(self):
         """ Constructor """
-        ComponentSystem.__init__(self, [Player, Body])
+        ComponentSystem.__init__(self, [Player, Body], reads=[Player],
+                                 writes=[Body])
 
     def update(self, dt):
         """ Update the player ship. """
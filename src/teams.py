@@ -0,0 +1,135 @@
+"""
+Team resolution.
+
+An entity is on a team if it has a Team component.  A Team can have a parent,
+in which case the entity is on its parent's team (if the parent has one), so
+e.g. a bullet is on the team of the ship that fired it.  Working out an entity's
+team means walking up the chain of parents.
+
+The TeamSystem caches the result for each entity as an integer team id, where 0
+means no team.  A cached id stays valid until the team or parent of one of the
+Teams that it was resolved through changes (which increments its version), or
+one of the entities that it was resolved through dies or loses its Team.
+
+Team ids can be compared in bulk: team_ids() gets the ids of a list of
+entities as an array, and hostile() tests arrays of ids against one another.
+The TeamSystem also keeps the 'team_id' field of each Team component up to date
+each frame, so if Team components are stored in a table, the column of ids can
+be used directly.  When an entity's team id changes, the physics system is told
+to configure its shape again, since its collision group is its team id.
+"""
+
+
+from .ecs import ComponentSystem
+from .components import Team
+from .physics import Physics
+
+import numpy
+
+
+# The id of 'no team'.  Entities without a team are friendly to everyone.
+NO_TEAM = 0
+
+
+def resolve_team(entity):
+    """ Walk up the Team parents of an entity to find its team.  Returns the
+    team (or None) and the entities and Team components that were visited. """
+    team = None
+    visited = []
+    while entity is not None:
+        component = entity.get_component(Team)
+        if component is None:
+            break
+        visited.append((entity, component))
+        if component.team is not None:
+            team = component.team
+        entity = component.parent.entity
+    return (team, visited)
+
+
+def hostile(team_ids1, team_ids2):
+    """ Are entities with the given team ids hostile to one another?  Works
+    for single ids and for arrays of ids, which are broadcast together. """
+    return (team_ids1 != team_ids2) & \
+           (team_ids1 != NO_TEAM) & \
+           (team_ids2 != NO_TEAM)
+
+
+class TeamSystem(ComponentSystem):
+    """ Resolves and caches the teams of entities. """
+
+    def __init__(self):
+        """ Constructor. """
+        ComponentSystem.__init__(self, [Team], reads=[Team], writes=[Team])
+
+        # Team ids, by team name, and team names, by id.
+        self.__ids = {None: NO_TEAM}
+        self.__names = [None]
+
+        # The cached team of each entity: (team id, (handle, Team, version) of
+        # each entity that the team was resolved through.)
+        self.__cache = {}
+
+    def update(self, dt):
+        """ Update the team ids of the Team components, and tell the physics
+        system about entities whose collision groups have changed. """
+        physics = self.game_services.get_entity_manager().get_system(Physics)
+        for entity in self.entities():
+            component = entity.get_component(Team)
+            team_id = self.get_team_id(entity)
+            if team_id != component.team_id:
+                component.team_id = team_id
+                if physics is not None:
+                    physics.reconfigure(entity)
+
+    def on_component_remove(self, component):
+        """ Forget the team of an entity losing its Team component, and of
+        any entities that were resolved through it. """
+        self.__cache.pop(component.entity, None)
+        component.version += 1
+
+    def on_load(self):
+        """ Forget all of the cached teams. """
+        self.__cache = {}
+
+    def get_id_for_team(self, team):
+        """ Get the id of a team name, allocating one if it is new. """
+        team_id = self.__ids.get(team)
+        if team_id is None:
+            team_id = len(self.__names)
+            self.__ids[team] = team_id
+            self.__names.append(team)
+        return team_id
+
+    def get_team_for_id(self, team_id):
+        """ Get the name of the team with an id. """
+        return self.__names[team_id]
+
+    def get_team_id(self, entity):
+        """ Get the id of an entity's team. """
+        cached = self.__cache.get(entity)
+        if cached is not None:
+            generations = entity.handles.generations
+            for (handle, component, version) in cached[1]:
+                if generations[handle[0]] != handle[1] or \
+                   component.version != version:
+                    break
+            else:
+                return cached[0]
+        (team, visited) = resolve_team(entity)
+        if len(visited) == 0:
+            return NO_TEAM
+        team_id = self.get_id_for_team(team)
+        self.__cache[entity] = (team_id, tuple((e.handle, c, c.version)
+                                               for (e, c) in visited))
+        return team_id
+
+    def get_team(self, entity):
+        """ Get the name of an entity's team, or None. """
+        return self.__names[self.get_team_id(entity)]
+
+    def team_ids(self, entities):
+        """ Get an array of the team ids of some entities.  Entries that are
+        None have no team. """
+        return numpy.array([NO_TEAM if e is None else self.get_team_id(e)
+                            for e in entities], int)
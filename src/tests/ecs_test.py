@@ -1,5 +1,9 @@
 import unittest
 from ..ecs import *
+from ..utils import Vec2d
+import pickle
+import json
+import StringIO
 from testing import *
 
 
@@ -37,6 +41,15 @@ class MockComponent2(Component):
     pass
 
 
+class MockColumnComponent(Component):
+    value = Column("value")
+    position = VectorColumn("position")
+    def __init__(self, entity, game_services, config):
+        Component.__init__(self, entity, game_services, config)
+        self.value = config.get_or_default("value", 0)
+        self.position = Vec2d(0, 0)
+
+
 class EntityManagerTest(unittest.TestCase):
 
     def test_create_queued_objects(self):
@@ -60,6 +73,18 @@ class EntityManagerTest(unittest.TestCase):
         entman.update(0)
         assert not entity in entman.query(MockComponent) # removed now
 
+    def test_garbage_collect__queued(self):
+        """ Should drop entities that are killed before they are created. """
+        game_services = create_entman_testing_services()
+        entman = game_services.get_entity_manager()
+        entity = entman.create_entity_with(MockComponent)
+        entity.kill()
+        entity.kill() # Killing twice is harmless.
+        entman.update(0)
+        assert not entity in entman.query_include_queued(MockComponent)
+        entman.create_queued_objects()
+        assert not entity in entman.query(MockComponent)
+
     def test_create_entity(self):
         """ Should create an entity in the 'new' set. """
         game_services = create_entman_testing_services()
@@ -79,6 +104,45 @@ class EntityManagerTest(unittest.TestCase):
         assert component is not None
         assert isinstance(component, MockComponent)
 
+    def test_create_entities(self):
+        """ Should compile a config once and create entities from it. """
+        game_services = create_entman_testing_services()
+        entman = game_services.get_entity_manager()
+        config = Config({"components": {
+            "src.tests.ecs_test.MockComponent": {},
+            "src.tests.ecs_test.MockComponent2": {}
+        }})
+        prototype = entman.get_prototype(config)
+        self.assertEquals(entman.get_prototype(config), prototype)
+        self.assertEquals(len(prototype.components), 2)
+        entities = entman.create_entities(prototype, 3)
+        entman.create_queued_objects()
+        self.assertEquals(len(entities), 3)
+        self.assertEquals(len(entman.query(MockComponent, MockComponent2)), 3)
+
+    def test_create_entity__pooled(self):
+        """ The components of dead pooled entities should be reused. """
+        game_services = create_entman_testing_services()
+        entman = game_services.get_entity_manager()
+        config = Config({"pool": 1, "components": {
+            "src.tests.ecs_test.MockComponent": {}
+        }})
+        entity = entman.create_entity(config)
+        component = entity.get_component(MockComponent)
+        component.last_dt = 1
+        entman.create_queued_objects()
+        entity.kill()
+        entman.update(0)
+        self.assertEquals(entman.pool_stats.size, 1)
+        entity2 = entman.create_entity(config)
+        self.assertEquals(entity2.get_component(MockComponent), component)
+        self.assertEquals(component.entity, entity2)
+        self.assertEquals(component.last_dt, 0)
+        self.assertEquals(entman.pool_stats.hits, 1)
+        self.assertEquals(entman.pool_stats.misses, 1)
+        self.assertEquals(entman.pool_stats.peak_size, 1)
+        self.assertEquals(entman.pool_stats.size, 0)
+
     def test_register_component_system(self):
         """ Should register the component system and set it up. """
 
@@ -153,6 +217,360 @@ class EntityManagerTest(unittest.TestCase):
         assert not entity in entman.query_include_queued(MockComponent)
 
 
+    def test_query_view(self):
+        """ A query view should track entities as they are created, gain and
+        lose components, and die. """
+        game_services = create_entman_testing_services()
+        entman = game_services.get_entity_manager()
+        view = entman.query_view(MockComponent, MockComponent2)
+        entered = []
+        exited = []
+        view.subscribe(entered.append, exited.append)
+        entity = entman.create_entity_with(MockComponent, MockComponent2)
+        assert not entity in view # queued
+        entman.create_queued_objects()
+        assert entity in view
+        self.assertEquals(view.entities(), (entity,))
+        entman.remove_component_by_concrete_type(entity, MockComponent2)
+        assert not entity in view
+        entman.create_component(entity, MockComponent2)
+        assert entity in view
+        entity.kill()
+        entman.update(0)
+        assert not entity in view
+        self.assertEquals(entered, [entity, entity])
+        self.assertEquals(exited, [entity, entity])
+
+
+    def test_query__cached(self):
+        """ A query should return the same tuple until its result changes. """
+        game_services = create_entman_testing_services()
+        entman = game_services.get_entity_manager()
+        entman.create_entity_with(MockComponent)
+        entman.create_queued_objects()
+        entities = entman.query(MockComponent)
+        self.assertTrue(entman.query(MockComponent) is entities)
+        entman.create_entity_with(MockComponent)
+        entman.create_queued_objects()
+        self.assertEquals(len(entman.query(MockComponent)), 2)
+
+    def test_notifications(self):
+        """ Only systems interested in a component type should be notified,
+        and the notifications should be counted. """
+        game_services = create_entman_testing_services()
+        entman = game_services.get_entity_manager()
+        system = MockSystem()
+        entman.register_component_system(system)
+        entity = entman.create_entity_with(MockComponent, MockComponent2)
+        component = entity.get_component(MockComponent)
+        self.assertEquals(component.added, 1)
+        entity.kill()
+        entman.update(0)
+        self.assertEquals(component.removed, 1)
+        self.assertEquals(entman.last_frame_notifications, 2)
+        entman.update(0)
+        self.assertEquals(entman.last_frame_notifications, 0)
+
+    def test_handles(self):
+        """ Handles should be invalidated when an entity dies or loses a
+        component, and their slots reused after garbage collection. """
+        game_services = create_entman_testing_services()
+        entman = game_services.get_entity_manager()
+        entity = entman.create_entity_with(MockComponent, MockComponent2)
+        handle = entity.handle
+        self.assertTrue(entman.is_alive(handle))
+        self.assertEquals(entman.get_entity(handle), entity)
+        entman.remove_component_by_concrete_type(entity, MockComponent2)
+        self.assertFalse(entman.is_alive(handle))
+        self.assertTrue(entman.is_alive(entity.handle))
+        handle = entity.handle
+        entity.kill()
+        self.assertFalse(entman.is_alive(handle))
+        self.assertEquals(entman.get_entity(handle), None)
+        entman.update(0)
+        entity2 = entman.create_entity_with(MockComponent)
+        self.assertEquals(entity2.handle[0], handle[0])
+        self.assertFalse(entman.is_alive(handle))
+
+    def test_entity_ref(self):
+        """ A reference should reset when its entity dies or loses one of
+        the referenced component types. """
+        game_services = create_entman_testing_services()
+        entman = game_services.get_entity_manager()
+        entity = entman.create_entity_with(MockComponent, MockComponent2)
+        ref = EntityRef(entity, MockComponent2)
+        refs = EntityRefList(MockComponent)
+        refs.add_ref_to(entity)
+        self.assertEquals(ref.entity, entity)
+        self.assertEquals(ref.entity, entity)
+        entman.remove_component_by_concrete_type(entity, MockComponent2)
+        self.assertEquals(ref.entity, None)
+        self.assertEquals(list(refs), [entity])
+        entity.kill()
+        self.assertEquals(len(refs), 0)
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def test_update(self):
+        """ Updates should be measured when instrumentation is on. """
+        game_services = create_entman_testing_services()
+        entman = game_services.get_entity_manager()
+        entman.register_component_system(MockSystem())
+        self.assertEquals(entman.instrumentation, None)
+        entman.set_instrumented(True, 2)
+        entity = entman.create_entity_with(MockComponent)
+        entman.create_queued_objects()
+        entman.update(0)
+        entity.kill()
+        entman.update(0)
+        entman.update(0)
+        instrumentation = entman.instrumentation
+        self.assertEquals(list(instrumentation.entity_counts), [0, 0])
+        self.assertEquals(list(instrumentation.components_destroyed), [1, 0])
+        self.assertEquals(list(instrumentation.system_entities["MockSystem"]), [1, 0])
+        (name, time, entities) = instrumentation.breakdown()[0]
+        self.assertEquals(name, "MockSystem")
+        self.assertEquals(entities, 0.5)
+
+    def test_export(self):
+        """ Measurements should be exported as a row per frame. """
+        instrumentation = Instrumentation()
+        instrumentation.record_frame(1, 2, 3)
+        instrumentation.record_system("A", 0.5, 4)
+        instrumentation.record_frame(5, 6, 7)
+        rows = instrumentation.rows()
+        self.assertEquals(rows[0].get("A_time"), None)
+        self.assertEquals(rows[1]["A_time"], 0.5)
+        self.assertEquals(rows[1]["A_entities"], 4)
+        output = StringIO.StringIO()
+        instrumentation.export_csv(output)
+        lines = output.getvalue().splitlines()
+        self.assertEquals(lines[0], "entities,components_created,components_destroyed,A_time,A_entities")
+        self.assertEquals(len(lines), 3)
+        output = StringIO.StringIO()
+        instrumentation.export_json(output)
+        self.assertEquals(json.loads(output.getvalue())[1]["entities"], 5)
+
+
+class MockKillingSystem(ComponentSystem):
+    def __init__(self, component_type):
+        ComponentSystem.__init__(self, [component_type], writes=[component_type])
+        self.alive_after_kill = []
+    def update(self, dt):
+        entman = self.game_services.get_entity_manager()
+        for e in self.entities():
+            e.kill()
+            self.alive_after_kill.append(entman.is_alive(e.handle))
+
+
+class MockCreatingSystem(ComponentSystem):
+    """ Creates an entity with a MockComponent2, and swaps the MockComponent
+    of its entities for a MockColumnComponent. """
+    def __init__(self):
+        ComponentSystem.__init__(self, [MockComponent], writes=[MockComponent])
+        self.created = []
+        self.returned = []
+    def update(self, dt):
+        entman = self.game_services.get_entity_manager()
+        def setup(entity):
+            entity.add_component(MockComponent2(entity, self.game_services,
+                                                Config()))
+            self.created.append(entity)
+        self.returned.append(entman.create_entity(None, setup))
+        for e in self.entities():
+            entman.remove_component_by_concrete_type(e, MockComponent)
+            e.add_component(MockColumnComponent(e, self.game_services, Config()))
+            self.returned.append(len(entman.query(MockComponent)))
+
+
+class MockRacingKillSystem(ComponentSystem):
+    """ Kills entities as if it had raced another system to kill them. """
+    def __init__(self):
+        ComponentSystem.__init__(self, [MockComponent], reads=[MockComponent],
+                                 writes=[])
+    def update(self, dt):
+        for e in self.entities():
+            self.game_services.get_entity_manager().on_entity_killed(e)
+
+
+class SystemSchedulerTest(unittest.TestCase):
+
+    def test_stages(self):
+        """ Consecutive systems that don't conflict should share a stage. """
+        a = ComponentSystem([], writes=[MockComponent])
+        b = ComponentSystem([], reads=[MockComponent], writes=[MockComponent2])
+        c = ComponentSystem([], writes=[MockColumnComponent])
+        d = ComponentSystem([])
+        e = ComponentSystem([], writes=[])
+        stages = SystemScheduler.stages([a, b, c, d, e])
+        self.assertEquals(stages, [[a], [b, c], [d], [e]])
+
+    def test_update__threaded(self):
+        """ Kills made by concurrently updated systems should be deferred
+        until the stage is complete. """
+        game_services = create_entman_testing_services()
+        entman = game_services.get_entity_manager()
+        entman.register_component_system(MockKillingSystem(MockComponent))
+        entman.register_component_system(MockKillingSystem(MockComponent2))
+        entman.set_system_threads(2)
+        entity1 = entman.create_entity_with(MockComponent)
+        entity2 = entman.create_entity_with(MockComponent2)
+        entman.create_queued_objects()
+        entman.update(0)
+        assert entity1.is_garbage
+        assert entity2.is_garbage
+        self.assertEquals(len(entman.query(MockComponent)), 0)
+        self.assertEquals(len(entman.query(MockComponent2)), 0)
+        self.assertFalse(entman.is_alive(entity1.handle))
+        entman.set_system_threads(0)
+
+    def test_update__threaded_create(self):
+        """ Entities created and components added and removed by concurrently
+        updated systems should be deferred until the stage is complete. """
+        game_services = create_entman_testing_services()
+        entman = game_services.get_entity_manager()
+        system = MockCreatingSystem()
+        entman.register_component_system(system)
+        entman.register_component_system(MockKillingSystem(MockComponent2))
+        entman.set_system_threads(2)
+        entity = entman.create_entity_with(MockComponent)
+        entman.create_queued_objects()
+        entman.update(0)
+        entman.set_system_threads(0)
+        self.assertEquals(system.returned, [None, 1])
+        self.assertEquals(len(system.created), 1)
+        self.assertTrue(system.created[0].has_component(MockComponent2))
+        self.assertFalse(entity.has_component(MockComponent))
+        self.assertTrue(entity.has_component(MockColumnComponent))
+        entman.create_queued_objects()
+        self.assertEquals(list(entman.query(MockComponent2)), system.created)
+
+    def test_update__threaded_handles(self):
+        """ Entities killed during a stage should be dead to references at
+        once. """
+        game_services = create_entman_testing_services()
+        entman = game_services.get_entity_manager()
+        system = MockKillingSystem(MockComponent)
+        entman.register_component_system(system)
+        entman.register_component_system(MockKillingSystem(MockComponent2))
+        entman.set_system_threads(2)
+        entman.create_entity_with(MockComponent)
+        entman.create_queued_objects()
+        entman.update(0)
+        self.assertEquals(system.alive_after_kill, [False])
+        entman.set_system_threads(0)
+
+    def test_update__threaded_double_kill(self):
+        """ An entity killed by two systems in the same stage should only be
+        removed once. """
+        game_services = create_entman_testing_services()
+        entman = game_services.get_entity_manager()
+        entman.register_component_system(MockRacingKillSystem())
+        entman.register_component_system(MockRacingKillSystem())
+        entman.set_system_threads(2)
+        entity = entman.create_entity_with(MockComponent)
+        entman.create_queued_objects()
+        entman.update(0)
+        entman.update(0)
+        entman.set_system_threads(0)
+        self.assertEquals(len(entman.query(MockComponent)), 0)
+        entity1 = entman.create_entity_with(MockComponent)
+        entity2 = entman.create_entity_with(MockComponent)
+        self.assertNotEquals(entity1.handle[0], entity2.handle[0])
+
+
+class ComponentStoreTest(unittest.TestCase):
+
+    def test_query_entities(self):
+        """ Should return the entities with all of the queried types. """
+        game_services = create_entman_testing_services()
+        store = ComponentStore()
+        e1 = Entity(game_services)
+        e2 = Entity(game_services)
+        e3 = Entity(game_services)
+        store.add(e1, MockComponent(e1, game_services, Config()))
+        store.add(e2, MockComponent(e2, game_services, Config()))
+        store.add(e2, MockComponent2(e2, game_services, Config()))
+        store.add(e3, MockComponent2(e3, game_services, Config()))
+        self.assertEquals(set(store.query_entities(MockComponent)), set([e1, e2]))
+        self.assertEquals(set(store.query_entities(MockComponent2)), set([e2, e3]))
+        self.assertEquals(store.query_entities(MockComponent, MockComponent2), [e2])
+        self.assertEquals(set(store.iter_entities(MockComponent)), set([e1, e2]))
+        self.assertEquals(list(store.iter_entities(MockComponent, MockComponent2)),
+                          [e2])
+
+    def test_query_entities__changing_archetype(self):
+        """ Adding and removing components should move entities between
+        archetypes. """
+        game_services = create_entman_testing_services()
+        store = ComponentStore()
+        e1 = Entity(game_services)
+        store.add(e1, MockComponent(e1, game_services, Config()))
+        self.assertEquals(store.query_entities(MockComponent, MockComponent2), [])
+        store.add(e1, MockComponent2(e1, game_services, Config()))
+        self.assertEquals(store.query_entities(MockComponent, MockComponent2), [e1])
+        store.remove(e1, MockComponent)
+        self.assertEquals(store.query_entities(MockComponent, MockComponent2), [])
+        self.assertEquals(store.query_entities(MockComponent2), [e1])
+        assert store.get(e1, MockComponent) is None
+        store.remove(e1, MockComponent2)
+        self.assertEquals(store.query_entities(MockComponent2), [])
+        self.assertEquals(store.get_all_components(e1), [])
+
+
+class ComponentTableTest(unittest.TestCase):
+
+    def create_components(self, store, n):
+        """ Create entities with column components in a store. """
+        game_services = create_entman_testing_services()
+        ret = []
+        for i in range(n):
+            entity = Entity(game_services)
+            component = MockColumnComponent(entity, game_services, Config({"value": i}))
+            store.add(entity, component)
+            ret.append(component)
+        return ret
+
+    def test_columns(self):
+        """ Column values should be stored in the table. """
+        store = ComponentStore(columnar=True)
+        components = self.create_components(store, 100)
+        table = store.get_table(MockColumnComponent)
+        self.assertEquals(table.count, 100)
+        self.assertEquals(list(table.column("value")), range(100))
+        table.column("value")[:] += 1
+        self.assertEquals(components[10].value, 11)
+        components[10].position = Vec2d(1, 2)
+        self.assertEquals(table.column("position")[10][1], 2)
+        assert store.get_table(MockComponent) is None
+        assert ComponentStore().get_table(MockColumnComponent) is None
+
+    def test_remove(self):
+        """ Removing a component should move the last row into its place and
+        give the component its values back. """
+        store = ComponentStore(columnar=True)
+        components = self.create_components(store, 3)
+        table = store.get_table(MockColumnComponent)
+        store.remove(components[0].entity, MockColumnComponent)
+        self.assertEquals(table.count, 2)
+        self.assertEquals(components[0].value, 0)
+        assert components[0]._table is None
+        self.assertEquals(components[2]._row, 0)
+        self.assertEquals(components[2].value, 2)
+        self.assertEquals(list(table.column("value")), [2, 1])
+
+    def test_pickle(self):
+        """ Pickled components should contain their column values. """
+        store = ComponentStore(columnar=True)
+        components = self.create_components(store, 3)
+        components[1].position = Vec2d(3, 4)
+        state = components[1].__getstate__()
+        self.assertEquals(state["value"], 1)
+        self.assertEquals(state["position"], Vec2d(3, 4))
+        assert state["_table"] is None
+
+
 class ComponentSystemTest(unittest.TestCase):
 
     def create_system_and_component(self):
@@ -0,0 +1,566 @@
+import unittest
+import math
+import random
+import pymunk
+from ..physics import *
+from ..ecs import EntityManager
+from ..components import DamageOnContact, Team, RigidAttachment, Tracking
+from ..utils import Vec2d
+from ..config import Config
+from testing import *
+
+
+def create_physics_testing_services(columnar, config=None):
+    """ Create game services with an entity manager that has a physics
+    system. """
+    game_services = MockGameServices()
+    game_services.entity_manager = EntityManager(game_services, columnar)
+    game_services.entity_manager.register_component_system(Physics(config))
+    return game_services
+
+
+class PhysicsTest(unittest.TestCase):
+
+    def simulate(self, columnar):
+        """ Run a simulation in which bodies are created, pushed, moved and
+        killed, and return the final state of the bodies. """
+        game_services = create_physics_testing_services(columnar)
+        entman = game_services.get_entity_manager()
+        physics = entman.get_system(Physics)
+        entities = []
+        for i in range(4):
+            entity = entman.create_entity_with(Body)
+            body = entity.get_component(Body)
+            body.position = Vec2d(i*1000, 0)
+            body.velocity = Vec2d(0, i)
+            entities.append(entity)
+        for frame in range(20):
+            entman.create_queued_objects()
+            if frame == 5:
+                physics.apply_force_at_local_point(entities[1], Vec2d(0, 100), Vec2d(1, 0))
+            if frame == 8:
+                entities[2].get_component(Body).position = Vec2d(2000, 500)
+            if frame == 10:
+                entities[0].kill()
+            if frame == 12:
+                entity = entman.create_entity_with(Body)
+                entity.get_component(Body).position = Vec2d(-1000, 0)
+                entities.append(entity)
+            entman.update(1.0/60)
+        ret = []
+        for entity in entities[1:]:
+            body = entity.get_component(Body)
+            ret.append((tuple(body.position), tuple(body.velocity),
+                        body.orientation, body.angular_velocity))
+        return ret
+
+    def test_update__columnar(self):
+        """ Syncing with a Body table should give the same results as syncing
+        each body individually. """
+        expected = self.simulate(False)
+        got = self.simulate(True)
+        self.assertEquals(len(expected), len(got))
+        for (e, g) in zip(expected, got):
+            for (a, b) in zip(e, g):
+                self.assertEquals(a, b)
+
+
+class RecordingCollisionHandler(CollisionHandler):
+    """ Records the collisions that it sees. """
+
+    def __init__(self, t1=DamageOnContact, t2=Team, handled=True):
+        CollisionHandler.__init__(self, t1, t2)
+        self.collisions = []
+        self.handled = handled
+
+    def handle_matching_collision(self, c1, c2):
+        self.collisions.append((c1, c2))
+        return CollisionResult(self.handled, False)
+
+
+class CollisionTest(unittest.TestCase):
+
+    def setUp(self):
+        """ Create a physics system with a collision handler. """
+        game_services = create_physics_testing_services(False)
+        self.entman = game_services.get_entity_manager()
+        self.physics = self.entman.get_system(Physics)
+        self.handler = RecordingCollisionHandler()
+        self.physics.add_collision_handler(self.handler)
+
+    def create_pair(self, types1, types2):
+        """ Create two overlapping bodies. """
+        e1 = self.entman.create_entity_with(Body, *types1)
+        e2 = self.entman.create_entity_with(Body, *types2)
+        e2.get_component(Body).position = Vec2d(1, 0)
+        return (e1, e2)
+
+    def step(self):
+        self.entman.create_queued_objects()
+        self.entman.update(1.0/60)
+
+    def test_dispatch(self):
+        """ The handler should be given the components in its order. """
+        (e1, e2) = self.create_pair([Team], [DamageOnContact])
+        self.step()
+        self.step()
+        self.assertEquals(self.handler.collisions, [
+            (e2.get_component(DamageOnContact), e1.get_component(Team))
+        ])
+        self.assertEquals(e1.get_component(Body).position, Vec2d(0, 0))
+
+    def test_dispatch__unhandled(self):
+        """ Bodies without handled components should just collide. """
+        (e1, e2) = self.create_pair([], [DamageOnContact])
+        self.step()
+        self.step()
+        self.assertEquals(self.handler.collisions, [])
+        self.assertTrue(e1.get_component(Body).position.x < 0)
+
+    def test_dispatch__attached(self):
+        """ Contacts with an attached shape should be reported for the
+        attached entity. """
+        parent = self.entman.create_entity_with(Body)
+        child = self.entman.create_entity_with(Body, Team, RigidAttachment)
+        attachment = child.get_component(RigidAttachment)
+        attachment.parent.entity = parent
+        attachment.position = Vec2d(20, 0)
+        bullet = self.entman.create_entity_with(Body, DamageOnContact)
+        bullet.get_component(Body).position = Vec2d(22, 0)
+        self.step()
+        self.assertEquals(self.handler.collisions, [
+            (bullet.get_component(DamageOnContact), child.get_component(Team))
+        ])
+
+    def test_dispatch__existing_bodies(self):
+        """ Adding a handler should apply to bodies that already exist. """
+        handler = RecordingCollisionHandler()
+        handler.t1 = Team
+        handler.t2 = Team
+        (e1, e2) = self.create_pair([Team], [Team])
+        e2.get_component(Body).position = Vec2d(100, 0)
+        self.step()
+        self.physics.add_collision_handler(handler)
+        e2.get_component(Body).position = Vec2d(1, 0)
+        self.step()
+        self.assertEquals(len(handler.collisions), 1)
+
+    def test_dispatch__fall_through(self):
+        """ Handlers matching the same pair should be tried in turn until
+        one handles the contact. """
+        handler = RecordingCollisionHandler(DamageOnContact, Tracking)
+        self.physics.add_collision_handler(handler)
+        self.handler.handled = False
+        (e1, e2) = self.create_pair([Team, Tracking], [DamageOnContact])
+        self.step()
+        self.assertEquals(len(self.handler.collisions), 1)
+        self.assertEquals(handler.collisions, [
+            (e2.get_component(DamageOnContact), e1.get_component(Tracking))
+        ])
+
+    def test_reconfigure__component(self):
+        """ Gaining a handled component should make a body's contacts be
+        handled. """
+        (e1, e2) = self.create_pair([], [DamageOnContact])
+        e2.get_component(Body).position = Vec2d(100, 0)
+        self.step()
+        e1.add_component(Team(e1, e1.game_services, Config()))
+        e2.get_component(Body).position = Vec2d(1, 0)
+        self.step()
+        self.assertEquals(len(self.handler.collisions), 1)
+
+    def test_reconfigure__group(self):
+        """ A body should be put in its new group when asked. """
+        groups = {}
+        self.physics.set_collision_group_function(lambda e: groups.get(e, 0))
+        (e1, e2) = self.create_pair([Team], [DamageOnContact])
+        e2.get_component(Body).position = Vec2d(100, 0)
+        self.step()
+        groups[e1] = groups[e2] = 1
+        self.physics.reconfigure(e1)
+        self.physics.reconfigure(e2)
+        e2.get_component(Body).position = Vec2d(1, 0)
+        self.step()
+        self.assertEquals(self.handler.collisions, [])
+
+    def test_filter__group(self):
+        """ Bodies in the same group should not collide. """
+        (e1, e2) = self.create_pair([Team], [DamageOnContact])
+        e1.get_component(Body).collision_group = 1
+        self.physics.set_collision_group_function(lambda e: 1)
+        self.step()
+        self.step()
+        self.assertEquals(self.handler.collisions, [])
+        self.assertEquals(e1.get_component(Body).position, Vec2d(0, 0))
+
+    def test_filter__bullets(self):
+        """ Bullets should not collide with each other. """
+        (e1, e2) = self.create_pair([Team, DamageOnContact], [DamageOnContact])
+        e1.get_component(Body).collision_category = "bullet"
+        e2.get_component(Body).collision_category = "bullet"
+        self.step()
+        self.assertEquals(self.handler.collisions, [])
+
+    def test_filter__non_collideable(self):
+        """ Non-collideable bodies should not collide but should still be
+        found by queries. """
+        (e1, e2) = self.create_pair([Team], [DamageOnContact])
+        e1.get_component(Body).is_collideable = False
+        self.step()
+        self.assertEquals(self.handler.collisions, [])
+        self.assertEquals(self.physics.get_entity_at(Vec2d(-9.5, 0)), e1)
+        e1.get_component(Body).is_collideable = True
+        self.step()
+        self.assertEquals(len(self.handler.collisions), 1)
+
+
+class ForceTest(unittest.TestCase):
+
+    forces = [Vec2d(0, 100), Vec2d(50, 0), Vec2d(-20, 30)]
+    points = [Vec2d(1, 0), Vec2d(0, -2), Vec2d(3, 3)]
+
+    def expected_motion(self):
+        """ Get the motion of a pymunk body that has each force applied
+        separately. """
+        body = pymunk.Body(1, pymunk.moment_for_circle(1, 0, 5))
+        body.angle = math.radians(30)
+        space = pymunk.Space()
+        space.add(body, pymunk.Circle(body, 5))
+        for (force, point) in zip(self.forces, self.points):
+            body.apply_force_at_local_point(force, point)
+        space.step(1.0/60)
+        return (body.velocity, math.degrees(body.angular_velocity))
+
+    def check_forces(self, columnar):
+        """ Accumulated forces should move bodies as if they had been applied
+        separately. """
+        game_services = create_physics_testing_services(columnar)
+        entman = game_services.get_entity_manager()
+        physics = entman.get_system(Physics)
+        (e1, e2) = [entman.create_entity_with(Body) for i in range(2)]
+        e1.get_component(Body).orientation = 30
+        e2.get_component(Body).orientation = 30
+        e2.get_component(Body).position = Vec2d(100, 0)
+        entman.create_queued_objects()
+        for (force, point) in zip(self.forces, self.points):
+            physics.apply_force_at_local_point(e1, force, point)
+        physics.apply_forces_at_local_points([e2]*3, self.forces, self.points)
+        entman.update(1.0/60)
+        (velocity, angular_velocity) = self.expected_motion()
+        for entity in (e1, e2):
+            body = entity.get_component(Body)
+            self.assertAlmostEquals(body.velocity.x, velocity.x)
+            self.assertAlmostEquals(body.velocity.y, velocity.y)
+            self.assertAlmostEquals(body.angular_velocity, angular_velocity)
+            self.assertEquals(body.force, Vec2d(0, 0))
+            self.assertEquals(body.torque, 0)
+
+    def test_forces(self):
+        self.check_forces(False)
+
+    def test_forces__columnar(self):
+        self.check_forces(True)
+
+
+class RigidAttachmentTest(unittest.TestCase):
+
+    def create_bodies(self, columnar):
+        """ Create a spinning body with another attached to it. """
+        game_services = create_physics_testing_services(columnar)
+        self.entman = game_services.get_entity_manager()
+        self.physics = self.entman.get_system(Physics)
+        self.parent = self.entman.create_entity_with(Body)
+        body = self.parent.get_component(Body)
+        body.velocity = Vec2d(10, 0)
+        body.angular_velocity = 90
+        self.child = self.entman.create_entity_with(Body, RigidAttachment)
+        self.child.get_component(Body).orientation = 45
+        attachment = self.child.get_component(RigidAttachment)
+        attachment.parent.entity = self.parent
+        attachment.position = Vec2d(0, 20)
+
+    def step(self, frames):
+        for frame in range(frames):
+            self.entman.create_queued_objects()
+            self.entman.update(1.0/60)
+
+    def assertVectorsEqual(self, v1, v2):
+        self.assertAlmostEquals(v1[0], v2[0], places=6)
+        self.assertAlmostEquals(v1[1], v2[1], places=6)
+
+    def check_update(self, columnar):
+        """ The attached body should move with its parent. """
+        self.create_bodies(columnar)
+        self.step(30)
+        parent_body = self.parent.get_component(Body)
+        child_body = self.child.get_component(Body)
+        offset = self.physics.local_dir_to_world(self.parent, Vec2d(0, 20))
+        self.assertVectorsEqual(child_body.position,
+                                parent_body.position + offset)
+        spin = math.radians(parent_body.angular_velocity)
+        self.assertVectorsEqual(child_body.velocity,
+                                parent_body.velocity + offset.perpendicular() * spin)
+        self.assertAlmostEquals(child_body.orientation, 45)
+
+    def test_update(self):
+        self.check_update(False)
+
+    def test_update__columnar(self):
+        self.check_update(True)
+
+    def test_update__parent_killed(self):
+        """ The attached body should carry on by itself when its parent is
+        killed. """
+        self.create_bodies(False)
+        self.step(30)
+        self.parent.kill()
+        self.step(1)
+        child_body = self.child.get_component(Body)
+        position = Vec2d(child_body.position)
+        velocity = Vec2d(child_body.velocity)
+        self.step(1)
+        self.assertVectorsEqual(child_body.position, position + velocity / 60.0)
+
+
+class HitScanTest(unittest.TestCase):
+
+    def setUp(self):
+        """ Create a body with two others in a line in front of it. """
+        game_services = create_physics_testing_services(False)
+        self.entman = game_services.get_entity_manager()
+        self.physics = self.entman.get_system(Physics)
+        (self.shooter, self.near, self.far) = \
+            [self.entman.create_entity_with(Body) for i in range(3)]
+        self.near.get_component(Body).position = Vec2d(0, -100)
+        self.far.get_component(Body).position = Vec2d(0, -200)
+        self.physics.set_collision_group_function(
+            lambda e: 3 if e == self.near else 0
+        )
+        self.entman.create_queued_objects()
+        self.entman.update(1.0/60)
+
+    def test_hit_scan_batch(self):
+        """ Each ray should hit the closest body that isn't filtered out. """
+        (hit_entities, points, normals, fractions) = self.physics.hit_scan_batch(
+            [self.shooter] * 4,
+            [(0, 0)] * 4,
+            [(0, -1), (0, -1), (0, -1), (1, 0)],
+            1000,
+            1,
+            groups=[0, 3, 0, 0],
+            ignore=[(), (), set([self.near]), ()]
+        )
+        self.assertEquals(list(hit_entities),
+                          [self.near, self.far, self.far, None])
+        radius = self.near.get_component(Body).size
+        for (i, y) in ((0, -100), (1, -200), (2, -200)):
+            self.assertAlmostEquals(points[i][1], y + radius, places=6)
+            self.assertAlmostEquals(normals[i][1], 1, places=6)
+        self.assertEquals(tuple(points[3]), (1000, 0))
+        self.assertEquals(tuple(normals[3]), (0, 0))
+        self.assertEquals(fractions[3], 1)
+
+    def test_hit_scan_batch__non_collideable(self):
+        """ Rays should pass through non-collideable bodies. """
+        self.near.get_component(Body).is_collideable = False
+        self.entman.update(1.0/60)
+        hit_entities = self.physics.hit_scan_batch(
+            [self.shooter], [(0, 0)], [(0, -1)], 1000, 1
+        )[0]
+        self.assertEquals(list(hit_entities), [self.far])
+
+
+class TransformTest(unittest.TestCase):
+
+    def setUp(self):
+        """ Create a body and an equivalent pymunk body. """
+        game_services = create_physics_testing_services(False)
+        entman = game_services.get_entity_manager()
+        self.physics = entman.get_system(Physics)
+        self.entity = entman.create_entity_with(Body)
+        body = self.entity.get_component(Body)
+        body.position = Vec2d(10, -20)
+        body.orientation = 37
+        self.pymunk_body = Physics.PymunkBody(body)
+        self.pymunk_body.copy_from_component()
+        self.points = [Vec2d(0, 0), Vec2d(1, 0), Vec2d(-3, 7), Vec2d(100, 250)]
+
+    def assertVectorsEqual(self, v1, v2):
+        self.assertAlmostEquals(v1[0], v2[0], places=9)
+        self.assertAlmostEquals(v1[1], v2[1], places=9)
+
+    def test_local_to_world(self):
+        """ Should match pymunk's transform. """
+        body = self.pymunk_body.body
+        got = self.physics.local_to_world_array(self.entity, self.points)
+        for (point, row) in zip(self.points, got):
+            expected = body.local_to_world(point)
+            self.assertVectorsEqual(self.physics.local_to_world(self.entity, point), expected)
+            self.assertVectorsEqual(row, expected)
+
+    def test_world_to_local(self):
+        """ Should match pymunk's transform. """
+        body = self.pymunk_body.body
+        got = self.physics.world_to_local_array(self.entity, self.points)
+        for (point, row) in zip(self.points, got):
+            expected = body.world_to_local(point)
+            self.assertVectorsEqual(self.physics.world_to_local(self.entity, point), expected)
+            self.assertVectorsEqual(row, expected)
+
+    def test_local_dir_to_world(self):
+        """ Should match pymunk's transform, minus the translation. """
+        body = self.pymunk_body.body
+        got = self.physics.local_dir_to_world_array(self.entity, self.points)
+        for (point, row) in zip(self.points, got):
+            expected = body.local_to_world(point) - body.position
+            self.assertVectorsEqual(self.physics.local_dir_to_world(self.entity, point), expected)
+            self.assertVectorsEqual(row, expected)
+
+
+class SpatialIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        """ Index some entities at random positions. """
+        game_services = create_physics_testing_services(False)
+        entman = game_services.get_entity_manager()
+        rng = random.Random(0)
+        self.index = SpatialIndex(100)
+        self.entities = []
+        self.positions = {}
+        for i in range(200):
+            entity = entman.create_entity_with(Body)
+            position = (rng.uniform(-1000, 1000), rng.uniform(-1000, 1000))
+            self.index.update(entity, position[0], position[1])
+            self.entities.append(entity)
+            self.positions[entity] = position
+
+    def distance(self, entity, point):
+        (x, y) = self.positions[entity]
+        return math.hypot(x - point[0], y - point[1])
+
+    def test_k_nearest(self):
+        """ Should find the same entities as a brute force search. """
+        for point in ((0, 0), (950, -950), (5000, 5000)):
+            expected = sorted(self.entities, key=lambda e: self.distance(e, point))
+            self.assertEquals(self.index.k_nearest(point, 5), expected[:5])
+            self.assertEquals(self.index.nearest(point), expected[0])
+
+    def test_k_nearest__filtered(self):
+        """ Only entities passing the filter should be found. """
+        odd = set(self.entities[1::2])
+        point = (100, 100)
+        expected = sorted(odd, key=lambda e: self.distance(e, point))
+        got = self.index.k_nearest(point, 3, filter_func=lambda e: e in odd)
+        self.assertEquals(got, expected[:3])
+        self.assertEquals(self.index.k_nearest(point, 3, types=(Joint,)), [])
+
+    def test_query_radius(self):
+        """ Should find everything within the radius, closest first. """
+        point = (-200, 300)
+        expected = sorted([e for e in self.entities if self.distance(e, point) <= 250],
+                          key=lambda e: self.distance(e, point))
+        self.assertEquals(self.index.query_radius(point, 250), expected)
+
+    def test_query_rect(self):
+        """ Should find everything in the rectangle. """
+        expected = set(e for e in self.entities
+                       if -300 <= self.positions[e][0] <= 50 and
+                          0 <= self.positions[e][1] <= 700)
+        self.assertEquals(set(self.index.query_rect((-300, 0), (50, 700))), expected)
+
+    def test_update(self):
+        """ Moved and removed entities should be found in their new place. """
+        entity = self.entities[0]
+        self.index.update(entity, 5000, 5000)
+        self.index.update_many(self.entities[1:2], [(5001, 5001)])
+        self.index.remove(self.entities[2])
+        self.assertEquals(self.index.nearest((4999, 4999)), entity)
+        self.assertEquals(self.index.query_radius((5000, 5000), 10),
+                          [entity, self.entities[1]])
+        self.assertFalse(self.entities[2] in self.index)
+        self.assertEquals(len(self.index), 199)
+
+
+class SpaceConfigTest(unittest.TestCase):
+
+    def test_choose_spatial_hash_cell_size(self):
+        """ The cell size should fit the most common body sizes, unless the
+        bodies vary too much in size. """
+        self.assertEquals(choose_spatial_hash_cell_size([5, 5, 6, 20, 3]), 16)
+        self.assertEquals(choose_spatial_hash_cell_size([5, 5, 6, 20000]), None)
+        self.assertEquals(choose_spatial_hash_cell_size([]), None)
+
+    def test_spatial_hash(self):
+        """ An 'auto' spatial hash should be set up once there are bodies. """
+        game_services = create_physics_testing_services(False, Config({
+            "physics_spatial_hash_cell_size": "auto"
+        }))
+        entman = game_services.get_entity_manager()
+        physics = entman.get_system(Physics)
+        entman.update(1.0/60)
+        self.assertEquals(physics.spatial_hash_cell_size, None)
+        entman.create_entity_with(Body)
+        entman.create_entity_with(Body).get_component(Body).position = \
+            Vec2d(10, 5)
+        entman.create_queued_objects()
+        entman.update(1.0/60)
+        self.assertEquals(physics.spatial_hash_cell_size, 16)
+        (first, second) = entman.query(Body)
+        hit = physics.hit_scan_batch([first], [(0, 0)], [(1, 0.5)], [100], [1])
+        self.assertEquals(list(hit[0]), [second])
+
+    def check_sleep(self, columnar):
+        """ Check that an idle body falls asleep, and that changing its Body
+        component wakes it. """
+        game_services = create_physics_testing_services(columnar, Config({
+            "physics_sleep_time_threshold": 0.5,
+            "physics_idle_speed_threshold": 5
+        }))
+        entman = game_services.get_entity_manager()
+        physics = entman.get_system(Physics)
+        entity = entman.create_entity_with(Body)
+        body = entity.get_component(Body)
+        body.velocity = Vec2d(1, 0)
+        entman.create_queued_objects()
+        for i in range(40):
+            entman.update(1.0/60)
+        self.assertTrue(physics.is_sleeping(entity))
+        position = body.position
+        entman.update(1.0/60)
+        self.assertEquals(body.position, position)
+        self.assertTrue(physics.is_sleeping(entity))
+        body.velocity = Vec2d(60, 0)
+        entman.update(1.0/60)
+        self.assertFalse(physics.is_sleeping(entity))
+        self.assertAlmostEquals(body.position.x, position.x + 1)
+
+    def test_sleep(self):
+        """ Idle bodies should sleep until they are changed. """
+        self.check_sleep(False)
+
+    def check_move_in_place(self, columnar):
+        """ Check that moving a body by changing its vectors in place is seen
+        by the simulation. """
+        game_services = create_physics_testing_services(columnar)
+        entman = game_services.get_entity_manager()
+        entity = entman.create_entity_with(Body)
+        body = entity.get_component(Body)
+        entman.create_queued_objects()
+        entman.update(1.0/60)
+        body.position += Vec2d(500, 500)
+        body.velocity += Vec2d(60, 0)
+        entman.update(1.0/60)
+        self.assertAlmostEquals(body.position.x, 501)
+        self.assertAlmostEquals(body.position.y, 500)
+
+    def test_move_in_place(self):
+        """ In place changes to a body should be synced. """
+        self.check_move_in_place(False)
+
+    def test_move_in_place__columnar(self):
+        """ In place changes to a table row should be synced. """
+        self.check_move_in_place(True)
+
+    def test_sleep__columnar(self):
+        """ Idle bodies should sleep until a Body table row is changed. """
+        self.check_sleep(True)
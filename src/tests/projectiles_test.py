@@ -0,0 +1,68 @@
+import unittest
+import numpy
+from ..projectiles import *
+from ..ecs import EntityPrototype
+from ..config import Config
+from testing import *
+
+
+def bullet_config(**kwargs):
+    """ Create the config of a bullet that can be a projectile. """
+    config = {
+        "projectile": 1,
+        "components": {
+            "src.components.DamageOnContact": {"damage": 3},
+            "src.components.KillOnTimer": {"lifetime": 1},
+            "src.physics.Body": {"size": 2}
+        }
+    }
+    config.update(kwargs)
+    return Config(config)
+
+
+class ProjectileTypeTest(unittest.TestCase):
+
+    def test_init(self):
+        """ The properties should be read from the components. """
+        projectile_type = ProjectileType("bullet", EntityPrototype(bullet_config()))
+        self.assertEquals(projectile_type.damage, 3)
+        self.assertEquals(projectile_type.lifetime, 1)
+        self.assertEquals(projectile_type.size, 2)
+        self.assertEquals(projectile_type.anim_name, None)
+        self.assertEquals(projectile_type.explodes, None)
+
+    def test_can_simulate(self):
+        """ Only marked configs with the right components should be
+        simulated. """
+        self.assertTrue(ProjectileType.can_simulate(
+            EntityPrototype(bullet_config())))
+        self.assertFalse(ProjectileType.can_simulate(
+            EntityPrototype(bullet_config(projectile=0))))
+        self.assertFalse(ProjectileType.can_simulate(
+            EntityPrototype(bullet_config(components={
+                "src.components.DamageOnContact": {"damage": 3}
+            }))))
+
+
+class ProjectilesTest(unittest.TestCase):
+
+    def test_update(self):
+        """ Projectiles should be added, moved and removed in bulk. """
+        projectiles = Projectiles()
+        projectiles.add((0, 0), (10, 0), 0, 1, "a")
+        projectiles.add((5, 5), (0, -10), 1, 2, "b")
+        self.assertEquals(len(projectiles), 2)
+        self.assertEquals(len(projectiles.ages), 0)
+        projectiles.flush()
+        starts = projectiles.integrate(0.5)
+        numpy.testing.assert_array_equal(starts, [[0, 0], [5, 5]])
+        numpy.testing.assert_array_equal(projectiles.positions, [[5, 0], [5, 0]])
+        numpy.testing.assert_array_equal(projectiles.ages, [0.5, 0.5])
+        projectiles.add((1, 1), (0, 0), 0, 3, "c")
+        projectiles.flush()
+        projectiles.remove(numpy.array([True, False, False]))
+        numpy.testing.assert_array_equal(projectiles.types, [1, 0])
+        numpy.testing.assert_array_equal(projectiles.groups, [2, 3])
+        self.assertEquals(projectiles.shooters, ["b", "c"])
+        projectiles.clear()
+        self.assertEquals(len(projectiles), 0)
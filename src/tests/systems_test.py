@@ -0,0 +1,332 @@
+import unittest
+from ..systems import *
+from ..utils import Vec2d
+from testing import *
+
+
+def create_systems_testing_services():
+    """ Create game services with an entity manager that has a physics
+    system. """
+    game_services = create_entman_testing_services()
+    physics = Physics()
+    physics.set_collision_group_function(get_collision_group)
+    game_services.get_entity_manager().register_component_system(physics)
+    game_services.get_entity_manager().register_component_system(AssemblySystem())
+    game_services.get_entity_manager().register_component_system(TeamSystem())
+    return game_services
+
+
+def create_ship(entity_manager, team, position, *types):
+    """ Create an entity with a body on a team. """
+    entity = entity_manager.create_entity_with(Body, Team, *types)
+    entity.get_component(Team).team = team
+    entity.get_component(Body).position = Vec2d(position)
+    return entity
+
+
+def create_joint(entity_manager, e1, e2):
+    """ Create an entity with a joint between two others. """
+    entity = entity_manager.create_entity()
+    joint = Joint(entity, entity.game_services, Config())
+    joint.entity_a.entity = e1
+    joint.entity_b.entity = e2
+    entity.add_component(joint)
+    return entity
+
+
+class AssemblySystemTest(unittest.TestCase):
+
+    def setUp(self):
+        """ Create a chain of three jointed bodies and a lone body. """
+        game_services = create_systems_testing_services()
+        self.entman = game_services.get_entity_manager()
+        self.assemblies = self.entman.get_system(AssemblySystem)
+        (self.a, self.b, self.c, self.d) = \
+            [self.entman.create_entity_with(Body) for i in range(4)]
+        self.ab = create_joint(self.entman, self.a, self.b)
+        self.bc = create_joint(self.entman, self.b, self.c)
+
+    def test_get_assembly(self):
+        """ Entities should be in an assembly with everything they are
+        jointed to, even before they have been created. """
+        self.assertEquals(self.assemblies.get_assembly(self.a),
+                          set([self.a, self.b, self.c]))
+        self.assertEquals(self.assemblies.get_assembly(self.d), set([self.d]))
+        self.assertTrue(self.assemblies.same_assembly(self.c, self.a))
+        self.assertFalse(self.assemblies.same_assembly(self.c, self.d))
+        self.assertEquals(get_attached_entities(self.d), set([self.d]))
+
+    def test_rigid_attachment(self):
+        """ Rigidly attached entities should be in the same assembly. """
+        attachment = RigidAttachment(self.d, self.d.game_services, Config())
+        attachment.parent.entity = self.c
+        self.d.add_component(attachment)
+        self.assertTrue(self.assemblies.same_assembly(self.a, self.d))
+        self.entman.create_queued_objects()
+        self.entman.remove_component_by_concrete_type(self.d, RigidAttachment)
+        self.assertEquals(self.assemblies.get_assembly(self.d), set([self.d]))
+
+    def test_remove_joint(self):
+        """ Removing a joint should split the assembly. """
+        self.entman.create_queued_objects()
+        self.bc.kill()
+        self.entman.update(0)
+        self.assertEquals(self.assemblies.get_assembly(self.a),
+                          set([self.a, self.b]))
+        self.assertEquals(self.assemblies.get_assembly(self.c), set([self.c]))
+
+    def test_kill(self):
+        """ Killing an entity should split the assembly it was in. """
+        self.entman.create_queued_objects()
+        self.b.kill()
+        self.entman.update(0)
+        self.assertFalse(self.assemblies.same_assembly(self.a, self.c))
+        self.assertEquals(self.assemblies.get_assembly(self.c), set([self.c]))
+
+    def test_on_load(self):
+        """ The index should be rebuilt from the joints. """
+        self.entman.create_queued_objects()
+        self.assemblies.on_load()
+        self.assertEquals(self.assemblies.get_assembly(self.c),
+                          set([self.a, self.b, self.c]))
+
+
+class HitScanBatchTest(unittest.TestCase):
+
+    def test_hit_scan_batch(self):
+        """ Rays should not hit their own assembly, and should pass through
+        friendly bodies if asked to. """
+        game_services = create_systems_testing_services()
+        entman = game_services.get_entity_manager()
+        shooter = create_ship(entman, "player", (0, 0))
+        turret = create_ship(entman, "player", (0, -20))
+        create_joint(entman, shooter, turret)
+        friend = create_ship(entman, "player", (0, -100))
+        enemy = create_ship(entman, "enemy", (0, -200))
+        entman.create_queued_objects()
+        entman.update(1.0/60)
+        hit_entities = hit_scan_batch([shooter, shooter],
+                                      ignore_friendly=[False, True])[0]
+        self.assertEquals(list(hit_entities), [friend, enemy])
+        self.assertEquals(len(hit_scan_batch([])[0]), 0)
+
+        # A change of team should change the collision group.
+        enemy.get_component(Team).team = "player"
+        entman.update(1.0/60)
+        entman.update(1.0/60)
+        hit_entities = hit_scan_batch([shooter], ignore_friendly=[True])[0]
+        self.assertEquals(list(hit_entities), [None])
+
+
+class TurretSystemTest(unittest.TestCase):
+
+    def setUp(self):
+        """ Create a 'turret' with a friend in front of it and an enemy
+        behind. """
+        game_services = create_systems_testing_services()
+        self.entman = game_services.get_entity_manager()
+        self.turrets = TurretSystem(line_of_sight_frames=2,
+                                    line_of_sight_tolerance=5,
+                                    line_of_sight_angle=5)
+        self.entman.register_component_system(self.turrets)
+        self.turret = create_ship(self.entman, "player", (0, 0))
+        self.friend = create_ship(self.entman, "player", (0, -100))
+        self.enemy = create_ship(self.entman, "enemy", (0, 100))
+        self.entman.create_queued_objects()
+        self.entman.update(1.0/60)
+
+    def check(self):
+        """ Check the turret's line of sight to the enemy. """
+        return self.turrets.check_line_of_sight([(self.turret, self.enemy)])[0]
+
+    def test_check_line_of_sight(self):
+        """ Checks should be cached until they expire, or the turret moves
+        or turns. """
+        stats = self.turrets.line_of_sight_stats
+        body = self.turret.get_component(Body)
+        self.assertFalse(self.check())
+        body.position = Vec2d(3, 0)
+        self.assertFalse(self.check())
+        self.assertEquals((stats.hits, stats.misses), (1, 1))
+        body.orientation = 180
+        self.assertTrue(self.check())
+        self.assertEquals((stats.hits, stats.misses), (1, 2))
+        body.position = Vec2d(10, 0)
+        self.assertTrue(self.check())
+        self.assertEquals((stats.hits, stats.misses), (1, 3))
+        self.assertTrue(self.check())
+        for i in range(3):
+            self.entman.update(1.0/60)
+        self.check()
+        self.assertEquals((stats.hits, stats.misses), (2, 4))
+
+    def test_check_line_of_sight__hit_killed(self):
+        """ Checks should be redone if the entity in the way dies. """
+        self.assertFalse(self.check())
+        self.friend.kill()
+        self.entman.update(1.0/60)
+        self.entman.update(1.0/60)
+        self.assertTrue(self.check())
+
+
+class ProjectileSystemTest(unittest.TestCase):
+
+    def setUp(self):
+        """ Create a shooter and a target. """
+        game_services = create_systems_testing_services()
+        self.entman = game_services.get_entity_manager()
+        self.projectiles = ProjectileSystem()
+        self.entman.register_component_system(self.projectiles)
+        self.shooter = create_ship(self.entman, "player", (0, 0))
+        self.target = self.create_target("enemy", (100, 0))
+        self.friend = self.create_target("player", (50, 0))
+        self.bullet = Config({
+            "projectile": 1,
+            "components": {
+                "src.components.DamageOnContact": {"damage": 3},
+                "src.components.KillOnTimer": {"lifetime": 1},
+                "src.physics.Body": {"size": 1}
+            }
+        })
+        self.entman.create_queued_objects()
+        self.entman.update(1.0/60)
+
+    def create_target(self, team, position):
+        """ Create something with hitpoints to shoot at. """
+        target = self.entman.create_entity(Config({"components": {
+            "src.physics.Body": {"size": 5},
+            "src.components.Hitpoints": {"hp": 10},
+            "src.components.Team": {"team": team}
+        }}))
+        target.get_component(Body).position = Vec2d(position)
+        return target
+
+    def shoot(self, velocity, count=1):
+        """ Shoot some projectiles from the shooter. """
+        type_index = self.projectiles.get_type(self.bullet)
+        for i in range(count):
+            self.projectiles.shoot(type_index, Vec2d(0, 0), Vec2d(velocity),
+                                   self.shooter)
+
+    def test_hit(self):
+        """ Projectiles should pass through their own team, damage what they
+        hit, and be removed. """
+        self.shoot((600, 0), 2)
+        for i in range(12):
+            self.entman.update(1.0/60)
+        self.assertEquals(self.target.get_component(Hitpoints).hp, 4)
+        self.assertEquals(self.friend.get_component(Hitpoints).hp, 10)
+        self.assertEquals(len(self.projectiles.projectiles), 0)
+
+    def test_hit__fast(self):
+        """ Fast projectiles shouldn't pass through things between frames. """
+        self.shoot((60000, 0))
+        self.entman.update(1.0/60)
+        self.assertEquals(self.target.get_component(Hitpoints).hp, 7)
+
+    def test_shooter_assembly(self):
+        """ The assembly of a shooter should be looked up once a frame, not
+        once per projectile. """
+        assemblies = self.entman.get_system(AssemblySystem)
+        calls = []
+        def get_assembly(entity):
+            calls.append(entity)
+            return AssemblySystem.get_assembly(assemblies, entity)
+        assemblies.get_assembly = get_assembly
+        self.shoot((0, 600), 10)
+        self.entman.update(1.0/60)
+        self.assertEquals(calls, [self.shooter])
+
+    def test_expire(self):
+        """ Projectiles should be removed at the end of their lifetime. """
+        self.shoot((0, 600))
+        for i in range(59):
+            self.entman.update(1.0/60)
+        self.assertEquals(len(self.projectiles.projectiles), 1)
+        self.entman.update(1.0/60)
+        self.entman.update(1.0/60)
+        self.assertEquals(len(self.projectiles.projectiles), 0)
+
+    def test_no_entities(self):
+        """ The system shouldn't manage any entities or components. """
+        self.assertEquals(self.projectiles.entity_count(), 0)
+        self.assertFalse(self.projectiles.matches(Body))
+        self.assertFalse(self.projectiles.matches(Weapon))
+
+    def test_get_type(self):
+        """ Bullets that can't be projectiles should be entities. """
+        self.assertEquals(self.projectiles.get_type(self.bullet), 0)
+        self.assertEquals(self.projectiles.get_type(Config({"components": {}})),
+                          None)
+
+
+class TrackingSystemTest(unittest.TestCase):
+
+    def test_update(self):
+        """ Trackers should track the nearest body on another team. """
+        game_services = create_systems_testing_services()
+        entman = game_services.get_entity_manager()
+        entman.register_component_system(TrackingSystem())
+        tracker1 = create_ship(entman, "player", (0, 0), Tracking)
+        tracker2 = create_ship(entman, "enemy", (1000, 0), Tracking)
+        friend = create_ship(entman, "player", (10, 0))
+        enemy1 = create_ship(entman, "enemy", (100, 0))
+        enemy2 = create_ship(entman, "enemy", (-50, 0))
+        no_team = entman.create_entity_with(Body)
+        no_team.get_component(Body).position = Vec2d(900, 0)
+        entman.create_queued_objects()
+        entman.update(0)
+        self.assertEquals(tracker1.get_component(Tracking).tracked.entity, enemy2)
+        self.assertEquals(tracker2.get_component(Tracking).tracked.entity, friend)
+
+    def test_update__dead_target(self):
+        """ Trackers should not track bodies that have died since the
+        targets were found. """
+        game_services = create_systems_testing_services()
+        entman = game_services.get_entity_manager()
+        tracking = TrackingSystem()
+        entman.register_component_system(tracking)
+        tracker = create_ship(entman, "player", (0, 0), Tracking)
+        enemy1 = create_ship(entman, "enemy", (100, 0))
+        enemy2 = create_ship(entman, "enemy", (200, 0))
+        entman.create_queued_objects()
+        tracking.get_targets()
+        enemy1.kill()
+        tracking.update(0)
+        self.assertEquals(tracker.get_component(Tracking).tracked.entity, enemy2)
+
+    def test_update__switch(self):
+        """ Trackers should only switch to a target that is much nearer. """
+        game_services = create_systems_testing_services()
+        entman = game_services.get_entity_manager()
+        tracking = TrackingSystem()
+        entman.register_component_system(tracking)
+        tracker = create_ship(entman, "player", (0, 0), Tracking)
+        enemy1 = create_ship(entman, "enemy", (100, 0))
+        entman.create_queued_objects()
+        entman.update(0)
+        self.assertEquals(tracker.get_component(Tracking).tracked.entity, enemy1)
+        enemy2 = create_ship(entman, "enemy", (-80, 0))
+        entman.create_queued_objects()
+        entman.update(tracking.rebuild_period)
+        self.assertEquals(tracker.get_component(Tracking).tracked.entity, enemy1)
+        enemy3 = create_ship(entman, "enemy", (0, 30))
+        entman.create_queued_objects()
+        entman.update(tracking.rebuild_period)
+        self.assertEquals(tracker.get_component(Tracking).tracked.entity, enemy3)
+
+    def test_get_targets(self):
+        """ The trees should only be rebuilt when they are too old. """
+        game_services = create_systems_testing_services()
+        entman = game_services.get_entity_manager()
+        tracking = TrackingSystem()
+        entman.register_component_system(tracking)
+        create_ship(entman, "player", (0, 0))
+        create_ship(entman, "enemy", (100, 0))
+        entman.create_queued_objects()
+        targets = tracking.get_targets()
+        create_ship(entman, "enemy", (200, 0))
+        entman.create_queued_objects()
+        self.assertTrue(tracking.get_targets() is targets)
+        tracking.update(tracking.rebuild_period)
+        self.assertFalse(tracking.get_targets() is targets)
@@ -0,0 +1,100 @@
+import unittest
+import numpy
+from .. import teams
+from ..teams import *
+from ..components import Team
+from testing import *
+
+
+class TeamSystemTest(unittest.TestCase):
+
+    def setUp(self):
+        """ Create a ship, a turret on the ship, and a bullet fired by the
+        turret. """
+        game_services = create_entman_testing_services()
+        self.entman = game_services.get_entity_manager()
+        self.teams = TeamSystem()
+        self.entman.register_component_system(self.teams)
+        (self.ship, self.turret, self.bullet, self.other) = \
+            [self.entman.create_entity_with(Team) for i in range(4)]
+        self.ship.get_component(Team).team = "player"
+        self.other.get_component(Team).team = "enemy"
+        self.turret.get_component(Team).parent.entity = self.ship
+        self.bullet.get_component(Team).parent.entity = self.turret
+        self.entman.create_queued_objects()
+
+    def test_get_team(self):
+        """ Entities should be on the team of their furthest ancestor. """
+        self.assertEquals(self.teams.get_team(self.bullet), "player")
+        self.assertEquals(self.teams.get_team(self.other), "enemy")
+        self.assertEquals(self.teams.get_team_id(self.entman.create_entity()),
+                          NO_TEAM)
+        self.assertEquals(self.teams.get_team_id(self.bullet),
+                          self.teams.get_id_for_team("player"))
+
+    def test_invalidate__team(self):
+        """ Changing a team should change its descendants' teams. """
+        self.teams.get_team(self.bullet)
+        self.ship.get_component(Team).team = "enemy"
+        self.assertEquals(self.teams.get_team(self.bullet), "enemy")
+
+    def test_invalidate__parent(self):
+        """ Changing a parent should change its descendants' teams. """
+        self.teams.get_team(self.bullet)
+        self.turret.get_component(Team).parent.entity = self.other
+        self.assertEquals(self.teams.get_team(self.bullet), "enemy")
+
+    def test_invalidate__death(self):
+        """ An entity whose ancestors have died should lose their team. """
+        self.teams.get_team(self.bullet)
+        self.ship.kill()
+        self.entman.update(0)
+        self.assertEquals(self.teams.get_team(self.bullet), None)
+
+    def test_cache(self):
+        """ Teams should stay cached while other entities' teams change. """
+        calls = []
+        def counting_resolve_team(entity):
+            calls.append(entity)
+            return resolve_team(entity)
+        self.teams.get_team(self.bullet)
+        teams.resolve_team = counting_resolve_team
+        try:
+            other_bullet = self.entman.create_entity_with(Team)
+            other_bullet.get_component(Team).parent.entity = self.other
+            self.other.get_component(Team).team = "pirates"
+            self.assertEquals(self.teams.get_team(self.bullet), "player")
+            self.assertEquals(calls, [])
+        finally:
+            teams.resolve_team = resolve_team
+
+    def test_no_system(self):
+        """ Teams should be found without a TeamSystem. """
+        from ..systems import get_team, on_same_team
+        entman = create_entman_testing_services().get_entity_manager()
+        (ship, bullet, other) = [entman.create_entity_with(Team)
+                                 for i in range(3)]
+        ship.get_component(Team).team = "player"
+        other.get_component(Team).team = "enemy"
+        bullet.get_component(Team).parent.entity = ship
+        self.assertEquals(get_team(bullet), "player")
+        self.assertTrue(on_same_team(bullet, ship))
+        self.assertFalse(on_same_team(bullet, other))
+
+    def test_team_ids(self):
+        """ The team ids should be written to the Team components, and can be
+        compared in bulk. """
+        self.entman.update(0)
+        entities = [self.ship, self.turret, self.bullet, self.other]
+        ids = self.teams.team_ids(entities)
+        self.assertEquals(
+            [e.get_component(Team).team_id for e in entities], list(ids)
+        )
+        numpy.testing.assert_array_equal(
+            hostile(ids[:, None], ids[None, :]),
+            [[False, False, False, True],
+             [False, False, False, True],
+             [False, False, False, True],
+             [True, True, True, False]]
+        )
+        self.assertFalse(hostile(ids[3], NO_TEAM))
@@ -0,0 +1,108 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import numpy
+import scipy.optimize
+from ..thrusters import *
+from testing import *
+
+
+# The layout of the player's thrusters.
+PLAYER_LAYOUT = (
+    (-20, -20, 1, 0, 8000),
+    (-20, 20, 1, 0, 8000),
+    (20, -20, -1, 0, 8000),
+    (20, 20, -1, 0, 8000),
+    (0, -20, 0, 1, 8000),
+    (0, 20, 0, -1, 50000),
+)
+
+
+def objective(layout, direction, turn, thrusts):
+    """ The value to be maximised by an allocation. """
+    array = numpy.array(layout, float)
+    direction = numpy.array(direction, float)
+    length = numpy.hypot(*direction)
+    if length > 0:
+        direction /= length
+    (px, py, dx, dy, max_thrust) = array.T
+    force = (numpy.dot(thrusts, dx), numpy.dot(thrusts, dy))
+    moment = numpy.dot(thrusts, px*dy - py*dx)
+    return numpy.dot(direction, force) + numpy.sign(turn) * moment
+
+
+class SolveTest(unittest.TestCase):
+
+    def test_solve(self):
+        """ Should do at least as well as a general purpose optimiser. """
+        for direction in DIRECTIONS + ((0.6, 0.8),):
+            for turn in TURNS:
+                thrusts = solve(PLAYER_LAYOUT, direction, turn)
+                optimised = scipy.optimize.minimize(
+                    lambda t: -objective(PLAYER_LAYOUT, direction, turn, t),
+                    numpy.zeros(len(PLAYER_LAYOUT)),
+                    method="TNC",
+                    bounds=[(0, t[4]) for t in PLAYER_LAYOUT]
+                )
+                self.assertTrue(
+                    objective(PLAYER_LAYOUT, direction, turn, thrusts) >=
+                    objective(PLAYER_LAYOUT, direction, turn, optimised.x) - 1e-3
+                )
+                for (thrust, thruster) in zip(thrusts, PLAYER_LAYOUT):
+                    self.assertTrue(0 <= thrust <= thruster[4])
+
+    def test_solve__no_input(self):
+        """ Thrusters should be off if nothing is wanted. """
+        self.assertEquals(solve(PLAYER_LAYOUT, (0, 0), 0), (0,) * 6)
+        self.assertEquals(solve((), (1, 0), 1), ())
+
+
+class ThrusterSolverTest(unittest.TestCase):
+
+    def test_get_thrusts(self):
+        """ Layouts should be solved once, up front, and shared. """
+        solver = ThrusterSolver()
+        table = solver.get_table(PLAYER_LAYOUT)
+        self.assertEquals(len(table), len(DIRECTIONS) * len(TURNS))
+        self.assertEquals(solver.solved, len(table))
+        layout = tuple(tuple(thruster) for thruster in PLAYER_LAYOUT)
+        self.assertEquals(solver.get_thrusts(layout, (1.0, 0.0), 1),
+                          solve(PLAYER_LAYOUT, (1, 0), 1))
+        self.assertEquals(solver.solved, len(table))
+        self.assertEquals(len(solver), 1)
+
+    def test_get_thrusts__continuous(self):
+        """ Inputs that aren't discrete should be solved when they are
+        first seen. """
+        solver = ThrusterSolver()
+        thrusts = solver.get_thrusts(PLAYER_LAYOUT, (0.6, 0.8), 0)
+        self.assertEquals(thrusts, solve(PLAYER_LAYOUT, (0.6, 0.8), 0))
+        self.assertEquals(solver.solved, len(DIRECTIONS) * len(TURNS) + 1)
+
+    def test_save_load(self):
+        """ Solutions should be loaded from a cache, unless the cache is from
+        a different version of the solver. """
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "thruster_cache.json")
+            solver = ThrusterSolver()
+            solver.get_table(PLAYER_LAYOUT)
+            solver.save(filename)
+            loaded = ThrusterSolver()
+            self.assertEquals(loaded.load(filename), 1)
+            self.assertEquals(loaded.get_thrusts(PLAYER_LAYOUT, (0, 1), -1),
+                              solve(PLAYER_LAYOUT, (0, 1), -1))
+            self.assertEquals(loaded.solved, 0)
+            with open(filename) as f:
+                text = f.read()
+            self.assertTrue(text.endswith("}\n"))
+            data = json.loads(text)
+            data["version"] = SOLVER_VERSION + 1
+            with open(filename, "w") as f:
+                json.dump(data, f)
+            self.assertEquals(ThrusterSolver().load(filename), 0)
+            self.assertEquals(ThrusterSolver().load(filename + ".missing"), 0)
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,160 @@
+"""
+Thruster allocation.
+
+An entity with Thrusters moves by firing some combination of its thrusters.
+Given a desired direction of movement and a desired direction of turn, we want
+to find the thrust, Tn, of each thruster, such that 0 <= Tn <= TMAXn, which
+maximises
+
+    direction . F' + sign(turn) * Q'
+
+where F' = sum(Tn * Dn) is the resultant force on the body and
+Q' = sum(Pn x (Tn * Dn)) is the resultant torque, for thruster positions Pn
+and directions Dn.
+
+This is a linear program, but since the objective is linear and each thrust is
+only bounded by its own limits, it separates into one problem per thruster:
+each thruster fires at full thrust if it contributes positively to the
+objective, and is off otherwise.
+
+The solutions depend only on the layout of the thrusters, so they are shared
+between all of the entities with the same layout.  The inputs given by the
+player and the AI are (nearly always) one of a small number of discrete values,
+so the solutions for those are all computed when a layout is first seen.
+
+The solutions for the layouts in the configs can also be saved to a cache file,
+which is loaded when the game starts (see bin/build_thruster_cache.)  The cache
+is keyed by a hash of each layout, and records the version of the solver that
+built it; a cache from a different version is ignored.
+"""
+
+
+import hashlib
+import json
+import os
+import numpy
+
+
+# The version of the solver. This must be incremented whenever a change would
+# give different solutions, so that out of date caches are not used.
+SOLVER_VERSION = 1
+
+# The discrete directions and turns that are solved for up front.
+DIRECTIONS = tuple((x, y) for x in (-1, 0, 1) for y in (-1, 0, 1))
+TURNS = (-1, 0, 1)
+
+
+def get_layout(thrusters):
+    """ Get the layout of a list of Thruster components: a tuple of
+    (px, py, dx, dy, max_thrust) for each thruster, which can be used as a
+    key. """
+    return tuple((float(t.position.x), float(t.position.y),
+                  float(t.direction.x), float(t.direction.y),
+                  float(t.max_thrust)) for t in thrusters)
+
+
+def layout_hash(layout):
+    """ Get a hash of a layout that is stable between runs. """
+    layout = tuple(tuple(float(x) for x in thruster) for thruster in layout)
+    return hashlib.sha1(repr(layout)).hexdigest()
+
+
+def solve_table(layout):
+    """ Solve a layout for all of the discrete inputs, returning a dict
+    mapping ((x, y), turn) to thrusts. """
+    table = {}
+    for direction in DIRECTIONS:
+        for turn in TURNS:
+            table[(direction, turn)] = solve(layout, direction, turn)
+    return table
+
+
+def solve(layout, direction, turn):
+    """ Get the thrust of each thruster in a layout that best achieves the
+    desired direction of movement and turn. """
+    if len(layout) == 0:
+        return ()
+    array = numpy.array(layout, float)
+    (px, py, dx, dy, max_thrust) = array.T
+    (x, y) = (float(direction[0]), float(direction[1]))
+    length = numpy.hypot(x, y)
+    if length > 0:
+        (x, y) = (x / length, y / length)
+    value = x*dx + y*dy + numpy.sign(turn) * (px*dy - py*dx)
+    return tuple(numpy.where(value > 1e-9, max_thrust, 0.0).tolist())
+
+
+class ThrusterSolver(object):
+    """ Solves and caches thruster allocations, by layout. """
+
+    def __init__(self):
+        """ Constructor. """
+        self.__tables = {}
+        self.solved = 0
+
+    def get_table(self, layout):
+        """ Get the table of solutions for a layout, mapping
+        ((x, y), turn) to thrusts.  The discrete inputs are solved the first
+        time the layout is seen. """
+        table = self.__tables.get(layout)
+        if table is None:
+            table = solve_table(layout)
+            self.solved += len(table)
+            self.__tables[layout] = table
+        return table
+
+    def set_table(self, layout, table):
+        """ Set the table of solutions for a layout. """
+        self.__tables[layout] = table
+
+    def get_thrusts(self, layout, direction, turn):
+        """ Get the thrust of each thruster in a layout for some input. """
+        table = self.get_table(layout)
+        key = ((direction[0], direction[1]), turn)
+        thrusts = table.get(key)
+        if thrusts is None:
+            thrusts = solve(layout, direction, turn)
+            table[key] = thrusts
+            self.solved += 1
+        return thrusts
+
+    def save(self, filename):
+        """ Save the tables of solutions to a cache file. """
+        layouts = {}
+        for (layout, table) in self.__tables.items():
+            layouts[layout_hash(layout)] = {
+                "layout": layout,
+                "solutions": [[direction[0], direction[1], turn, thrusts]
+                              for ((direction, turn), thrusts) in sorted(table.items())]
+            }
+        with open(filename, "w") as f:
+            json.dump({"version": SOLVER_VERSION, "layouts": layouts}, f,
+                      sort_keys=True)
+            f.write("\n")
+
+    def load(self, filename):
+        """ Load tables of solutions from a cache file.  Returns the number of
+        layouts loaded, which is zero if the file doesn't exist or was built
+        by a different version of the solver. """
+        if not os.path.exists(filename):
+            return 0
+        with open(filename) as f:
+            data = json.load(f)
+        if data.get("version") != SOLVER_VERSION:
+            return 0
+        loaded = 0
+        for (key, entry) in data["layouts"].items():
+            layout = tuple(tuple(float(x) for x in thruster)
+                           for thruster in entry["layout"])
+            if layout_hash(layout) != key:
+                continue
+            table = {}
+            for (x, y, turn, thrusts) in entry["solutions"]:
+                table[((x, y), turn)] = tuple(thrusts)
+            self.__tables[layout] = table
+            loaded += 1
+        return loaded
+
+    def __len__(self):
+        """ Get the number of layouts that have been solved. """
+        return len(self.__tables)